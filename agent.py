@@ -1,18 +1,29 @@
 # agent.py
 import os
 import io
+import sys
+import gzip
+import json
 import time
+import random
 import base64
+import hashlib
 import uuid
 import socket
 import ctypes
 import tempfile
 import subprocess
 import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from pathlib import Path
 
 import requests
 import psutil
+try:
+    import zstandard
+except ImportError:  # без zstandard — только gzip
+    zstandard = None
 import ipaddress
 from PIL import ImageGrab
 import platform
@@ -328,9 +339,16 @@ def test_scan_permissions(scan_path):
         return False
 
 
-HEARTBEAT_INTERVAL_SEC = 1
+HEARTBEAT_INTERVAL_SEC = 1   # пауза перед повтором после ошибки или пустого ответа без ожидания
+HEARTBEAT_LONGPOLL_SEC = 20  # сервер держит heartbeat до команды или до этого дедлайна
 CONNS_PUSH_INTERVAL_SEC = 15
 HTTP_TIMEOUT = 5
+UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+UPLOAD_RETRIES = 5
+COMPRESS_MIN_BYTES = 1024    # тела запросов больше этого сжимаются (gzip, zstd если сервер умеет)
+RELAY_PORT = 5001            # relay-режим: порт, на который смотрят локальные агенты
+RELAY_AGENT_TTL_SEC = 60     # локальный агент молчит дольше — relay перестаёт слать за него heartbeat
+RATE_LIMIT_RETRIES = 5       # 429 от сервера: сколько раз повторить запрос, выждав Retry-After
 
 
 # ----------------- Устойчивый ID -----------------
@@ -372,27 +390,149 @@ def get_mac() -> str:
     return ':'.join(("%012X" % mac)[i:i + 2] for i in range(0, 12, 2))
 
 
-def send_file_to_server(filename: str, raw_bytes: bytes):
-    """Отправка файла на сервер (base64) на /api/agent/<id>/file"""
-    b64 = base64.b64encode(raw_bytes).decode("utf-8")
-    requests.post(
-        f"{API_BASE}/{AGENT_ID}/file",
-        json={"name": filename, "data": b64},
+def send_file_to_server(filename: str, fileobj):
+    """
+    Чанковая загрузка файла на /api/agent/<id>/uploads: сырые байты по 4 МБ,
+    с докачкой после обрыва. fileobj — открытый на чтение бинарный файл (или BytesIO).
+    """
+    h = hashlib.sha256()
+    total = 0
+    for buf in iter(lambda: fileobj.read(UPLOAD_CHUNK_BYTES), b""):
+        h.update(buf)
+        total += len(buf)
+
+    r = requests.post(
+        f"{API_BASE}/{AGENT_ID}/uploads",
+        json={"name": filename, "total": total, "sha256": h.hexdigest()},
         timeout=HTTP_TIMEOUT
     )
+    while r.status_code == 429:
+        time.sleep(retry_after(r))
+        r = requests.post(
+            f"{API_BASE}/{AGENT_ID}/uploads",
+            json={"name": filename, "total": total, "sha256": h.hexdigest()},
+            timeout=HTTP_TIMEOUT
+        )
+    r.raise_for_status()
+    upload_id, offset = r.json()["upload_id"], r.json()["offset"]
+    url = f"{API_BASE}/{AGENT_ID}/uploads/{upload_id}"
+
+    retries = 0
+    while True:
+        fileobj.seek(offset)
+        chunk = fileobj.read(UPLOAD_CHUNK_BYTES)
+        try:
+            r = requests.put(
+                url, params={"offset": offset}, data=chunk,
+                headers={"Content-Type": "application/octet-stream"},
+                timeout=HTTP_TIMEOUT + 30
+            )
+            if r.status_code == 429:
+                # сервер просит притормозить — тот же чанк позже, попыткой это не считаем
+                time.sleep(retry_after(r))
+                continue
+            if r.status_code == 409:
+                # сервер знает смещение лучше нас — докачиваем с него
+                offset = r.json().get("offset") or 0
+                continue
+            if r.status_code == 422:
+                raise RuntimeError(r.json().get("error") or "upload rejected")
+            r.raise_for_status()
+            retries = 0
+        except requests.RequestException:
+            retries += 1
+            if retries > UPLOAD_RETRIES:
+                raise
+            time.sleep(min(2 ** retries, 30))
+            st = requests.get(url, timeout=HTTP_TIMEOUT)
+            if st.ok:
+                offset = st.json()["offset"]
+            continue
 
+        body = r.json()
+        if body.get("status") == "stored":
+            return
+        offset = body["offset"]
 
-def post_output(text: str):
+
+# кодировки тел запросов, которые понимает сервер: он перечисляет их в Accept-Encoding
+# ответов на POST. До первого ответа — только gzip; пустой кортеж — сервер сжатие не понимает
+SERVER_ENCODINGS = ("gzip",)
+
+
+def retry_after(r, default=HEARTBEAT_INTERVAL_SEC):
+    """Пауза из Retry-After ответа 429 — с разбросом, чтобы агенты не возвращались все разом."""
+    try:
+        sec = float(r.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        sec = default
+    return min(max(sec, 0), 300) * random.uniform(1.0, 1.5)
+
+
+def returned_early(t0):
+    """Ответ на long-poll пришёл намного раньше запрошенного ожидания — сервер его не держал."""
+    return time.monotonic() - t0 < HEARTBEAT_LONGPOLL_SEC / 2
+
+
+def post_json(url: str, payload, timeout=HTTP_TIMEOUT):
+    """
+    POST JSON; крупное тело сжимается. Старый сервер (400/415 на сжатое) — повтор без сжатия.
+    Сервер перегружен (429) — ждём Retry-After и повторяем, до RATE_LIMIT_RETRIES раз.
+    """
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        r = _post_json_once(url, payload, timeout)
+        if r.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+            return r
+        time.sleep(retry_after(r))
+
+
+def _post_json_once(url, payload, timeout):
+    global SERVER_ENCODINGS
+    body = json.dumps(payload).encode()
+    headers = {"Content-Type": "application/json"}
+    enc = None
+    if len(body) >= COMPRESS_MIN_BYTES and SERVER_ENCODINGS:
+        enc = "zstd" if zstandard and "zstd" in SERVER_ENCODINGS else "gzip"
+        headers["Content-Encoding"] = enc
+    data = body if enc is None else (
+        zstandard.ZstdCompressor(level=3).compress(body) if enc == "zstd" else gzip.compress(body))
+
+    r = requests.post(url, data=data, headers=headers, timeout=timeout)
+    advertised = r.headers.get("Accept-Encoding")
+    if advertised is not None:
+        SERVER_ENCODINGS = tuple(e.strip() for e in advertised.split(",") if e.strip() in ("gzip", "zstd"))
+    elif enc and r.status_code in (400, 415):
+        SERVER_ENCODINGS = ()
+    if enc and r.status_code in (400, 415) and enc not in SERVER_ENCODINGS:
+        r = requests.post(url, data=body, headers={"Content-Type": "application/json"}, timeout=timeout)
+    return r
+
+
+# ID команды, которая сейчас выполняется — сервер по нему отдаёт вывод ожидающему аналитику
+CURRENT_COMMAND_ID = None
+
+
+def post_output(text: str, done: bool = False):
     try:
-        requests.post(
+        post_json(
             f"{API_BASE}/{AGENT_ID}/output",
-            json={"output": text},
-            timeout=HTTP_TIMEOUT
+            {"output": text, "command_id": CURRENT_COMMAND_ID, "done": done}
         )
     except Exception:
         pass
 
 
+def run_command(cmd_id: str, command: str):
+    """Выполняет команду и сообщает серверу, что она завершена."""
+    global CURRENT_COMMAND_ID
+    CURRENT_COMMAND_ID = cmd_id
+    try:
+        handle_command(command)
+    finally:
+        post_output("", done=True)
+        CURRENT_COMMAND_ID = None
+
+
 # ----------------- Команды сервера -----------------
 def handle_command(command: str):
     command = (command or "").strip()
@@ -405,7 +545,8 @@ def handle_command(command: str):
             img = ImageGrab.grab()
             buf = io.BytesIO()
             img.save(buf, format="PNG")
-            send_file_to_server(f"screenshot_{int(time.time())}.png", buf.getvalue())
+            buf.seek(0)
+            send_file_to_server(f"screenshot_{int(time.time())}.png", buf)
             post_output("Screenshot captured")
         except Exception as e:
             post_output(f"Screenshot error: {e}")
@@ -594,8 +735,8 @@ def handle_command(command: str):
     if command.startswith("__DOWNLOAD__:"):
         filepath = command.split(":", 1)[1].strip().strip('"')
         try:
-            data = Path(filepath).read_bytes()
-            send_file_to_server(Path(filepath).name, data)
+            with open(filepath, "rb") as f:
+                send_file_to_server(Path(filepath).name, f)
             post_output(f"File '{os.path.basename(filepath)}' sent to server.")
         except Exception as e:
             post_output(f"Download failed: {e}")
@@ -643,19 +784,140 @@ def push_conns_loop():
         try:
             conns = collect_conns()
             if conns:
-                requests.post(url, json={"conns": conns}, timeout=HTTP_TIMEOUT)
+                post_json(url, {"conns": conns})
         except Exception as e:
             print("connections post error:", e)
         time.sleep(CONNS_PUSH_INTERVAL_SEC)
 
 
+# ----------------- Relay-режим -----------------
+class Relay:
+    """
+    Шлюз для сегмента сети: локальные агенты указывают адрес relay вместо сервера.
+    Их heartbeat'ы relay собирает и шлёт наверх одной сжатой пачкой
+    (/api/heartbeat/batch), команды из ответа раздаёт ждущим агентам.
+    Остальные запросы (output, uploads, connections) проксируются как есть.
+    Доставку команд серверу подтверждает сам relay — в следующей пачке.
+    """
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.agents = {}    # agent_id -> (данные heartbeat, время последнего)
+        self.acks = {}      # agent_id -> [cmd_id], подтвердим серверу в следующей пачке
+        self.commands = {}  # agent_id -> [команды], ждут, пока агент придёт за ними
+
+    def heartbeat(self, payload, ip):
+        agent_id = payload["id"]
+        try:
+            wait = min(float(payload.get("wait") or 0), HEARTBEAT_LONGPOLL_SEC)
+        except (TypeError, ValueError):
+            wait = 0
+        entry = {k: payload.get(k, "") for k in ("id", "hostname", "os", "mac")}
+        entry["ip"] = ip
+        with self.cv:
+            self.agents[agent_id] = (entry, time.time())
+            self.cv.wait_for(lambda: self.commands.get(agent_id), timeout=wait)
+            return self.commands.pop(agent_id, [])
+
+    def _collect(self):
+        with self.cv:
+            now = time.time()
+            for agent_id in [a for a, (_, ts) in self.agents.items() if now - ts > RELAY_AGENT_TTL_SEC]:
+                del self.agents[agent_id]
+                self.commands.pop(agent_id, None)
+            acks, self.acks = self.acks, {}
+            return [dict(e, ack=acks.get(a, [])) for a, (e, _) in self.agents.items()], acks
+
+    def uplink_loop(self):
+        url = f"{SERVER_BASE}/api/heartbeat/batch"
+        while True:
+            agents, acks = self._collect()
+            if not agents:
+                time.sleep(HEARTBEAT_INTERVAL_SEC)
+                continue
+            t0 = time.monotonic()
+            try:
+                r = post_json(url, {"relay": AGENT_ID, "wait": HEARTBEAT_LONGPOLL_SEC, "agents": agents},
+                              timeout=HEARTBEAT_LONGPOLL_SEC + HTTP_TIMEOUT)
+                r.raise_for_status()
+                commands = (r.json() or {}).get("commands") or {}
+            except Exception as e:
+                print(f"[{time.ctime()}] Relay batch error: {e}")
+                with self.cv:
+                    for agent_id, ids in acks.items():
+                        self.acks.setdefault(agent_id, []).extend(ids)
+                time.sleep(HEARTBEAT_INTERVAL_SEC)
+                continue
+            with self.cv:
+                for agent_id, batch in commands.items():
+                    self.acks.setdefault(agent_id, []).extend(c["id"] for c in batch)
+                    self.commands.setdefault(agent_id, []).extend(batch)
+                self.cv.notify_all()
+            if not commands and returned_early(t0):
+                time.sleep(HEARTBEAT_INTERVAL_SEC)
+
+
+def run_relay(port):
+    relay = Relay()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, body, headers=()):
+            self.send_response(status)
+            for k, v in headers:
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _proxy(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else None
+            if self.command == "POST" and self.path.split("?")[0] == "/api/heartbeat":
+                try:
+                    payload = json.loads(body or b"{}")
+                except ValueError:
+                    payload = {}
+                if not payload.get("id"):
+                    return self._reply(400, b'{"error": "id required"}', [("Content-Type", "application/json")])
+                batch = relay.heartbeat(payload, self.client_address[0])
+                out = {"status": "ok", "commands": batch, "command": batch[0]["command"] if batch else None}
+                return self._reply(200, json.dumps(out).encode(), [("Content-Type", "application/json")])
+
+            headers = {k: v for k, v in self.headers.items()
+                       if k.lower() in ("content-type", "content-encoding", "range", "if-none-match")}
+            try:
+                r = requests.request(self.command, SERVER_BASE + self.path, data=body,
+                                     headers=headers, timeout=HTTP_TIMEOUT + 30)
+            except requests.RequestException as e:
+                return self._reply(502, str(e).encode(), [("Content-Type", "text/plain")])
+            self._reply(r.status_code, r.content, [(k, v) for k, v in r.headers.items()
+                                                   if k.lower() in ("content-type", "etag", "content-range",
+                                                                    "retry-after")])
+
+        do_GET = do_POST = do_PUT = _proxy
+
+        def log_message(self, fmt, *args):
+            pass
+
+    threading.Thread(target=relay.uplink_loop, daemon=True).start()
+    print(f"🔁 Relay mode: local agents -> http://<this-host>:{port}, upstream {SERVER_BASE}")
+    ThreadingHTTPServer(("0.0.0.0", port), Handler).serve_forever()
+
+
 # ----------------- Main -----------------
 if __name__ == "__main__":
+    if "--relay" in sys.argv:
+        # python agent.py --relay [port]
+        i = sys.argv.index("--relay")
+        run_relay(int(sys.argv[i + 1]) if len(sys.argv) > i + 1 else RELAY_PORT)
+        sys.exit(0)
+
     if not is_admin():
         print("[!] It is recommended to run this agent as Administrator.")
 
     print(f"🔄 VAST Agent is now running and connecting to: {SERVER_BASE}")
-    print("   • Sending heartbeats every 1 second")
+    print(f"   • Long-polling for commands (up to {HEARTBEAT_LONGPOLL_SEC} seconds per heartbeat)")
     print("   • Monitoring network connections every 15 seconds")
     print("   • YARA scanning configured and ready")
     print("   • Ready to receive commands from security analysts")
@@ -665,20 +927,36 @@ if __name__ == "__main__":
     # фон: отправка сетевых подключений для Threat Intel
     threading.Thread(target=push_conns_loop, daemon=True).start()
 
-    # heartbeat + команды
+    # heartbeat + команды (long-poll: сервер отвечает сразу, как появится команда)
+    pending_acks = []            # ID команд из прошлого ответа — подтверждаем в следующем heartbeat
+    done_ids = deque(maxlen=256) # защита от повторного выполнения при повторной доставке
     while True:
         payload = {
             "id": AGENT_ID,
             "hostname": socket.gethostname(),
             "os": f"{platform.system()} {platform.release()}",
-            "mac": get_mac()
+            "mac": get_mac(),
+            "wait": HEARTBEAT_LONGPOLL_SEC,
+            "ack": pending_acks
         }
+        t0 = time.monotonic()
         try:
-            r = requests.post(HEARTBEAT_URL, json=payload, timeout=HTTP_TIMEOUT)
+            r = requests.post(HEARTBEAT_URL, json=payload, timeout=HEARTBEAT_LONGPOLL_SEC + HTTP_TIMEOUT)
             if r.ok:
-                cmd = (r.json() or {}).get("command") or ""
-                if cmd.strip():
-                    handle_command(cmd)
+                batch = (r.json() or {}).get("commands") or []
+                pending_acks = [c["id"] for c in batch]
+                for c in batch:
+                    if c["id"] in done_ids:
+                        continue
+                    done_ids.append(c["id"])
+                    run_command(c["id"], c.get("command") or "")
+                # сервер без long-poll (старый, HEARTBEAT_LONGPOLL_MAX_SEC=0, нет свободных слотов)
+                # отвечает сразу — без паузы агент крутился бы в цикле
+                if batch or not returned_early(t0):
+                    continue
+            elif r.status_code == 429:
+                time.sleep(retry_after(r))
+                continue
             else:
                 print(f"[{time.ctime()}] Heartbeat status: {r.status_code}")
         except Exception as e:
@@ -44,6 +44,18 @@ def create_app(config):
 
     app.config.from_object(config)
 
+    # сжатие тел запросов/ответов (gzip, zstd)
+    from apps.api import compression
+    compression.init_app(app)
+
+    # /metrics и замер задержки запросов
+    from apps.api import telemetry
+    telemetry.init_app(app)
+
+    # профилирование запросов по токену или выборочно (внешний слой WSGI)
+    from apps.api import profiling
+    profiling.init_app(app)
+
     # API routes
     from apps.api.routes import api as api_blueprint
     app.register_blueprint(api_blueprint)
@@ -1,28 +1,456 @@
 # apps/api/agent_state.py
-from threading import Lock
+from threading import Lock, Thread
 from datetime import datetime
+from itertools import islice
+import bisect
+import heapq
+import json
 import time
 
-agents_cache = {}
-lock = Lock()
+from apps.api import backend, snapshot, telemetry
+
+ONLINE_WINDOW = 30  # сек без heartbeat -> агент offline
+SWEEP_INTERVAL_SEC = 1
+
+_listeners = []  # fn(agent_id, online: bool) — вызывается при смене статуса
+
+
+def on_transition(fn):
+    """Подписка на смену online/offline (обработчик должен быть быстрым)."""
+    _listeners.append(fn)
+    return fn
+
+
+def _notify(agent_id, online):
+    for fn in _listeners:
+        try:
+            fn(agent_id, online)
+        except Exception:
+            pass
+
+
+class AgentRecord:
+    """
+    Запись реестра. Слоты вместо dict и обновление на месте: heartbeat меняет
+    только last_seen_ts, строка last_seen форматируется, лишь когда её читают.
+    """
+    __slots__ = ("id", "hostname", "ip", "os", "mac", "last_seen_ts", "online")
+
+    def __init__(self, agent_id, hostname="", ip="", os="", mac="", last_seen_ts=0.0, online=False):
+        self.id = agent_id
+        self.hostname = hostname
+        self.ip = ip
+        self.os = os
+        self.mac = mac
+        self.last_seen_ts = last_seen_ts
+        self.online = online
+
+    @property
+    def last_seen(self):
+        # для отображения
+        return datetime.utcfromtimestamp(self.last_seen_ts).strftime("%Y-%m-%d %H:%M:%S")
+
+    def to_dict(self):
+        return {"id": self.id, "hostname": self.hostname, "ip": self.ip, "os": self.os,
+                "mac": self.mac, "last_seen": self.last_seen, "last_seen_ts": self.last_seen_ts,
+                "online": self.online}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["id"], d.get("hostname", ""), d.get("ip", ""), d.get("os", ""),
+                   d.get("mac", ""), d.get("last_seen_ts", 0.0), d.get("online", False))
+
+
+INDEXED = ("hostname", "ip", "os", "mac")  # поля вторичных индексов (os — по семейству)
+SORTS = ("last_seen", "hostname")
+
+
+def os_family(os_name):
+    """'Windows 10' -> 'windows', 'Linux 6.1.0' -> 'linux'."""
+    return (os_name or "").split(" ", 1)[0].lower()
+
+
+def _index_key(field, value):
+    return os_family(value) if field == "os" else (value or "").lower()
+
+
+def _sort_key(sort):
+    if sort == "hostname":
+        return lambda a: (a.hostname.lower(), a.id)
+    return lambda a: a.last_seen_ts
+
+
+def _page(records, sort, desc, offset, limit):
+    # нужны только первые offset + limit — частичная куча вместо полной сортировки
+    pick = heapq.nlargest if desc else heapq.nsmallest
+    return pick(offset + limit, records, key=_sort_key(sort))[offset:]
+
+
+class MemoryRegistry:
+    """
+    online-статус ведётся инкрементально: heartbeat кладёт в кучу (expires_ts, agent_id),
+    sweep снимает истёкшие записи и переводит агента в offline.
+    Устаревшие записи кучи (агент успел прислать новый heartbeat) просто пропускаются.
+
+    agents упорядочен по последнему heartbeat (запись переносится в конец), поэтому
+    страница «свежие первыми» — это просто обход с конца. Для сортировки по hostname —
+    отсортированный список by_hostname, для поиска — индексы значение -> set(id).
+    """
+    def __init__(self):
+        self.agents = {}
+        self.lock = telemetry.TimedLock("registry")
+        self.expiry_heap = []
+        self.online_ids = set()
+        self.index = {f: {} for f in INDEXED}
+        self.by_hostname = []  # [(hostname.lower(), id)]
+        self.dirty = set()     # изменились с последнего снимка (apps.api.snapshot)
+
+    def sweep(self, now):
+        with self.lock:
+            self._sweep_locked(now)
+
+    def _sweep_locked(self, now):
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires, agent_id = heapq.heappop(self.expiry_heap)
+            a = self.agents.get(agent_id)
+            if not a or not a.online:
+                continue
+            if a.last_seen_ts + ONLINE_WINDOW > now:
+                continue  # есть более свежий heartbeat, его запись ещё в куче
+            a.online = False
+            self.online_ids.discard(agent_id)
+            _notify(agent_id, False)
+
+    def _set_field_locked(self, rec, field, value, is_new):
+        old = getattr(rec, field)
+        if old == value and not is_new:
+            return
+        ix = self.index[field]
+        if not is_new:
+            ids = ix.get(_index_key(field, old))
+            if ids is not None:
+                ids.discard(rec.id)
+                if not ids:
+                    del ix[_index_key(field, old)]
+            if field == "hostname":
+                i = bisect.bisect_left(self.by_hostname, (old.lower(), rec.id))
+                if i < len(self.by_hostname) and self.by_hostname[i] == (old.lower(), rec.id):
+                    del self.by_hostname[i]
+        setattr(rec, field, value)
+        ix.setdefault(_index_key(field, value), set()).add(rec.id)
+        if field == "hostname":
+            bisect.insort(self.by_hostname, (value.lower(), rec.id))
+
+    def update_many(self, entries, now_ts):
+        """entries: [(agent_id, (hostname, ip, os, mac))]."""
+        came_online = []
+        with self.lock:
+            for agent_id, values in entries:
+                rec = self.agents.pop(agent_id, None)
+                is_new = rec is None
+                if is_new:
+                    rec = AgentRecord(agent_id)
+                for field, value in zip(INDEXED, values):
+                    self._set_field_locked(rec, field, value, is_new)
+                rec.last_seen_ts = now_ts
+                if agent_id not in self.online_ids:
+                    came_online.append(agent_id)
+                    self.online_ids.add(agent_id)
+                rec.online = True
+                self.agents[agent_id] = rec
+                self.dirty.add(agent_id)
+                heapq.heappush(self.expiry_heap, (now_ts + ONLINE_WINDOW, agent_id))
+        for agent_id in came_online:
+            _notify(agent_id, True)
+
+    def restore(self, rows):
+        """Тёплый старт: [(id, hostname, ip, os, mac, last_seen_ts)] по возрастанию last_seen_ts."""
+        now = time.time()
+        with self.lock:
+            for agent_id, *values, last_seen_ts in rows:
+                rec = AgentRecord(agent_id)
+                for field, value in zip(INDEXED, values):
+                    self._set_field_locked(rec, field, value, True)
+                rec.last_seen_ts = last_seen_ts
+                if last_seen_ts + ONLINE_WINDOW > now:
+                    rec.online = True
+                    self.online_ids.add(agent_id)
+                    heapq.heappush(self.expiry_heap, (last_seen_ts + ONLINE_WINDOW, agent_id))
+                self.agents[agent_id] = rec
+
+    def write_snapshot(self, conn):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            rows = [(a.id, a.hostname, a.ip, a.os, a.mac, a.last_seen_ts)
+                    for a in map(self.agents.get, dirty) if a is not None]
+        try:
+            conn.executemany(
+                "INSERT INTO agents (id, hostname, ip, os, mac, last_seen_ts) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET hostname = excluded.hostname, ip = excluded.ip, "
+                "os = excluded.os, mac = excluded.mac, last_seen_ts = excluded.last_seen_ts", rows)
+        except Exception:
+            with self.lock:
+                self.dirty |= dirty
+            raise
+
+    def all(self):
+        with self.lock:
+            return list(self.agents.values())
+
+    def get(self, agent_id):
+        with self.lock:
+            return self.agents.get(agent_id)
+
+    def is_online(self, agent_id):
+        with self.lock:
+            self._sweep_locked(time.time())
+            return agent_id in self.online_ids
+
+    def counts(self):
+        with self.lock:
+            self._sweep_locked(time.time())
+            active = len(self.online_ids)
+            return {"active": active, "inactive": len(self.agents) - active}
+
+    def select(self, filters, online, sort, desc, offset, limit):
+        with self.lock:
+            self._sweep_locked(time.time())
+            ids = None
+            # пересечение индексов, начиная с самого маленького (множества индекса не меняем)
+            for ix_ids in sorted((self.index[f].get(_index_key(f, v), set()) for f, v in filters.items()), key=len):
+                ids = ix_ids if ids is None else ids & ix_ids
+
+            if sort == "hostname":
+                order = (self.agents[i] for _, i in (reversed(self.by_hostname) if desc else self.by_hostname))
+            else:
+                order = reversed(self.agents.values()) if desc else iter(self.agents.values())
+
+            if ids is not None:
+                if online is not None:
+                    ids = ids & self.online_ids if online else ids - self.online_ids
+                total, need = len(ids), offset + limit
+                # совпадений много — страница набирается за ~need * N / total шагов готового порядка;
+                # мало — дешевле частичная куча по самим совпадениям
+                if need * len(self.agents) < total * total:
+                    return list(islice((a for a in order if a.id in ids), offset, need)), total
+                return _page((self.agents[i] for i in ids), sort, desc, offset, limit), total
+
+            if online is None:
+                total = len(self.agents)
+            else:
+                total = len(self.online_ids) if online else len(self.agents) - len(self.online_ids)
+                order = (a for a in order if a.online == online)
+            return list(islice(order, offset, offset + limit)), total
+
+
+class RedisRegistry:
+    """
+    agents — hash id -> JSON-запись, agents:seen — zset id -> last_seen_ts.
+    Счётчики active/inactive — ZCOUNT/HLEN, online-флаг вычисляется по zset.
+    События offline каждый воркер получает из своего sweep (по отрезку zset),
+    событие online — воркер, принявший heartbeat.
+    Индексы: множества agents:ix:<поле>:<значение>, сортировка по hostname —
+    lex-zset agents:byname (члены "<hostname>\\0<id>").
+    """
+    def __init__(self, r):
+        self.r = r
+        self.h = backend.key("agents")
+        self.z = backend.key("agents", "seen")
+        self.byname = backend.key("agents", "byname")
+        self.last_cut = time.time() - ONLINE_WINDOW
+
+    def _ix(self, field, value):
+        return backend.key("agents", "ix", field, _index_key(field, value))
+
+    def sweep(self, now):
+        cut = now - ONLINE_WINDOW
+        if cut <= self.last_cut:
+            return
+        for agent_id in self.r.zrangebyscore(self.z, f"({self.last_cut}", cut):
+            _notify(agent_id, False)
+        self.last_cut = cut
+
+    def update_many(self, entries, now_ts):
+        if not entries:
+            return
+        ids = [agent_id for agent_id, _ in entries]
+        p = self.r.pipeline()
+        p.hmget(self.h, ids)
+        for agent_id in ids:
+            p.zscore(self.z, agent_id)
+        res = p.execute()
+        old_raw, prev = res[0], res[1:]
+
+        p = self.r.pipeline()
+        mapping = {}
+        for (agent_id, values), raw in zip(entries, old_raw):
+            old = json.loads(raw) if raw else None
+            rec = dict(zip(INDEXED, values), id=agent_id, last_seen_ts=now_ts)
+            for field in INDEXED:
+                if old is not None and old.get(field) == rec[field]:
+                    continue
+                if old is not None:
+                    p.srem(self._ix(field, old.get(field)), agent_id)
+                p.sadd(self._ix(field, rec[field]), agent_id)
+            if old is None or old.get("hostname") != rec["hostname"]:
+                if old is not None:
+                    p.zrem(self.byname, f"{old.get('hostname', '').lower()}\0{agent_id}")
+                p.zadd(self.byname, {f"{rec['hostname'].lower()}\0{agent_id}": 0})
+            mapping[agent_id] = json.dumps(rec)
+        p.hset(self.h, mapping=mapping)
+        p.zadd(self.z, {agent_id: now_ts for agent_id in ids})
+        p.execute()
+        for agent_id, seen in zip(ids, prev):
+            if seen is None or seen + ONLINE_WINDOW <= now_ts:
+                _notify(agent_id, True)
+
+    def _load(self, ids, now):
+        if not ids:
+            return []
+        p = self.r.pipeline()
+        p.hmget(self.h, ids)
+        for agent_id in ids:
+            p.zscore(self.z, agent_id)
+        res = p.execute()
+        out = []
+        for raw, seen in zip(res[0], res[1:]):
+            if raw:
+                a = AgentRecord.from_dict(json.loads(raw))
+                a.online = seen is not None and seen + ONLINE_WINDOW > now
+                out.append(a)
+        return out
+
+    def all(self):
+        now = time.time()
+        seen = dict(self.r.zrange(self.z, 0, -1, withscores=True))
+        out = []
+        for raw in self.r.hvals(self.h):
+            a = AgentRecord.from_dict(json.loads(raw))
+            s = seen.get(a.id)
+            a.online = s is not None and s + ONLINE_WINDOW > now
+            out.append(a)
+        return out
+
+    def get(self, agent_id):
+        found = self._load([agent_id], time.time())
+        return found[0] if found else None
+
+    def is_online(self, agent_id):
+        seen = self.r.zscore(self.z, agent_id)
+        return seen is not None and seen + ONLINE_WINDOW > time.time()
+
+    def counts(self):
+        p = self.r.pipeline()
+        p.zcount(self.z, f"({time.time() - ONLINE_WINDOW}", "+inf")
+        p.hlen(self.h)
+        active, total = p.execute()
+        return {"active": active, "inactive": total - active}
+
+    def select(self, filters, online, sort, desc, offset, limit):
+        now = time.time()
+        cut = now - ONLINE_WINDOW
+        if filters:
+            ids = list(self.r.sinter([self._ix(f, v) for f, v in filters.items()]))
+            records = [a for a in self._load(ids, now) if online is None or a.online == online]
+            return _page(records, sort, desc, offset, limit), len(records)
+
+        if sort == "hostname" and online is None:
+            rng = self.r.zrevrangebylex if desc else self.r.zrangebylex
+            lo, hi = ("+", "-") if desc else ("-", "+")
+            members = rng(self.byname, lo, hi, start=offset, num=limit)
+            return self._load([m.split("\0", 1)[1] for m in members], now), self.r.hlen(self.h)
+        if sort == "hostname":
+            records = [a for a in self.all() if a.online == online]
+            return _page(records, sort, desc, offset, limit), len(records)
+
+        lo, hi = "-inf", "+inf"
+        if online is True:
+            lo = f"({cut}"
+        elif online is False:
+            hi = cut
+        p = self.r.pipeline()
+        if desc:
+            p.zrevrangebyscore(self.z, hi, lo, start=offset, num=limit)
+        else:
+            p.zrangebyscore(self.z, lo, hi, start=offset, num=limit)
+        p.zcount(self.z, lo, hi)
+        ids, total = p.execute()
+        return self._load(ids, now), total
+
+
+def _memory_registry():
+    # реестр в памяти поднимается из снимка при первом обращении и сохраняется в фоне
+    reg = MemoryRegistry()
+    reg.restore(snapshot.load_agents())
+    snapshot.register(reg.write_snapshot)
+    return reg
+
+
+store = backend.select(_memory_registry, RedisRegistry)
+_sweeper = None
+_sweeper_lock = Lock()
+
+
+def _sweep_loop():
+    while True:
+        time.sleep(SWEEP_INTERVAL_SEC)
+        try:
+            store().sweep(time.time())
+        except Exception:
+            pass
+
+
+def _ensure_sweeper():
+    global _sweeper
+    if _sweeper is None:
+        with _sweeper_lock:
+            if _sweeper is None:
+                _sweeper = Thread(target=_sweep_loop, name="agent-state-sweeper", daemon=True)
+                _sweeper.start()
+
+
+def _values(data, remote_ip):
+    # порядок — как в INDEXED
+    return (str(data.get('hostname') or ''), remote_ip or '',
+            str(data.get('os') or ''), str(data.get('mac') or ''))
 
 def update_agent(agent_id, data, remote_ip):
-    now = datetime.utcnow()
-    with lock:
-        agents_cache[agent_id] = {
-            'id': agent_id,
-            'hostname': data.get('hostname', ''),
-            'ip': remote_ip,
-            'os': data.get('os', ''),
-            'mac': data.get('mac', ''),
-            'last_seen': now.strftime("%Y-%m-%d %H:%M:%S"),  # для отображения
-            'last_seen_ts': time.time(),                     # для логики
-        }
+    _ensure_sweeper()
+    store().update_many([(agent_id, _values(data, remote_ip))], time.time())
+
+def update_agents(items):
+    """Пачка heartbeat'ов (relay): [(agent_id, data, ip)] — один проход под одним lock."""
+    _ensure_sweeper()
+    store().update_many([(agent_id, _values(data, ip)) for agent_id, data, ip in items], time.time())
 
 def get_all_agents():
-    with lock:
-        return list(agents_cache.values())
+    return store().all()
 
 def get_agent(agent_id):
-    with lock:
-        return agents_cache.get(agent_id)
+    return store().get(agent_id)
+
+def is_online(agent_id):
+    return store().is_online(agent_id)
+
+def counts():
+    """{"active", "inactive"} за O(1) (плюс снятие уже истёкших записей)."""
+    return store().counts()
+
+@telemetry.gauge
+def _gauges():
+    c = counts()
+    return [("agents", "Agents in the registry by heartbeat state.", "gauge",
+             [({"state": "online"}, c["active"]), ({"state": "offline"}, c["inactive"])])]
+
+def list_agents(offset=0, limit=50, sort="last_seen", desc=None, online=None, **filters):
+    """
+    Страница реестра: ([AgentRecord], всего подходящих).
+    filters — точное совпадение без учёта регистра по hostname / ip / mac / os (семейство ОС).
+    sort: "last_seen" (по умолчанию свежие первыми) или "hostname" (по умолчанию A→Z).
+    """
+    if sort not in SORTS:
+        sort = "last_seen"
+    if desc is None:
+        desc = sort == "last_seen"
+    filters = {f: v for f, v in filters.items() if f in INDEXED and v}
+    return store().select(filters, online, sort, desc, max(0, offset), max(0, limit))
@@ -0,0 +1,335 @@
+# apps/api/artifacts.py
+# Хранилище собранных файлов: содержимое на диске по SHA-256 (одинаковые файлы
+# от разных агентов хранятся один раз), метаданные — в маленьком SQLite-индексе.
+# Переживает перезапуск и общий для всех воркеров gunicorn.
+import errno
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from apps.api import telemetry
+from apps.api.uploads import DATA_DIR
+
+ARTIFACT_DIR = Path(os.getenv('ARTIFACT_DIR', DATA_DIR / 'artifacts'))
+ARTIFACT_QUOTA_BYTES = int(os.getenv('ARTIFACT_QUOTA_BYTES', 20 * 1024 ** 3))           # на диске всего
+ARTIFACT_AGENT_QUOTA_BYTES = int(os.getenv('ARTIFACT_AGENT_QUOTA_BYTES', 2 * 1024 ** 3))  # на агента
+ARTIFACT_MAX_AGE_SEC = int(os.getenv('ARTIFACT_MAX_AGE_DAYS', 30)) * 86400
+COPY_BUF = 1024 * 1024
+
+BLOB_DIR = ARTIFACT_DIR / 'blobs'
+INDEX_PATH = ARTIFACT_DIR / 'index.sqlite3'
+
+lock = threading.Lock()  # eviction внутри процесса; между процессами — транзакции SQLite
+_ready = False
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size   INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    agent_id    TEXT NOT NULL,
+    name        TEXT NOT NULL,
+    sha256      TEXT NOT NULL REFERENCES blobs(sha256),
+    size        INTEGER NOT NULL,
+    ts          REAL NOT NULL,
+    last_access REAL NOT NULL,
+    UNIQUE (agent_id, name)
+);
+CREATE INDEX IF NOT EXISTS files_ts ON files (ts);
+CREATE INDEX IF NOT EXISTS files_agent_access ON files (agent_id, last_access);
+CREATE INDEX IF NOT EXISTS files_access ON files (last_access);
+CREATE INDEX IF NOT EXISTS files_sha ON files (sha256);
+CREATE INDEX IF NOT EXISTS files_agent_id ON files (agent_id, id);
+
+-- сводка для списка файлов без сканирования таблицы; ведут триггеры
+CREATE TABLE IF NOT EXISTS stats (
+    k       INTEGER PRIMARY KEY CHECK (k = 0),
+    files   INTEGER NOT NULL,
+    bytes   INTEGER NOT NULL,
+    deletes INTEGER NOT NULL  -- растёт при каждом удалении/замене: клиенту пора перечитать список
+);
+CREATE TABLE IF NOT EXISTS agent_usage (
+    agent_id TEXT PRIMARY KEY,
+    files    INTEGER NOT NULL,
+    bytes    INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS files_ins AFTER INSERT ON files BEGIN
+    UPDATE stats SET files = files + 1, bytes = bytes + NEW.size;
+    INSERT INTO agent_usage (agent_id, files, bytes) VALUES (NEW.agent_id, 1, NEW.size)
+        ON CONFLICT (agent_id) DO UPDATE SET files = files + 1, bytes = bytes + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS files_del AFTER DELETE ON files BEGIN
+    UPDATE stats SET files = files - 1, bytes = bytes - OLD.size, deletes = deletes + 1;
+    UPDATE agent_usage SET files = files - 1, bytes = bytes - OLD.size WHERE agent_id = OLD.agent_id;
+    DELETE FROM agent_usage WHERE agent_id = OLD.agent_id AND files <= 0;
+END;
+"""
+
+# индекс, созданный до появления сводки: заполняем её один раз
+_SEED = """
+INSERT INTO agent_usage (agent_id, files, bytes) SELECT agent_id, COUNT(*), SUM(size) FROM files GROUP BY agent_id;
+INSERT INTO stats (k, files, bytes, deletes) SELECT 0, COUNT(*), COALESCE(SUM(size), 0), 0 FROM files;
+"""
+
+
+def _connect():
+    global _ready
+    if not _ready:
+        BLOB_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(INDEX_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if not _ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+        if not conn.execute("SELECT 1 FROM stats").fetchone():
+            for stmt in _SEED.strip().split(";\n"):
+                conn.execute(stmt)
+        conn.execute("COMMIT")
+        _ready = True
+    return conn
+
+
+def blob_path(sha256):
+    return BLOB_DIR / sha256[:2] / sha256
+
+
+def _row(r):
+    return {
+        "id": r["id"], "agent_id": r["agent_id"], "name": r["name"], "sha256": r["sha256"],
+        "size": r["size"], "ts": r["ts"], "path": str(blob_path(r["sha256"])),
+    }
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for buf in iter(lambda: f.read(COPY_BUF), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+
+def _move_into(src_path, dst):
+    """
+    Переносит файл в хранилище. Если UPLOAD_DIR на другой файловой системе (EXDEV) —
+    копия во временный файл рядом с blob и атомарный rename, чтобы не было недописанного blob.
+    """
+    try:
+        os.replace(src_path, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp = dst.with_name(f"{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            shutil.move(src_path, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+
+
+def put(agent_id, name, src_path, sha256=None):
+    """
+    Забирает готовый файл src_path в хранилище (файл перемещается или удаляется,
+    если такой blob уже есть). Одноимённый файл агента заменяется.
+    """
+    sha256 = sha256 or file_sha256(src_path)
+    size = os.path.getsize(src_path)
+    dst = blob_path(sha256)
+    now = time.time()
+
+    with lock:
+        conn = _connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if dst.exists():
+                os.remove(src_path)
+            else:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                _move_into(src_path, dst)
+            conn.execute("INSERT OR IGNORE INTO blobs (sha256, size) VALUES (?, ?)", (sha256, size))
+            replaced = [r[0] for r in conn.execute("SELECT sha256 FROM files WHERE agent_id = ? AND name = ?",
+                                                   (agent_id, name))]
+            conn.execute("DELETE FROM files WHERE agent_id = ? AND name = ?", (agent_id, name))
+            cur = conn.execute(
+                "INSERT INTO files (agent_id, name, sha256, size, ts, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (agent_id, name, sha256, size, now, now))
+            new_id = cur.lastrowid
+            orphans = _evict(conn, agent_id, keep_id=new_id, now=now, touched=replaced)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        _unlink_orphans(orphans)
+
+    return {"id": new_id, "agent_id": agent_id, "name": name, "sha256": sha256,
+            "size": size, "ts": now, "path": str(dst)}
+
+
+def _unlink_orphans(orphans):
+    """
+    Удаляет файлы blob'ов под lock'ом и в транзакции записи — как put(): иначе параллельный put
+    того же sha256 увидит dst.exists(), выбросит свою копию, а blob удалится из-под индекса.
+    """
+    if not orphans:
+        return
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for sha in orphans:
+            # другой воркер мог успеть снова сослаться на этот blob
+            if not conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha,)).fetchone():
+                blob_path(sha).unlink(missing_ok=True)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def _evict(conn, agent_id, keep_id, now, touched=()):
+    """
+    Удаляет старые файлы и укладывается в квоты (LRU по last_access).
+    Только что добавленный файл не трогаем. touched — sha256 уже удалённых файлов (замена).
+    Возвращает sha256 blob'ов без ссылок.
+    """
+    touched = list(touched)
+    stale = conn.execute("SELECT id, sha256 FROM files WHERE ts < ? AND id != ?",
+                         (now - ARTIFACT_MAX_AGE_SEC, keep_id)).fetchall()
+    for r in stale:
+        conn.execute("DELETE FROM files WHERE id = ?", (r["id"],))
+        touched.append(r["sha256"])
+
+    used = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM agent_usage WHERE agent_id = ?", (agent_id,)).fetchone()[0]
+    if used > ARTIFACT_AGENT_QUOTA_BYTES:
+        for r in conn.execute("SELECT id, size, sha256 FROM files WHERE agent_id = ? AND id != ? ORDER BY last_access",
+                              (agent_id, keep_id)).fetchall():
+            if used <= ARTIFACT_AGENT_QUOTA_BYTES:
+                break
+            conn.execute("DELETE FROM files WHERE id = ?", (r["id"],))
+            used -= r["size"]
+            touched.append(r["sha256"])
+
+    orphans = _drop_orphans(conn, touched)
+
+    # глобальная квота считается по blob'ам — это реальные байты на диске
+    used = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+    if used > ARTIFACT_QUOTA_BYTES:
+        for r in conn.execute("SELECT id, sha256 FROM files WHERE id != ? ORDER BY last_access", (keep_id,)).fetchall():
+            if used <= ARTIFACT_QUOTA_BYTES:
+                break
+            conn.execute("DELETE FROM files WHERE id = ?", (r["id"],))
+            for sha, size in _drop_orphans(conn, [r["sha256"]]).items():
+                used -= size
+                orphans[sha] = size
+    return list(orphans)
+
+
+def _drop_orphans(conn, shas):
+    """Удаляет из индекса те blob'ы из shas, на которые больше не ссылается ни один файл. {sha256: size}"""
+    rows = {}
+    for sha in set(shas):
+        if conn.execute("SELECT 1 FROM files WHERE sha256 = ? LIMIT 1", (sha,)).fetchone():
+            continue
+        r = conn.execute("SELECT size FROM blobs WHERE sha256 = ?", (sha,)).fetchone()
+        if r:
+            conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha,))
+            rows[sha] = r[0]
+    return rows
+
+
+def list_files(agent_id=None, before=None, after=None, limit=None):
+    """
+    Метаданные файлов, новые сверху. id растёт с каждой записью (замена файла —
+    это новая строка), поэтому он же служит курсором:
+    before=<id> — следующая страница, after=<id> — только добавленные после него.
+    """
+    where, args = [], []
+    if agent_id:
+        where.append("agent_id = ?")
+        args.append(agent_id)
+    if before is not None:
+        where.append("id < ?")
+        args.append(before)
+    if after is not None:
+        where.append("id > ?")
+        args.append(after)
+    sql = "SELECT * FROM files"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        args.append(limit)
+    conn = _connect()
+    try:
+        return [_row(r) for r in conn.execute(sql, args)]
+    finally:
+        conn.close()
+
+
+def summary(agent_id=None):
+    """Сводка за O(1): {"files", "bytes", "agents", "latest", "deletes"} (latest — id самой новой записи)."""
+    conn = _connect()
+    try:
+        _, files, size, deletes = conn.execute("SELECT * FROM stats").fetchone()
+        if agent_id:
+            r = conn.execute("SELECT files, bytes FROM agent_usage WHERE agent_id = ?", (agent_id,)).fetchone()
+            files, size = (r[0], r[1]) if r else (0, 0)
+            agents = 1 if r else 0
+            latest = conn.execute("SELECT MAX(id) FROM files WHERE agent_id = ?", (agent_id,)).fetchone()[0]
+        else:
+            agents = conn.execute("SELECT COUNT(*) FROM agent_usage").fetchone()[0]
+            latest = conn.execute("SELECT MAX(id) FROM files").fetchone()[0]
+        return {"files": files, "bytes": size, "agents": agents, "latest": latest or 0, "deletes": deletes}
+    finally:
+        conn.close()
+
+
+def _touch(conn, row):
+    conn.execute("UPDATE files SET last_access = ? WHERE id = ?", (time.time(), row["id"]))
+    return _row(row)
+
+
+def get(agent_id, name):
+    conn = _connect()
+    try:
+        r = conn.execute("SELECT * FROM files WHERE agent_id = ? AND name = ?", (agent_id, name)).fetchone()
+        return _touch(conn, r) if r else None
+    finally:
+        conn.close()
+
+
+def latest(agent_id):
+    conn = _connect()
+    try:
+        r = conn.execute("SELECT * FROM files WHERE agent_id = ? ORDER BY ts DESC LIMIT 1", (agent_id,)).fetchone()
+        return _touch(conn, r) if r else None
+    finally:
+        conn.close()
+
+
+def usage():
+    """Занятые байты: logical — сумма по файлам, physical — реально на диске."""
+    conn = _connect()
+    try:
+        count, logical = conn.execute("SELECT files, bytes FROM stats").fetchone()
+        physical = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        return {"files": count, "logical_bytes": logical, "physical_bytes": physical}
+    finally:
+        conn.close()
+
+
+@telemetry.gauge
+def _gauges():
+    u = usage()
+    return [("files", "Stored files.", "gauge", [({}, u["files"])]),
+            ("files_bytes", "Stored file bytes: logical (sum over files) and physical (deduplicated blobs).", "gauge",
+             [({"kind": "logical"}, u["logical_bytes"]), ({"kind": "physical"}, u["physical_bytes"])])]
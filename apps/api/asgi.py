@@ -0,0 +1,264 @@
+# apps/api/asgi.py
+# ASGI-вход для агентского API (asgi.py в корне, uvicorn).
+# Long-poll heartbeat'ы ждут команду на event loop — future на агента, а не поток воркера,
+# поэтому десятки тысяч простаивающих агентов держатся одним процессом.
+# Короткая синхронная работа (реестр, очередь, Redis) идёт в пуле потоков.
+# Остальные запросы (вывод, загрузки, Threat Intel, UI) отдаются тому же Flask-приложению
+# через WSGI-мост a2wsgi.
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.exceptions import HTTPException
+
+from apps.api import backend, command_queue, compression, ratelimit, routes, telemetry
+
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 32))   # пул для синхронной части и для WSGI-моста
+MAX_BODY_BYTES = 16 * 1024 * 1024                   # heartbeat-пачка relay на 1000 агентов — сотни КБ
+FALLBACK_POLL_SEC = 1.0                             # нет подписки на уведомления Redis — опрашиваем очередь
+
+log = logging.getLogger(__name__)
+
+
+class Waiters:
+    """{agent_id: set(future)} — кто ждёт команду агента. Меняется только в потоке event loop."""
+    def __init__(self):
+        self.by_agent = {}
+        self.loop = None
+
+    def add(self, agent_ids):
+        fut = self.loop.create_future()
+        for a in agent_ids:
+            self.by_agent.setdefault(a, set()).add(fut)
+        return fut
+
+    def discard(self, agent_ids, fut):
+        for a in agent_ids:
+            futs = self.by_agent.get(a)
+            if futs is not None:
+                futs.discard(fut)
+                if not futs:
+                    del self.by_agent[a]
+
+    def wake(self, agent_ids):
+        for a in agent_ids:
+            for fut in self.by_agent.get(a, ()):
+                if not fut.done():
+                    fut.set_result(a)
+
+    def wake_threadsafe(self, agent_ids):
+        # вызывается из потоков (enqueue в WSGI-мосте или пуле)
+        if self.loop is not None and self.by_agent:
+            self.loop.call_soon_threadsafe(self.wake, list(agent_ids))
+
+
+class HTTPError(Exception):
+    def __init__(self, message, status=400, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers
+
+
+def _client_ip(scope):
+    client = scope.get("client")
+    return client[0] if client else None
+
+
+async def _send_json(send, status, obj, headers=()):
+    body = json.dumps(obj).encode()
+    hdrs = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+            # как compression.compress_response: какие кодировки тела запроса понимаем
+            (b"accept-encoding", ", ".join(compression.ENCODINGS).encode())]
+    hdrs += [(k.encode(), v.encode()) for k, v in headers]
+    await send({"type": "http.response.start", "status": status, "headers": hdrs})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_json(scope, receive):
+    chunks, size = [], 0
+    while True:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            return None
+        chunks.append(msg.get("body", b""))
+        size += len(chunks[-1])
+        if size > MAX_BODY_BYTES:
+            raise HTTPError("request body is too large", 413)
+        if not msg.get("more_body"):
+            break
+    headers = dict(scope["headers"])
+    try:
+        body = compression.decode_body(b"".join(chunks), headers.get(b"content-encoding", b"").decode("latin-1"))
+    except HTTPException as e:
+        extra = (("Accept-Encoding", ", ".join(compression.ENCODINGS)),) if e.code == 415 else ()
+        raise HTTPError(e.description, e.code, extra)
+    try:
+        return json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPError("invalid JSON body")
+
+
+class AgentAPI:
+    """ASGI-приложение: heartbeat'ы — нативно, всё остальное — wsgi_app через мост."""
+    def __init__(self, wsgi_app):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=ASGI_THREADS)
+        self.pool = ThreadPoolExecutor(ASGI_THREADS, thread_name_prefix="asgi-api")
+        self.waiters = Waiters()
+        self.notify_ok = not backend.is_redis()   # memory:// — enqueue в этом же процессе
+        self.subscriber = None
+        self.native = {("POST", "/api/heartbeat"): ("api.heartbeat", self.heartbeat),
+                       ("POST", "/api/heartbeat/batch"): ("api.heartbeat_batch", self.heartbeat_batch)}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] == "http":
+            self._start()
+            native = self.native.get((scope["method"], scope["path"]))
+            if native is not None:
+                return await self._native(scope, receive, send, *native)
+        return await self.wsgi(scope, receive, send)
+
+    async def _native(self, scope, receive, send, endpoint, handler):
+        # те же метрики, что after_request Flask-приложения
+        status = [None]
+
+        async def send_tracked(msg):
+            if msg["type"] == "http.response.start":
+                status[0] = msg["status"]
+            await send(msg)
+
+        t0 = time.perf_counter()
+        try:
+            await handler(scope, receive, send_tracked)
+        except HTTPError as e:
+            await _send_json(send_tracked, e.status, {"error": str(e)}, e.headers)
+        finally:
+            if status[0] is not None:  # клиент не ушёл, не дождавшись ответа
+                self._run(telemetry.observe, "api", endpoint, scope["method"], status[0],
+                          time.perf_counter() - t0)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                self._start()
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                if self.subscriber is not None:
+                    self.subscriber.cancel()
+                self.pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _start(self):
+        if self.waiters.loop is not None:
+            return
+        self.waiters.loop = asyncio.get_running_loop()
+        command_queue.on_enqueue(self.waiters.wake_threadsafe)
+        if backend.is_redis():
+            # команды ставят и другие процессы (UI под gunicorn) — слушаем канал очереди
+            self.subscriber = asyncio.ensure_future(self._subscribe())
+
+    async def _subscribe(self):
+        import redis.asyncio as aioredis
+        while True:
+            r = None
+            try:
+                r = aioredis.from_url(backend.STATE_BACKEND_URL, decode_responses=True)
+                ps = r.pubsub(ignore_subscribe_messages=True)
+                await ps.subscribe(backend.key("cqn"))
+                self.notify_ok = True
+                async for msg in ps.listen():
+                    if msg["type"] == "message":
+                        self.waiters.wake(msg["data"].split("\n"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("queue notifications unavailable, polling: %s", e)
+            finally:
+                self.notify_ok = False
+                if r is not None:
+                    await r.aclose()
+            await asyncio.sleep(FALLBACK_POLL_SEC)
+
+    def _run(self, fn, *args, **kwargs):
+        return self.waiters.loop.run_in_executor(self.pool, partial(fn, *args, **kwargs))
+
+    async def _admit(self, scope, data):
+        key = str(data.get("id") or data.get("relay") or "") if isinstance(data, dict) else ""
+        wait = await self._run(ratelimit.check, "heartbeat", key or _client_ip(scope))
+        if wait:
+            raise HTTPError("rate limit exceeded", 429, (("Retry-After", ratelimit.retry_after(wait)),))
+
+    async def _checkin(self, fn, data, scope):
+        try:
+            return await self._run(fn, data, _client_ip(scope))
+        except routes.HeartbeatError as e:
+            raise HTTPError(str(e), e.status)
+
+    @staticmethod
+    def _wait(scope, data):
+        raw = data.get("wait") if isinstance(data, dict) else None
+        if raw is None:
+            raw = (parse_qs(scope.get("query_string", b"").decode()).get("wait") or [None])[0]
+        return routes.longpoll_wait(raw)
+
+    async def _longpoll(self, agent_ids, take, wait, receive):
+        """
+        take() сразу; если пусто — ждём уведомления об enqueue для этих агентов и берём снова.
+        Future регистрируется до первого take, так что команда между ними не теряется.
+        Возвращает None, если клиент отключился.
+        """
+        loop = self.waiters.loop
+        fut = self.waiters.add(agent_ids)
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            got = await self._run(take)
+            deadline = loop.time() + wait
+            while not got:
+                left = deadline - loop.time()
+                if left <= 0:
+                    break
+                step = left if self.notify_ok else min(left, FALLBACK_POLL_SEC)
+                await asyncio.wait({fut, disconnect}, timeout=step, return_when=asyncio.FIRST_COMPLETED)
+                if disconnect.done():
+                    return None
+                if fut.done():
+                    self.waiters.discard(agent_ids, fut)
+                    fut = self.waiters.add(agent_ids)
+                got = await self._run(take)
+            return got
+        finally:
+            self.waiters.discard(agent_ids, fut)
+            disconnect.cancel()
+
+    async def heartbeat(self, scope, receive, send):
+        data = await _read_json(scope, receive)
+        if data is None:
+            return
+        await self._admit(scope, data)
+        agent_id, legacy = await self._checkin(routes.checkin, data, scope)
+        batch = await self._longpoll([agent_id], partial(routes.take_commands, agent_id, legacy),
+                                     self._wait(scope, data), receive)
+        if batch is not None:
+            await _send_json(send, 200, routes.heartbeat_reply(batch))
+
+    async def heartbeat_batch(self, scope, receive, send):
+        data = await _read_json(scope, receive)
+        if data is None:
+            return
+        await self._admit(scope, data)
+        ids = await self._checkin(routes.checkin_batch, data, scope)
+        commands = {}
+        if ids:
+            commands = await self._longpoll(ids, partial(command_queue.take_many, ids),
+                                            self._wait(scope, data), receive)
+        if commands is not None:
+            await _send_json(send, 200, {"status": "ok", "commands": commands})
@@ -0,0 +1,60 @@
+# apps/api/backend.py
+# Где живёт общее состояние API (очередь команд, вывод команд, реестр агентов,
+# счётчики метрик, соединения Threat Intel).
+#   STATE_BACKEND_URL=memory://              — словари в процессе (по умолчанию, workers = 1)
+#   STATE_BACKEND_URL=redis://host:6379/1     — общее для всех воркеров и хостов
+# Каждый модуль-хранилище держит две реализации (Memory*/Redis*) с одинаковым
+# интерфейсом и выбирает нужную через select().
+import os
+import threading
+
+STATE_BACKEND_URL = os.getenv('STATE_BACKEND_URL', 'memory://')
+KEY_PREFIX = os.getenv('STATE_KEY_PREFIX', 'vast:')
+
+_client = None
+_lock = threading.Lock()
+
+
+def use(url_or_client):
+    """Переключает backend (до первого обращения к хранилищам) — для тестов и скриптов."""
+    global STATE_BACKEND_URL, _client
+    if isinstance(url_or_client, str):
+        STATE_BACKEND_URL, _client = url_or_client, None
+    else:
+        STATE_BACKEND_URL, _client = 'redis://', url_or_client
+
+
+def is_redis():
+    return STATE_BACKEND_URL.startswith(('redis://', 'rediss://', 'unix://'))
+
+
+def redis_client():
+    global _client
+    with _lock:
+        if _client is None:
+            import redis  # есть в requirements (брокер Celery)
+            _client = redis.Redis.from_url(STATE_BACKEND_URL, decode_responses=True)
+        return _client
+
+
+def key(*parts):
+    return KEY_PREFIX + ":".join(str(p) for p in parts)
+
+
+def select(memory_factory, redis_factory):
+    """Возвращает ленивый геттер хранилища: реализация выбирается при первом вызове."""
+    holder = []
+    lock = threading.Lock()
+
+    def get():
+        if not holder:
+            with lock:
+                if not holder:
+                    holder.append(redis_factory(redis_client()) if is_redis() else memory_factory())
+        return holder[0]
+
+    def reset():
+        holder.clear()
+
+    get.reset = reset
+    return get
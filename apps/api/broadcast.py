@@ -0,0 +1,159 @@
+# apps/api/broadcast.py
+# Рассылка одной команды по группе агентов: селектор -> список агентов -> одна постановка
+# в очереди всех агентов сразу. Вывод каждого агента идёт через обычный dispatch
+# (по command_id), здесь хранится только соответствие агент -> команда и сводный прогресс.
+import fnmatch
+import json
+import os
+import threading
+import time
+import uuid
+
+from apps.api import agent_state, backend, dispatch
+
+BROADCAST_TIMEOUT_SEC = float(os.getenv('BROADCAST_TIMEOUT_SEC', 300))  # после — незавершённые считаются failed
+MAX_TARGETS = int(os.getenv('BROADCAST_MAX_TARGETS', 10000))
+SELECTOR_KEYS = ("all", "os", "hostname", "agents", "online")
+STATES = ("queued", "delivered", "completed", "failed")
+
+
+class SelectorError(ValueError):
+    pass
+
+
+class MemoryBroadcasts:
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def put(self, rec):
+        now = time.time()
+        with self.lock:
+            # результаты команд живут RESULT_TTL_SEC — рассылки дольше не нужны
+            for bid in [b for b, r in self.items.items() if now - r["ts"] > dispatch.RESULT_TTL_SEC]:
+                del self.items[bid]
+            self.items[rec["id"]] = rec
+
+    def get(self, bid):
+        with self.lock:
+            return self.items.get(bid)
+
+
+class RedisBroadcasts:
+    """bc:<id> — JSON записи рассылки, с тем же TTL, что и результаты команд."""
+    def __init__(self, r):
+        self.r = r
+
+    def put(self, rec):
+        self.r.set(backend.key("bc", rec["id"]), json.dumps(rec), ex=int(dispatch.RESULT_TTL_SEC))
+
+    def get(self, bid):
+        raw = self.r.get(backend.key("bc", bid))
+        return json.loads(raw) if raw else None
+
+
+store = backend.select(MemoryBroadcasts, RedisBroadcasts)
+
+
+def resolve(selector):
+    """
+    Селектор -> [agent_id]:
+      {"all": true} | {"os": "windows"} (семейство ОС) | {"hostname": "web-*"} (шаблон fnmatch)
+      | {"agents": [id, ...]}; os и hostname можно сочетать, "online": true/false — доп. фильтр.
+    """
+    if not isinstance(selector, dict) or not selector:
+        raise SelectorError("selector required")
+    unknown = set(selector) - set(SELECTOR_KEYS)
+    if unknown:
+        raise SelectorError(f"unknown selector keys: {', '.join(sorted(unknown))}")
+    online = selector.get("online")
+    if online is not None and not isinstance(online, bool):
+        raise SelectorError("online must be true or false")
+
+    explicit = selector.get("agents")
+    if explicit is not None:
+        if not isinstance(explicit, list) or not all(isinstance(a, str) and a for a in explicit):
+            raise SelectorError("agents must be a list of agent ids")
+        ids = list(dict.fromkeys(explicit))
+        if online is not None:
+            # неизвестные реестру агенты — offline
+            ids = [a for a in ids if agent_state.is_online(a) == online]
+        return ids
+
+    os_name, pattern = selector.get("os"), selector.get("hostname")
+    for k, v in (("os", os_name), ("hostname", pattern)):
+        if v is not None and not isinstance(v, str):
+            raise SelectorError(f"{k} must be a string")
+    if selector.get("all") not in (None, True, False):
+        raise SelectorError("all must be true or false")
+    if not (selector.get("all") is True or os_name or pattern):
+        raise SelectorError("selector must contain all, os, hostname or agents")
+    has_glob = pattern and any(c in pattern for c in "*?[")
+    filters = {"os": os_name}
+    if pattern and not has_glob:
+        filters["hostname"] = pattern  # точное имя — через индекс
+    records, _ = agent_state.list_agents(offset=0, limit=MAX_TARGETS + 1, sort="hostname",
+                                         online=online, **filters)
+    if has_glob:
+        pattern = pattern.lower()
+        records = [a for a in records if fnmatch.fnmatchcase(a.hostname.lower(), pattern)]
+    return [a.id for a in records]
+
+
+def start(selector, command, timeout=None):
+    """Ставит command всем агентам селектора. Возвращает запись рассылки."""
+    ids = resolve(selector)
+    if len(ids) > MAX_TARGETS:
+        raise SelectorError(f"selector matches more than {MAX_TARGETS} agents")
+    timeout = BROADCAST_TIMEOUT_SEC if timeout is None else max(1.0, min(float(timeout), dispatch.RESULT_TTL_SEC))
+    queued, rejected = dispatch.submit_many(ids, command)
+    now = time.time()
+    rec = {"id": uuid.uuid4().hex, "command": command, "selector": selector, "ts": now,
+           "deadline": now + timeout, "targets": queued, "rejected": rejected}
+    store().put(rec)
+    return rec
+
+
+def get(bid):
+    return store().get(bid)
+
+
+def _state(status, expired):
+    if status is None:
+        return "failed"      # результат вытеснен, а агент так и не ответил
+    delivered, done, _ = status
+    if done:
+        return "completed"
+    if expired:
+        return "failed"
+    return "delivered" if delivered else "queued"
+
+
+def progress(rec):
+    """
+    Состояние каждого агента рассылки и счётчики.
+    {"counts": {"total", "queued", "delivered", "completed", "failed", "pending"},
+     "agents": [(agent_id, command_id|None, state, error|None)]}
+    delivered — сколько агентов получили команду (включая завершивших), pending — ещё не завершены.
+    """
+    targets = rec["targets"]
+    statuses = dispatch.status_many(targets.values())
+    expired = time.time() > rec["deadline"]
+    rows = [(a, cid, _state(statuses.get(cid), expired), None) for a, cid in targets.items()]
+    rows += [(a, None, "failed", err) for a, err in rec["rejected"].items()]
+
+    counts = dict.fromkeys(STATES, 0)
+    for a, cid, state, _ in rows:
+        counts[state] += 1
+        # доставленными считаем и тех, кто уже ответил или не уложился в срок после доставки
+        if state != "delivered" and statuses.get(cid, (False,))[0]:
+            counts["delivered"] += 1
+    counts["total"] = len(rows)
+    counts["pending"] = counts["total"] - counts["completed"] - counts["failed"]
+    return {"counts": counts, "agents": rows}
+
+
+def output(cmd_id):
+    """Весь накопленный вывод команды одной строкой."""
+    chunks, _ = dispatch.read(cmd_id)
+    return "\n".join(text for _, text in chunks)
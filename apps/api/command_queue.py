@@ -0,0 +1,353 @@
+# apps/api/command_queue.py
+# Очередь команд для агентов: FIFO на агента, с ID команд и подтверждением доставки.
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from apps.api import backend, snapshot, telemetry
+
+MAX_QUEUED_PER_AGENT = int(os.getenv('MAX_QUEUED_COMMANDS', 100))
+MAX_BATCH = int(os.getenv('MAX_COMMANDS_PER_HEARTBEAT', 20))
+
+
+class QueueFull(Exception):
+    pass
+
+
+_listeners = []  # fn(agent_ids) — в очередь что-то положили (будит async long-poll, apps.api.asgi)
+
+
+def on_enqueue(fn):
+    _listeners.append(fn)
+    return fn
+
+
+def _notify(agent_ids):
+    for fn in _listeners:
+        try:
+            fn(agent_ids)
+        except Exception:
+            pass
+
+
+class MemoryCommandQueue:
+    def __init__(self):
+        # {agent_id: deque([{"id", "command", "ts"}])} — ещё не отданы агенту
+        self.pending = {}
+        # {agent_id: {cmd_id: {...}}} — отданы, но агент их ещё не подтвердил
+        self.inflight = {}
+        # общий lock очереди + будильник для long-poll heartbeat'ов
+        self.cv = threading.Condition()
+        # номер изменения — снимок перезаписывается, только если очередь менялась
+        self.version = 0
+        self.saved_version = 0
+
+    def enqueue(self, agent_id, item):
+        with self.cv:
+            q = self.pending.setdefault(agent_id, deque())
+            if len(q) >= MAX_QUEUED_PER_AGENT:
+                raise QueueFull(f"command queue for {agent_id} is full ({MAX_QUEUED_PER_AGENT})")
+            q.append(item)
+            self.version += 1
+            self.cv.notify_all()
+
+    def enqueue_many(self, items):
+        rejected = {}
+        with self.cv:
+            for agent_id, item in items:
+                q = self.pending.setdefault(agent_id, deque())
+                if len(q) >= MAX_QUEUED_PER_AGENT:
+                    rejected[agent_id] = f"command queue for {agent_id} is full ({MAX_QUEUED_PER_AGENT})"
+                    continue
+                q.append(item)
+            self.version += 1
+            self.cv.notify_all()
+        return rejected
+
+    def ack(self, agent_id, cmd_ids):
+        return self.ack_many({agent_id: cmd_ids})
+
+    def ack_many(self, acks):
+        n = 0
+        with self.cv:
+            for agent_id, cmd_ids in acks.items():
+                bucket = self.inflight.get(agent_id)
+                if not bucket:
+                    continue
+                for cid in cmd_ids:
+                    if bucket.pop(cid, None) is not None:
+                        n += 1
+                if not bucket:
+                    self.inflight.pop(agent_id, None)
+            if n:
+                self.version += 1
+        return n
+
+    def _take_locked(self, agent_id, max_items, track):
+        batch = list((self.inflight.get(agent_id) or {}).values())[:max_items]
+        q = self.pending.get(agent_id)
+        while q and len(batch) < max_items:
+            batch.append(q.popleft())
+        if q is not None and not q:
+            self.pending.pop(agent_id, None)
+
+        if track and batch:
+            bucket = self.inflight.setdefault(agent_id, {})
+            for item in batch:
+                bucket[item["id"]] = item
+        if batch:
+            self.version += 1
+        return batch
+
+    def take(self, agent_id, wait, max_items, track):
+        with self.cv:
+            if wait and not self.inflight.get(agent_id):
+                self.cv.wait_for(lambda: self.pending.get(agent_id), timeout=wait)
+            return self._take_locked(agent_id, max_items, track)
+
+    def take_many(self, agent_ids, wait, max_items):
+        def ready():
+            return any(self.pending.get(a) or self.inflight.get(a) for a in agent_ids)
+
+        with self.cv:
+            if wait:
+                self.cv.wait_for(ready, timeout=wait)
+            out = {}
+            for agent_id in agent_ids:
+                batch = self._take_locked(agent_id, max_items, True)
+                if batch:
+                    out[agent_id] = batch
+            return out
+
+    def count(self, agent_id=None):
+        with self.cv:
+            if agent_id is not None:
+                return len(self.pending.get(agent_id) or ()) + len(self.inflight.get(agent_id) or ())
+            return (sum(len(q) for q in self.pending.values())
+                    + sum(len(b) for b in self.inflight.values()))
+
+    def restore(self, rows):
+        with self.cv:
+            for agent_id, item, inflight in rows:
+                if inflight:
+                    self.inflight.setdefault(agent_id, {})[item["id"]] = item
+                else:
+                    self.pending.setdefault(agent_id, deque()).append(item)
+
+    def write_snapshot(self, conn):
+        # очереди короткие, поэтому при изменении переписываем таблицу целиком
+        with self.cv:
+            if self.version == self.saved_version:
+                return
+            version = self.version
+            rows = []
+            for agent_id, bucket in self.inflight.items():
+                rows += [(i["id"], agent_id, i["command"], i["ts"], 1) for i in bucket.values()]
+            for agent_id, q in self.pending.items():
+                rows += [(i["id"], agent_id, i["command"], i["ts"], 0) for i in q]
+        conn.execute("DELETE FROM commands")
+        conn.executemany("INSERT INTO commands (id, agent_id, command, ts, inflight, pos) VALUES (?, ?, ?, ?, ?, ?)",
+                         [r + (pos,) for pos, r in enumerate(rows)])
+        self.saved_version = version
+
+
+# проверка длины и RPUSH одним скриптом: иначе параллельные воркеры проходят LLEN вместе
+# и переполняют очередь; KEYS[2] — общий счётчик команд для /metrics
+_ENQUEUE_LUA = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+  return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[2])
+redis.call('INCR', KEYS[2])
+return 1
+"""
+
+
+class RedisCommandQueue:
+    """
+    pending — список JSON-команд (BLPOP будит long-poll без отдельного канала),
+    inflight — hash cmd_id -> JSON. Работает одинаково из любого воркера.
+    Канал cqn — ID агентов, которым поставлены команды (для async long-poll в других процессах).
+    cqc — число команд в очередях и inflight: ведут enqueue, ack и take без подтверждения.
+    """
+    def __init__(self, r):
+        self.r = r
+        self.script = r.register_script(_ENQUEUE_LUA)
+        self.count_key = backend.key("cqc")
+        if not r.exists(self.count_key):
+            # очереди от версии без счётчика — пересчитываем один раз
+            n = sum(r.llen(k) for k in r.scan_iter(match=backend.key("cq", "*"), count=1000))
+            n += sum(r.hlen(k) for k in r.scan_iter(match=backend.key("cqi", "*"), count=1000))
+            r.set(self.count_key, n, nx=True)
+
+    def _keys(self, agent_id):
+        return backend.key("cq", agent_id), backend.key("cqi", agent_id)
+
+    def enqueue(self, agent_id, item):
+        qk, _ = self._keys(agent_id)
+        if not self.script(keys=[qk, self.count_key], args=[MAX_QUEUED_PER_AGENT, json.dumps(item)]):
+            raise QueueFull(f"command queue for {agent_id} is full ({MAX_QUEUED_PER_AGENT})")
+        self.r.publish(backend.key("cqn"), agent_id)
+
+    def enqueue_many(self, items):
+        p = self.r.pipeline(transaction=False)
+        for agent_id, item in items:
+            self.script(keys=[self._keys(agent_id)[0], self.count_key],
+                        args=[MAX_QUEUED_PER_AGENT, json.dumps(item)], client=p)
+        rejected = {agent_id: f"command queue for {agent_id} is full ({MAX_QUEUED_PER_AGENT})"
+                    for (agent_id, _), ok in zip(items, p.execute()) if not ok}
+        # одно сообщение на всю рассылку: ID агентов через \n
+        self.r.publish(backend.key("cqn"), "\n".join(a for a, _ in items if a not in rejected))
+        return rejected
+
+    def ack(self, agent_id, cmd_ids):
+        return self.ack_many({agent_id: cmd_ids})
+
+    def ack_many(self, acks):
+        p = self.r.pipeline(transaction=False)
+        for agent_id, cmd_ids in acks.items():
+            if cmd_ids:
+                p.hdel(self._keys(agent_id)[1], *cmd_ids)
+        n = sum(p.execute())
+        if n:
+            self.r.decrby(self.count_key, n)
+        return n
+
+    def take_many(self, agent_ids, wait, max_items):
+        def grab():
+            p = self.r.pipeline(transaction=False)
+            for agent_id in agent_ids:
+                qk, ik = self._keys(agent_id)
+                p.hvals(ik)
+                p.lpop(qk, max_items)
+            res = p.execute()
+            out = {}
+            for i, agent_id in enumerate(agent_ids):
+                batch = [json.loads(v) for v in res[2 * i]][:max_items]
+                batch += [json.loads(v) for v in (res[2 * i + 1] or [])]
+                if batch:
+                    out[agent_id] = batch
+            return out
+
+        out = grab()
+        if not out and wait:
+            got = self.r.blpop([self._keys(a)[0] for a in agent_ids], timeout=max(1, int(wait)))
+            if got:
+                # BLPOP уже забрал одну команду — возвращаем её в начало и берём пачкой
+                self.r.lpush(got[0], got[1])
+                out = grab()
+        p = self.r.pipeline(transaction=False)
+        for agent_id, batch in out.items():
+            # из lpop могло прийти больше max_items вместе с inflight — лишнее вернём в очередь
+            extra = batch[max_items:]
+            del batch[max_items:]
+            if extra:
+                p.lpush(self._keys(agent_id)[0], *[json.dumps(i) for i in reversed(extra)])
+            p.hset(self._keys(agent_id)[1], mapping={i["id"]: json.dumps(i) for i in batch})
+        p.execute()
+        return out
+
+    def take(self, agent_id, wait, max_items, track):
+        qk, ik = self._keys(agent_id)
+        batch = [json.loads(v) for v in self.r.hvals(ik)][:max_items]
+        redelivered = len(batch)
+        if len(batch) < max_items:
+            batch += [json.loads(v) for v in (self.r.lpop(qk, max_items - len(batch)) or [])]
+        if not batch and wait:
+            got = self.r.blpop([qk], timeout=max(1, int(wait)))
+            if got:
+                batch.append(json.loads(got[1]))
+                batch += [json.loads(v) for v in (self.r.lpop(qk, max_items - 1) or [])]
+        if track and batch:
+            self.r.hset(ik, mapping={i["id"]: json.dumps(i) for i in batch})
+        elif len(batch) > redelivered:
+            # без подтверждения команда из очереди считается доставленной сразу
+            self.r.decrby(self.count_key, len(batch) - redelivered)
+        return batch
+
+    def count(self, agent_id=None):
+        if agent_id is not None:
+            qk, ik = self._keys(agent_id)
+            return self.r.llen(qk) + self.r.hlen(ik)
+        return max(0, int(self.r.get(self.count_key) or 0))
+
+
+def _memory_queue():
+    q = MemoryCommandQueue()
+    q.restore(snapshot.load_commands())
+    snapshot.register(q.write_snapshot)
+    return q
+
+
+store = backend.select(_memory_queue, RedisCommandQueue)
+
+
+def new_id():
+    return uuid.uuid4().hex
+
+
+def enqueue(agent_id, command, cmd_id=None):
+    """Ставит команду в очередь агента и возвращает её ID (cmd_id — заранее выданный new_id())."""
+    item = {"id": cmd_id or new_id(), "command": command, "ts": time.time()}
+    store().enqueue(agent_id, item)
+    _notify([agent_id])
+    return item["id"]
+
+
+def enqueue_many(agent_ids, command, cmd_ids=None):
+    """
+    Одна команда многим агентам за один проход (рассылка); cmd_ids — {agent_id: new_id()}, если выданы заранее.
+    Возвращает ({agent_id: cmd_id}, {agent_id: причина отказа}) — полная очередь не прерывает рассылку.
+    """
+    now = time.time()
+    cmd_ids = cmd_ids or {}
+    items = [(a, {"id": cmd_ids.get(a) or new_id(), "command": command, "ts": now}) for a in agent_ids]
+    rejected = store().enqueue_many(items) if items else {}
+    _notify([a for a, _ in items if a not in rejected])
+    return {a: i["id"] for a, i in items if a not in rejected}, rejected
+
+
+def ack(agent_id, cmd_ids):
+    """Агент подтвердил получение команд — убираем их из inflight."""
+    return store().ack(agent_id, list(cmd_ids or []))
+
+
+def ack_many(acks):
+    """{agent_id: [cmd_id, ...]} — подтверждения от relay одним проходом."""
+    return store().ack_many({a: list(ids or []) for a, ids in acks.items()})
+
+
+def take(agent_id, wait=0, max_items=MAX_BATCH, track=True):
+    """
+    Забирает до max_items команд агента, при необходимости ждёт до wait секунд.
+    Неподтверждённые команды из прошлой выдачи отдаются повторно первыми:
+    агент подтверждает выдачу в следующем heartbeat, значит, если подтверждения нет,
+    прошлый ответ до него не дошёл.
+    track=False — для старых агентов без ack: команда считается доставленной сразу.
+    """
+    batch = store().take(agent_id, wait, max_items, track)
+    return [{"id": i["id"], "command": i["command"]} for i in batch]
+
+
+def take_many(agent_ids, wait=0, max_items=MAX_BATCH):
+    """
+    Команды для многих агентов сразу (batch heartbeat от relay).
+    С wait ждёт, пока команда появится хотя бы у одного. Возвращает {agent_id: [...]}.
+    """
+    agent_ids = list(agent_ids)
+    if not agent_ids:
+        return {}
+    out = store().take_many(agent_ids, wait, max_items)
+    return {a: [{"id": i["id"], "command": i["command"]} for i in batch] for a, batch in out.items()}
+
+
+def pending_count(agent_id=None):
+    return store().count(agent_id)
+
+
+@telemetry.gauge
+def _gauges():
+    return [("queued_commands", "Commands queued or awaiting ack.", "gauge", [({}, pending_count())])]
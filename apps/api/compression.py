@@ -0,0 +1,136 @@
+# apps/api/compression.py
+# Сжатие в обе стороны.
+#  * Запросы: тело с Content-Encoding: gzip / zstd распаковывается потоково до Flask,
+#    поэтому request.json / request.stream в роутах работают как обычно.
+#  * Ответы: текст/JSON крупнее COMPRESS_MIN_BYTES сжимается по Accept-Encoding.
+# zstd — только если установлен пакет zstandard.
+import gzip
+import io
+import os
+import zlib
+
+from flask import request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import LimitedStream
+
+try:
+    import zstandard
+except ImportError:  # без zstandard — только gzip
+    zstandard = None
+
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_LEVEL = 6
+MAX_DECODED_BYTES = int(os.getenv('MAX_DECODED_BODY_BYTES', 256 * 1024 * 1024))  # защита от zip-бомб
+COMPRESSIBLE = ("application/json", "text/html", "text/plain", "text/css", "application/javascript")
+
+ENCODINGS = ("zstd", "gzip") if zstandard else ("gzip",)  # в порядке предпочтения
+
+
+class _DecodedStream:
+    """Распакованное тело запроса; ошибки формата и превышение лимита -> 400/413."""
+    def __init__(self, raw):
+        self.raw = raw
+        self.total = 0
+
+    def read(self, n=-1):
+        try:
+            buf = self.raw.read(n)
+        except (OSError, EOFError, zlib.error) as e:
+            raise BadRequest(f"cannot decode request body: {e}")
+        except Exception as e:
+            if zstandard and isinstance(e, zstandard.ZstdError):
+                raise BadRequest(f"cannot decode request body: {e}")
+            raise
+        self.total += len(buf)
+        if self.total > MAX_DECODED_BYTES:
+            raise RequestEntityTooLarge("decoded request body is too large")
+        return buf
+
+
+class RequestDecoder:
+    """WSGI-обёртка: подменяет wsgi.input распаковывающим потоком."""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        enc = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if enc and enc != "identity":
+            if enc not in ENCODINGS:
+                start_response("415 Unsupported Media Type", [
+                    ("Content-Type", "text/plain"), ("Accept-Encoding", ", ".join(ENCODINGS))])
+                return [b"unsupported Content-Encoding"]
+            raw = environ["wsgi.input"]
+            length = environ.get("CONTENT_LENGTH")
+            if length and length.isdigit():
+                raw = LimitedStream(raw, int(length))
+            if enc == "gzip":
+                decoded = gzip.GzipFile(fileobj=raw, mode="rb")
+            else:
+                decoded = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+            environ["wsgi.input"] = _DecodedStream(decoded)
+            environ["wsgi.input_terminated"] = True  # длина заранее неизвестна — читать до конца
+            environ.pop("CONTENT_LENGTH", None)
+            environ.pop("HTTP_CONTENT_ENCODING", None)
+        return self.app(environ, start_response)
+
+
+def decode_body(body, enc):
+    """Распаковка уже прочитанного тела (ASGI-вход). Ошибки — те же HTTPException, что у RequestDecoder."""
+    enc = (enc or "").strip().lower()
+    if not enc or enc == "identity":
+        return body
+    if enc not in ENCODINGS:
+        raise UnsupportedMediaType("unsupported Content-Encoding")
+    raw = io.BytesIO(body)
+    if enc == "gzip":
+        decoded = gzip.GzipFile(fileobj=raw, mode="rb")
+    else:
+        decoded = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+    stream = _DecodedStream(decoded)
+    # кусками — чтобы лимит MAX_DECODED_BYTES срабатывал до распаковки всей бомбы
+    return b"".join(iter(lambda: stream.read(64 * 1024), b""))
+
+
+def _negotiate():
+    accepted = request.accept_encodings
+    for enc in ENCODINGS:
+        if accepted[enc]:
+            return enc
+    return None
+
+
+def compress_response(resp):
+    # ингест-эндпоинтам сообщаем, какие кодировки тела запроса понимаем (RFC 7694)
+    if request.method == "POST":
+        resp.headers["Accept-Encoding"] = ", ".join(ENCODINGS)
+
+    if (resp.status_code < 200 or resp.status_code >= 300 or resp.status_code == 204
+            or resp.direct_passthrough or resp.is_streamed
+            or "Content-Encoding" in resp.headers
+            or resp.mimetype not in COMPRESSIBLE):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    enc = _negotiate()
+    if not enc:
+        return resp
+    body = resp.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return resp
+
+    if enc == "zstd":
+        body = zstandard.ZstdCompressor(level=3).compress(body)
+    else:
+        body = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+    resp.set_data(body)
+    resp.headers["Content-Encoding"] = enc
+    # представление другое — сильный ETag становится слабым (как делает nginx)
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+def init_app(app):
+    app.wsgi_app = RequestDecoder(app.wsgi_app)
+    # регистрируется первым, значит выполняется последним из after_request (после Minify)
+    app.after_request(compress_response)
@@ -0,0 +1,333 @@
+# apps/api/dispatch.py
+# Внутренний API для админских роутов: поставить команду агенту и дождаться её вывода
+# без HTTP-запросов к самому себе и без фиксированных sleep.
+# Вывод хранится по командам как поток чанков с номерами (seq) — его же отдаёт SSE.
+import heapq
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from apps.api import backend, command_queue
+
+COMMAND_WAIT_SEC = float(os.getenv('COMMAND_WAIT_SEC', 15))
+RESULT_TTL_SEC = 600            # сколько держим результаты команд
+MAX_CHUNKS_PER_COMMAND = 5000   # старые чанки длинных задач вытесняются, seq не сбрасывается
+
+
+class MemoryResults:
+    def __init__(self):
+        # {cmd_id: {"agent_id", "chunks": deque([(seq, str)]), "seq": int, "done": bool,
+        #           "delivered": bool, "ts": float}}
+        self.results = {}
+        # агенты без command_id в output: {agent_id: [cmd_id, ...]} в порядке отправки
+        self.open_by_agent = {}
+        # [(ts, cmd_id)] — кандидаты на вытеснение по TTL; ts записи мог с тех пор обновиться
+        self.expiry = []
+        self.cv = threading.Condition()
+
+    @staticmethod
+    def _new(agent_id, now):
+        return {"agent_id": agent_id, "chunks": deque(maxlen=MAX_CHUNKS_PER_COMMAND),
+                "seq": 0, "done": False, "delivered": False, "ts": now}
+
+    def _close_locked(self, agent_id, cmd_id):
+        open_ids = self.open_by_agent.get(agent_id) or []
+        if cmd_id in open_ids:
+            open_ids.remove(cmd_id)
+        if not open_ids:
+            self.open_by_agent.pop(agent_id, None)
+
+    def _evict_locked(self, now):
+        # старые результаты (и команды, на которые агент так и не ответил) — по куче, без обхода всех
+        while self.expiry and now - self.expiry[0][0] > RESULT_TTL_SEC:
+            _, cid = heapq.heappop(self.expiry)
+            r = self.results.get(cid)
+            if r is None:
+                continue
+            if now - r["ts"] > RESULT_TTL_SEC:
+                self._close_locked(self.results.pop(cid)["agent_id"], cid)
+            else:
+                heapq.heappush(self.expiry, (r["ts"], cid))
+
+    def _add_locked(self, agent_id, cmd_id, now):
+        r = self.results[cmd_id] = self._new(agent_id, now)
+        heapq.heappush(self.expiry, (now, cmd_id))
+        return r
+
+    def create_many(self, pairs):
+        now = time.time()
+        with self.cv:
+            self._evict_locked(now)
+            for agent_id, cmd_id in pairs:
+                self._add_locked(agent_id, cmd_id, now)
+                self.open_by_agent.setdefault(agent_id, []).append(cmd_id)
+
+    def discard(self, pairs):
+        """Команды, которые не удалось поставить в очередь."""
+        with self.cv:
+            for agent_id, cmd_id in pairs:
+                if self.results.pop(cmd_id, None) is not None:
+                    self._close_locked(agent_id, cmd_id)
+
+    def mark_delivered(self, cmd_ids):
+        with self.cv:
+            for cid in cmd_ids:
+                r = self.results.get(cid)
+                if r is not None:
+                    r["delivered"] = True
+
+    def status_many(self, cmd_ids):
+        with self.cv:
+            out = {}
+            for cid in cmd_ids:
+                r = self.results.get(cid)
+                if r is not None:
+                    out[cid] = (r["delivered"], r["done"], r["seq"])
+            return out
+
+    def oldest_open(self, agent_id):
+        with self.cv:
+            open_ids = self.open_by_agent.get(agent_id)
+            return open_ids[0] if open_ids else None
+
+    def append(self, agent_id, cmd_id, output, done):
+        with self.cv:
+            r = self.results.get(cmd_id)
+            if r is None:
+                # команда поставлена в обход submit() или результат уже вытеснен
+                r = self._add_locked(agent_id, cmd_id, time.time())
+            elif r["agent_id"] != agent_id:
+                return False
+            r["delivered"] = True
+            if output:
+                r["seq"] += 1
+                r["chunks"].append((r["seq"], output))
+            r["ts"] = time.time()
+            if done and not r["done"]:
+                r["done"] = True
+                self._close_locked(agent_id, cmd_id)
+            self.cv.notify_all()
+            return True
+
+    def owner(self, cmd_id):
+        with self.cv:
+            r = self.results.get(cmd_id)
+            return r["agent_id"] if r else None
+
+    def read(self, cmd_id, after, wait):
+        def ready():
+            r = self.results.get(cmd_id)
+            return r is None or r["done"] or r["seq"] > after
+
+        with self.cv:
+            if wait:
+                self.cv.wait_for(ready, timeout=wait)
+            r = self.results.get(cmd_id)
+            if r is None:
+                return None
+            return [c for c in r["chunks"] if c[0] > after], r["done"], r["seq"]
+
+
+class RedisResults:
+    """
+    cr:<cmd>  — hash {agent_id, seq, done, delivered}, crc:<cmd> — список JSON [seq, text],
+    cro:<agent> — открытые команды для старых агентов. Ожидание — pub/sub канал crn:<cmd>.
+    """
+    def __init__(self, r):
+        self.r = r
+
+    def create_many(self, pairs):
+        p = self.r.pipeline()
+        for agent_id, cmd_id in pairs:
+            p.hset(backend.key("cr", cmd_id), mapping={"agent_id": agent_id, "seq": 0, "done": 0, "delivered": 0})
+            p.expire(backend.key("cr", cmd_id), RESULT_TTL_SEC)
+            p.rpush(backend.key("cro", agent_id), cmd_id)
+            p.expire(backend.key("cro", agent_id), RESULT_TTL_SEC)
+        p.execute()
+
+    def discard(self, pairs):
+        p = self.r.pipeline()
+        for agent_id, cmd_id in pairs:
+            p.delete(backend.key("cr", cmd_id))
+            p.lrem(backend.key("cro", agent_id), 0, cmd_id)
+        p.execute()
+
+    def mark_delivered(self, cmd_ids):
+        p = self.r.pipeline(transaction=False)
+        for cid in cmd_ids:
+            p.exists(backend.key("cr", cid))
+        known = [cid for cid, n in zip(cmd_ids, p.execute()) if n]
+        p = self.r.pipeline(transaction=False)
+        for cid in known:
+            p.hset(backend.key("cr", cid), "delivered", 1)
+        p.execute()
+
+    def status_many(self, cmd_ids):
+        p = self.r.pipeline(transaction=False)
+        for cid in cmd_ids:
+            p.hmget(backend.key("cr", cid), "agent_id", "delivered", "done", "seq")
+        out = {}
+        for cid, (owner, delivered, done, seq) in zip(cmd_ids, p.execute()):
+            if owner is not None:
+                out[cid] = (delivered == "1", done == "1", int(seq or 0))
+        return out
+
+    def oldest_open(self, agent_id):
+        return self.r.lindex(backend.key("cro", agent_id), 0)
+
+    def append(self, agent_id, cmd_id, output, done):
+        hk, ck = backend.key("cr", cmd_id), backend.key("crc", cmd_id)
+        owner = self.r.hget(hk, "agent_id")
+        if owner is not None and owner != agent_id:
+            return False
+        p = self.r.pipeline()
+        p.hsetnx(hk, "agent_id", agent_id)
+        p.hset(hk, "delivered", 1)
+        if output:
+            p.hincrby(hk, "seq", 1)
+        if done:
+            p.hset(hk, "done", 1)
+            p.lrem(backend.key("cro", agent_id), 0, cmd_id)
+        res = p.execute()
+        if output:
+            seq = res[2]
+            p = self.r.pipeline()
+            p.rpush(ck, json.dumps([seq, output]))
+            p.ltrim(ck, -MAX_CHUNKS_PER_COMMAND, -1)
+            p.execute()
+        p = self.r.pipeline()
+        p.expire(hk, RESULT_TTL_SEC)
+        p.expire(ck, RESULT_TTL_SEC)
+        p.publish(backend.key("crn", cmd_id), 1)
+        p.execute()
+        return True
+
+    def owner(self, cmd_id):
+        return self.r.hget(backend.key("cr", cmd_id), "agent_id")
+
+    def _snapshot(self, cmd_id, after):
+        meta = self.r.hgetall(backend.key("cr", cmd_id))
+        if not meta:
+            return None
+        chunks = [tuple(json.loads(c)) for c in self.r.lrange(backend.key("crc", cmd_id), 0, -1)]
+        return [c for c in chunks if c[0] > after], meta.get("done") == "1", int(meta.get("seq") or 0)
+
+    def read(self, cmd_id, after, wait):
+        snap = self._snapshot(cmd_id, after)
+        if snap is None or snap[0] or snap[1] or not wait:
+            return snap
+        ps = self.r.pubsub(ignore_subscribe_messages=True)
+        try:
+            ps.subscribe(backend.key("crn", cmd_id))
+            deadline = time.time() + wait
+            while True:
+                # повторная проверка после подписки — чтобы не пропустить событие между ними
+                snap = self._snapshot(cmd_id, after)
+                left = deadline - time.time()
+                if snap is None or snap[0] or snap[1] or left <= 0:
+                    return snap
+                ps.get_message(timeout=left)
+        finally:
+            ps.close()
+
+
+store = backend.select(MemoryResults, RedisResults)
+
+
+def submit(agent_id, command):
+    """
+    Регистрирует ожидание результата и ставит команду в очередь. Возвращает cmd_id.
+    Регистрация — до постановки: enqueue будит агента, и его вывод может прийти раньше, чем вернётся submit.
+    """
+    cmd_id = command_queue.new_id()
+    store().create_many([(agent_id, cmd_id)])
+    try:
+        command_queue.enqueue(agent_id, command, cmd_id)
+    except command_queue.QueueFull:
+        store().discard([(agent_id, cmd_id)])
+        raise
+    return cmd_id
+
+
+def submit_many(agent_ids, command):
+    """
+    Одна команда многим агентам (рассылка). Возвращает ({agent_id: cmd_id}, {agent_id: ошибка}):
+    агенты с переполненной очередью не получают команду, остальные — получают.
+    Результаты регистрируются до постановки (см. submit), отказы потом снимаются.
+    """
+    ids = {a: command_queue.new_id() for a in agent_ids}
+    if not ids:
+        return {}, {}
+    store().create_many(list(ids.items()))
+    queued, rejected = command_queue.enqueue_many(list(ids), command, ids)
+    if rejected:
+        store().discard([(a, ids[a]) for a in rejected])
+    return queued, rejected
+
+
+def mark_delivered(cmd_ids):
+    """Агент подтвердил получение (ack в heartbeat)."""
+    cmd_ids = list(cmd_ids or [])
+    if cmd_ids:
+        store().mark_delivered(cmd_ids)
+
+
+def status_many(cmd_ids):
+    """{cmd_id: (delivered, done, seq)}; вытесненных/неизвестных команд в ответе нет."""
+    cmd_ids = list(cmd_ids)
+    return store().status_many(cmd_ids) if cmd_ids else {}
+
+
+def record_output(agent_id, cmd_id, output, done=False):
+    """
+    Вызывается из /api/agent/<id>/output. Если агент старый и не прислал cmd_id —
+    привязываем вывод к самой старой незавершённой команде агента и считаем её выполненной.
+    Возвращает cmd_id, к которому привязан вывод (или None).
+    """
+    if not cmd_id:
+        cmd_id, done = store().oldest_open(agent_id), True
+        if not cmd_id:
+            return None
+    return cmd_id if store().append(agent_id, cmd_id, output, done) else None
+
+
+def exists(agent_id, cmd_id):
+    return store().owner(cmd_id) == agent_id
+
+
+def read(cmd_id, after=0, wait=0):
+    """
+    Чанки с seq > after. Если новых нет и команда не завершена — ждёт до wait секунд.
+    Возвращает (chunks [(seq, text)], done).
+    """
+    snap = store().read(cmd_id, after, wait)
+    if snap is None:
+        return [], True
+    return snap[0], snap[1]
+
+
+def wait(cmd_id, timeout=COMMAND_WAIT_SEC):
+    """
+    Ждёт завершения команды. Возвращает {"id", "output", "done", "seq"} —
+    вывод, накопленный к этому моменту, и номер последнего чанка.
+    """
+    deadline = time.time() + timeout
+    seq, chunks, done = 0, [], False
+    while True:
+        snap = store().read(cmd_id, seq, max(0.0, deadline - time.time()))
+        if snap is None:
+            break
+        new, done, _ = snap
+        chunks += new
+        if new:
+            seq = new[-1][0]
+        if done or time.time() >= deadline:
+            break
+    return {"id": cmd_id, "output": "\n".join(text for _, text in chunks), "done": done, "seq": seq}
+
+
+def run(agent_id, command, timeout=COMMAND_WAIT_SEC):
+    """submit + wait."""
+    return wait(submit(agent_id, command), timeout)
@@ -0,0 +1,137 @@
+# apps/api/http_cache.py
+# Кэш ответов для эндпоинтов, которые дашборд опрашивает по таймеру.
+# Пока ответ свежий (TTL), все вкладки получают одну и ту же готовую копию;
+# после TTL ответ переиспользуется без пересчёта, если не изменились его «поколения» —
+# счётчики, которые увеличиваются при записи соответствующих данных (bump()).
+# Каждый ответ несёт сильный ETag: неизменившийся опрос получает 304 без тела.
+import hashlib
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import request, make_response
+
+from apps.api import backend
+
+CACHE_TTL_SEC = float(os.getenv('API_CACHE_TTL_SEC', 2))
+CACHE_MAX_AGE_SEC = float(os.getenv('API_CACHE_MAX_AGE_SEC', 60))  # потолок для ответов с поколениями
+MAX_ENTRIES = 256
+
+
+class MemoryGenerations:
+    def __init__(self):
+        self.gens = {}
+        self.lock = threading.Lock()
+
+    def bump(self, names):
+        with self.lock:
+            for n in names:
+                self.gens[n] = self.gens.get(n, 0) + 1
+
+    def get(self, names):
+        with self.lock:
+            return tuple(self.gens.get(n, 0) for n in names)
+
+
+class RedisGenerations:
+    """Поколения общие для всех воркеров: запись в одном сбрасывает кэш во всех."""
+    def __init__(self, r):
+        self.r = r
+
+    def bump(self, names):
+        p = self.r.pipeline(transaction=False)
+        for n in names:
+            p.incr(backend.key("gen", n))
+        p.execute()
+
+    def get(self, names):
+        return tuple(int(v or 0) for v in self.r.mget([backend.key("gen", n) for n in names]))
+
+
+generations = backend.select(MemoryGenerations, RedisGenerations)
+
+_entries = {}   # (path, query) -> {"body", "status", "mimetype", "etag", "gens", "created", "fresh_until"}
+_key_locks = {}
+lock = threading.Lock()
+
+
+def bump(*names):
+    """Данные изменились — ответы, зависящие от names, будут пересчитаны."""
+    generations().bump(names)
+
+
+def clear():
+    with lock:
+        _entries.clear()
+
+
+def _etag(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def _usable(entry, gens, now, ttl):
+    if now < entry["fresh_until"]:
+        return True
+    # TTL вышел, но данные не менялись — продлеваем без пересчёта
+    if gens is not None and entry["gens"] == gens and now - entry["created"] < CACHE_MAX_AGE_SEC:
+        entry["fresh_until"] = now + ttl
+        return True
+    return False
+
+
+def _respond(entry):
+    # слабое сравнение: сжатый ответ уходит с W/"..." (apps.api.compression)
+    if request.if_none_match.contains_weak(entry["etag"]):
+        resp = make_response("", 304)
+    else:
+        resp = make_response(entry["body"], entry["status"])
+        resp.mimetype = entry["mimetype"]
+    resp.set_etag(entry["etag"])
+    resp.headers["Cache-Control"] = "no-cache"  # браузер всегда переспрашивает, но с If-None-Match
+    return resp
+
+
+def cached(ttl=None, depends=()):
+    """
+    Декоратор GET-эндпоинта. ttl — сколько секунд отдавать готовый ответ (по умолчанию
+    API_CACHE_TTL_SEC); depends — имена поколений, от которых зависит ответ.
+    Без depends ответ живёт только ttl (данные зависят от времени: окна метрик и т.п.).
+    Кэшируются только ответы 200.
+    """
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            life = CACHE_TTL_SEC if ttl is None else ttl
+            key = (request.path, request.query_string)
+            gens = generations().get(depends) if depends else None
+
+            entry = _entries.get(key)
+            if entry is not None and _usable(entry, gens, time.monotonic(), life):
+                return _respond(entry)
+
+            # один пересчёт на ключ: остальные запросы ждут и берут его результат
+            with lock:
+                key_lock = _key_locks.setdefault(key, threading.Lock())
+            with key_lock:
+                entry = _entries.get(key)
+                if entry is not None and _usable(entry, gens, time.monotonic(), life):
+                    return _respond(entry)
+
+                resp = make_response(fn(*args, **kwargs))
+                if resp.status_code != 200 or resp.is_streamed:
+                    return resp
+                body = resp.get_data()
+                now = time.monotonic()
+                entry = {"body": body, "status": 200, "mimetype": resp.mimetype, "etag": _etag(body),
+                         "gens": gens, "created": now, "fresh_until": now + life}
+                with lock:
+                    _entries.pop(key, None)
+                    _entries[key] = entry
+                    while len(_entries) > MAX_ENTRIES:
+                        old = next(iter(_entries))
+                        del _entries[old]
+                        _key_locks.pop(old, None)
+            return _respond(entry)
+        return wrapper
+    return deco
@@ -0,0 +1,186 @@
+# apps/api/metrics.py
+# Счётчики событий для графиков дашборда: кольцевые буферы фиксированного размера
+# на секунды, минуты, часы и дни. Инкремент — O(1), выборка — O(число бакетов),
+# память не зависит от размера флота.
+import time
+from array import array
+from datetime import datetime
+
+from apps.api import backend
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def utc_ts(dt):
+    """naive UTC datetime -> unix ts (datetime.timestamp() считал бы его локальным временем)."""
+    return (dt - EPOCH).total_seconds()
+
+
+class _Ring:
+    """Кольцо из n бакетов шириной width секунд. stamps хранит номер бакета, чтобы отличать устаревшие слоты."""
+    __slots__ = ("width", "n", "counts", "stamps", "head")
+
+    def __init__(self, width, n):
+        self.width = width
+        self.n = n
+        self.counts = array('q', [0]) * n
+        self.stamps = array('q', [-1]) * n
+        self.head = -1  # самый свежий номер бакета
+
+    def add(self, idx, k):
+        slot = idx % self.n
+        if self.stamps[slot] != idx:
+            self.stamps[slot] = idx
+            self.counts[slot] = 0
+        self.counts[slot] += k
+        if idx > self.head:
+            self.head = idx
+
+    def get(self, idx):
+        slot = idx % self.n
+        return self.counts[slot] if self.stamps[slot] == idx else 0
+
+    def holds(self, idx):
+        return idx > self.head - self.n
+
+
+class RollingCounter:
+    """
+    Каждое событие увеличивает по одному бакету на каждом уровне (сек/мин/час/день),
+    поэтому окна 30 мин / 24 ч / 7 дней считаются точно без хранения самих событий.
+    Потокобезопасность — на вызывающей стороне (metrics_lock в apps.api.routes).
+    Для нескольких воркеров — RedisCounter, создаётся через counter(name).
+    """
+    LEVELS = ((1, 120), (60, 26 * 60), (3600, 8 * 24), (86400, 35))
+
+    def __init__(self):
+        self.rings = [_Ring(w, n) for w, n in self.LEVELS]
+        self.total_count = 0
+
+    def add(self, ts=None, k=1):
+        t = int(time.time() if ts is None else ts)
+        for r in self.rings:
+            r.add(t // r.width, k)
+        self.total_count += k
+
+    def series(self, start, step, n):
+        """n бакетов по step секунд начиная с start (unix ts, выровненный по step)."""
+        start, step = int(start), int(step)
+        ring = self.rings[0]
+        for r in self.rings:
+            if step % r.width == 0 and start % r.width == 0:
+                ring = r
+        per = step // ring.width
+        idx = start // ring.width
+        out = []
+        for _ in range(n):
+            s = 0
+            for _ in range(per):
+                s += ring.get(idx)
+                idx += 1
+            out.append(s)
+        return out
+
+    def _tiles(self, start, end, holds):
+        """
+        Покрывает [start, end) самыми крупными бакетами, которые в него влезают.
+        Возвращает [(номер уровня, номер бакета)].
+        """
+        t, end = int(start), int(end)
+        tiles = []
+        while t < end:
+            for lvl in range(len(self.LEVELS) - 1, -1, -1):
+                width = self.LEVELS[lvl][0]
+                idx = t // width
+                if t % width == 0 and t + width <= end and holds(lvl, idx):
+                    tiles.append((lvl, idx))
+                    t += width
+                    break
+            else:
+                # данных такой точности уже нет — переходим к следующей минуте
+                t = (t // 60 + 1) * 60
+        return tiles
+
+    def total(self, start, end):
+        """
+        Сумма событий в [start, end). start стоит выравнивать хотя бы по минуте —
+        посекундные данные хранятся только последние 2 минуты.
+        """
+        tiles = self._tiles(start, end, lambda lvl, idx: self.rings[lvl].holds(idx))
+        return sum(self.rings[lvl].get(idx) for lvl, idx in tiles)
+
+
+class RedisCounter(RollingCounter):
+    """
+    Те же уровни, но бакеты — ключи m:<name>:<width>:<idx> в Redis с TTL на длину кольца.
+    Все воркеры пишут в одни счётчики; выборка — один MGET.
+    """
+    def __init__(self, r, name):
+        self.r = r
+        self.name = name
+
+    def _key(self, lvl, idx):
+        return backend.key("m", self.name, self.LEVELS[lvl][0], idx)
+
+    def add(self, ts=None, k=1):
+        t = int(time.time() if ts is None else ts)
+        p = self.r.pipeline(transaction=False)
+        for lvl, (width, n) in enumerate(self.LEVELS):
+            key = self._key(lvl, t // width)
+            p.incrby(key, k)
+            p.expire(key, width * n)
+        p.incrby(backend.key("m", self.name, "total"), k)
+        p.execute()
+
+    @property
+    def total_count(self):
+        return int(self.r.get(backend.key("m", self.name, "total")) or 0)
+
+    def _mget(self, tiles):
+        if not tiles:
+            return []
+        return [int(v or 0) for v in self.r.mget([self._key(lvl, idx) for lvl, idx in tiles])]
+
+    def series(self, start, step, n):
+        start, step = int(start), int(step)
+        lvl = 0
+        for i, (width, _) in enumerate(self.LEVELS):
+            if step % width == 0 and start % width == 0:
+                lvl = i
+        width = self.LEVELS[lvl][0]
+        per = step // width
+        first = start // width
+        values = self._mget([(lvl, first + i) for i in range(n * per)])
+        return [sum(values[i * per:(i + 1) * per]) for i in range(n)]
+
+    def total(self, start, end):
+        now = int(time.time())
+
+        def holds(lvl, idx):
+            width, n = self.LEVELS[lvl]
+            return idx > now // width - n
+
+        return sum(self._mget(self._tiles(start, end, holds)))
+
+
+class _SelectedCounter:
+    """Счётчик, реализация которого (память/Redis) выбирается при первом обращении."""
+    def __init__(self, name):
+        self._get = backend.select(RollingCounter, lambda r: RedisCounter(r, name))
+
+    def add(self, ts=None, k=1):
+        self._get().add(ts, k)
+
+    def series(self, start, step, n):
+        return self._get().series(start, step, n)
+
+    def total(self, start, end):
+        return self._get().total(start, end)
+
+    @property
+    def total_count(self):
+        return self._get().total_count
+
+
+def counter(name):
+    return _SelectedCounter(name)
@@ -0,0 +1,206 @@
+# apps/api/outputs.py
+# История вывода агентов: на каждого агента — кольцо записей с возрастающим seq.
+# Читатели ходят по курсору (?after=<seq>), ничего не забирают из общей структуры,
+# поэтому несколько аналитиков на одном агенте не мешают друг другу.
+# Размер истории ограничен; крупные записи лежат на диске, в памяти — только путь.
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from itertools import islice
+from pathlib import Path
+
+from apps.api import backend
+from apps.api.uploads import DATA_DIR
+
+OUTPUT_DIR = Path(os.getenv('OUTPUT_DIR', DATA_DIR / 'outputs'))
+OUTPUT_HISTORY_ENTRIES = int(os.getenv('OUTPUT_HISTORY_ENTRIES', 1000))        # записей на агента
+OUTPUT_HISTORY_BYTES = int(os.getenv('OUTPUT_HISTORY_BYTES', 1024 * 1024))    # текста в памяти на агента
+OUTPUT_SPILL_BYTES = int(os.getenv('OUTPUT_SPILL_BYTES', 64 * 1024))          # крупнее — на диск
+OUTPUT_SPILL_AGENT_BYTES = int(os.getenv('OUTPUT_SPILL_AGENT_BYTES', 16 * 1024 * 1024))  # на диске на агента
+SPILL_MAX_AGE_SEC = 7 * 86400
+MAX_READ = 500
+
+
+def _spill(agent_id, text):
+    """Пишет крупный вывод в файл (до взятия lock'а). Возвращает (путь, байт на диске)."""
+    # каталог — хэш id: id приходит от агента и может быть "..", "a/b" и т.п.
+    d = OUTPUT_DIR / hashlib.sha256(agent_id.encode()).hexdigest()[:32]
+    d.mkdir(parents=True, exist_ok=True)
+    path = d / f"{uuid.uuid4().hex}.txt"
+    data = text.encode("utf-8")
+    path.write_bytes(data)
+    return str(path), len(data)
+
+
+def _spilled_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _unlink(paths):
+    for p in paths:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def _load(entry):
+    seq, ts, cmd_id, text, path = entry
+    if path:
+        try:
+            text = Path(path).read_text(encoding="utf-8")
+        except OSError:
+            text = None  # файл уже вытеснен
+    return {"seq": seq, "ts": ts, "command_id": cmd_id, "output": text}
+
+
+def _cleanup_spill_dir():
+    # файлы, оставшиеся от прошлых запусков
+    now = time.time()
+    for p in OUTPUT_DIR.glob("*/*.txt"):
+        try:
+            if now - p.stat().st_mtime > SPILL_MAX_AGE_SEC:
+                p.unlink()
+        except OSError:
+            pass
+
+
+class MemoryOutputs:
+    """
+    {agent_id: {"seq", "entries": deque([(seq, ts, cmd_id, text|None, path|None)]), "bytes", "spilled"}}.
+    seq внутри агента идут подряд, поэтому запись с seq > after находится арифметикой, без поиска.
+    bytes — текст в памяти, spilled — файлы на диске; оба ограничены, вытесняются старые записи.
+    """
+    def __init__(self):
+        self.agents = {}
+        self.lock = threading.Lock()
+
+    def append(self, agent_id, cmd_id, text, path, spilled=0):
+        now = time.time()
+        size = 0 if path else len(text)
+        evicted = []
+        with self.lock:
+            h = self.agents.get(agent_id)
+            if h is None:
+                h = self.agents[agent_id] = {"seq": 0, "entries": deque(), "bytes": 0, "spilled": 0}
+            h["seq"] += 1
+            h["entries"].append((h["seq"], now, cmd_id, None if path else text, path))
+            h["bytes"] += size
+            h["spilled"] += spilled
+            q = h["entries"]
+            while len(q) > OUTPUT_HISTORY_ENTRIES or (len(q) > 1 and (
+                    h["bytes"] > OUTPUT_HISTORY_BYTES or h["spilled"] > OUTPUT_SPILL_AGENT_BYTES)):
+                _, _, _, old_text, old_path = q.popleft()
+                if old_path:
+                    evicted.append(old_path)
+                    h["spilled"] -= _spilled_size(old_path)
+                else:
+                    h["bytes"] -= len(old_text)
+            seq = h["seq"]
+        _unlink(evicted)
+        return seq
+
+    def read(self, agent_id, after, limit):
+        with self.lock:
+            h = self.agents.get(agent_id)
+            if not h or not h["entries"]:
+                return [], (h or {}).get("seq", 0), None
+            q = h["entries"]
+            first = q[0][0]
+            start = max(0, after + 1 - first)
+            return list(islice(q, start, start + limit)), h["seq"], first
+
+    def last(self, agent_id):
+        with self.lock:
+            h = self.agents.get(agent_id)
+            return h["entries"][-1] if h and h["entries"] else None
+
+
+class RedisOutputs:
+    """
+    oh:<agent> — список JSON [seq, ts, cmd_id, text, path], ohs:<agent> — последний seq,
+    ohb:<agent> — байт в файлах на диске. Ограничение — по числу записей и по OUTPUT_SPILL_AGENT_BYTES;
+    текст одной записи в Redis не больше OUTPUT_SPILL_BYTES.
+    """
+    def __init__(self, r):
+        self.r = r
+
+    def append(self, agent_id, cmd_id, text, path, spilled=0):
+        lk, sk, bk = backend.key("oh", agent_id), backend.key("ohs", agent_id), backend.key("ohb", agent_id)
+        seq = self.r.incr(sk)
+        p = self.r.pipeline()
+        p.rpush(lk, json.dumps([seq, time.time(), cmd_id, None if path else text, path]))
+        p.llen(lk)
+        p.incrby(bk, spilled)
+        _, n, on_disk = p.execute()
+        drop = max(0, n - OUTPUT_HISTORY_ENTRIES)
+        while True:
+            dropped = self.r.lpop(lk, drop) if drop else []
+            paths = [e[4] for e in map(json.loads, dropped or []) if e[4]]
+            if paths:
+                freed = sum(_spilled_size(pth) for pth in paths)
+                _unlink(paths)
+                on_disk = self.r.decrby(bk, freed)
+            n -= len(dropped or [])
+            # файлы агента сверх лимита — вытесняем по одной старой записи
+            if on_disk <= OUTPUT_SPILL_AGENT_BYTES or n <= 1:
+                break
+            drop = 1
+        return seq
+
+    def read(self, agent_id, after, limit):
+        lk, sk = backend.key("oh", agent_id), backend.key("ohs", agent_id)
+        p = self.r.pipeline()
+        p.lindex(lk, 0)
+        p.get(sk)
+        head, last = p.execute()
+        if head is None:
+            return [], int(last or 0), None
+        first = json.loads(head)[0]
+        start = max(0, after + 1 - first)
+        entries = [tuple(json.loads(e)) for e in self.r.lrange(lk, start, start + limit - 1)]
+        # между LINDEX и LRANGE список мог сдвинуться — курсор важнее позиции
+        return [e for e in entries if e[0] > after], int(last or 0), first
+
+    def last(self, agent_id):
+        p = self.r.pipeline()
+        p.get(backend.key("ohs", agent_id))
+        p.lindex(backend.key("oh", agent_id), -1)
+        seq, raw = p.execute()
+        return tuple(json.loads(raw)) if seq and raw else None
+
+
+def _memory_outputs():
+    _cleanup_spill_dir()
+    return MemoryOutputs()
+
+
+store = backend.select(_memory_outputs, RedisOutputs)
+
+
+def append(agent_id, cmd_id, text):
+    """Добавляет вывод в историю агента, возвращает его seq."""
+    path, spilled = _spill(agent_id, text) if len(text) > OUTPUT_SPILL_BYTES else (None, 0)
+    return store().append(agent_id, cmd_id, text, path, spilled)
+
+
+def read(agent_id, after=0, limit=100):
+    """
+    Записи с seq > after, по возрастанию. Возвращает (записи, last_seq, first_seq):
+    first_seq — самая старая ещё хранимая запись (если она > after + 1, часть истории вытеснена).
+    """
+    entries, last, first = store().read(agent_id, max(0, after), max(1, min(limit, MAX_READ)))
+    return [_load(e) for e in entries], last, first
+
+
+def latest(agent_id):
+    """Последняя запись или None."""
+    entry = store().last(agent_id)
+    return _load(entry) if entry else None
@@ -0,0 +1,239 @@
+# apps/api/profiling.py
+# Профилирование отдельных запросов без передеплоя.
+# Запрос профилируется, если пришёл заголовок X-Profile: <PROFILE_TOKEN> или ?_profile=<PROFILE_TOKEN>,
+# либо случайно с вероятностью PROFILE_SAMPLE_RATE. Профилируется весь WSGI-вызов —
+# view, запросы SQLAlchemy, рендер Jinja, after_request (Minify, сжатие) и отдача тела.
+# Результат в PROFILE_DIR:
+#  * <имя>.folded — collapsed stacks (flamegraph.pl, speedscope, inferno);
+#  * <имя>.json — сводка: время запроса, число и время SQL-запросов, самые дорогие запросы.
+# В ответ добавляются X-Profile-Id и Server-Timing (app, sql).
+# Стеки снимает поток-сэмплер через sys._current_frames() раз в PROFILE_INTERVAL_MS.
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from apps.api.uploads import DATA_DIR
+
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')                               # без токена — только сэмплирование
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))         # доля запросов, 0 — выключено
+PROFILE_INTERVAL_SEC = float(os.getenv('PROFILE_INTERVAL_MS', 2)) / 1000
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', DATA_DIR / 'profiles'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 200))                       # столько последних профилей хранится
+MAX_CONCURRENT = 2                   # больше одновременно не профилируем — остальные идут как обычно
+SAMPLE_SKIP = ("/static/", "/api/heartbeat", "/metrics")                 # сэмплирование их не трогает
+TOP_QUERIES = 10
+
+ROOT = str(Path(__file__).resolve().parent.parent.parent) + os.sep
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT)
+_active = threading.local()          # .sql — {statement: [count, seconds]} профилируемого запроса
+_names = {}                          # code -> имя кадра
+log = logging.getLogger(__name__)
+
+
+# ---------- SQL ----------
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_sql(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_active, "sql", None) is not None:
+        conn.info.setdefault("profile_t0", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_sql(conn, cursor, statement, parameters, context, executemany):
+    sql = getattr(_active, "sql", None)
+    starts = conn.info.get("profile_t0")
+    if sql is None or not starts:
+        return
+    dt = time.perf_counter() - starts.pop()
+    s = sql.setdefault(" ".join(statement.split())[:500], [0, 0.0])
+    s[0] += 1
+    s[1] += dt
+
+
+# ---------- стеки ----------
+def _frame_name(code):
+    name = _names.get(code)
+    if name is None:
+        path = code.co_filename
+        if path.startswith(ROOT):
+            path = path[len(ROOT):]
+        else:
+            # site-packages/flask/app.py -> flask/app.py
+            path = os.sep.join(path.split(os.sep)[-2:])
+        name = _names[code] = f"{code.co_name} ({path}:{code.co_firstlineno})".replace(";", ":")
+    return name
+
+
+class _Sampler(threading.Thread):
+    """
+    Раз в interval снимает стек потока target; одинаковые стеки складываются в Counter.
+    Кадры сервера ниже RequestProfiler.__call__ отбрасываются.
+    """
+    def __init__(self, ident, interval):
+        super().__init__(name="request-profiler", daemon=True)
+        self.target = ident
+        self.root = RequestProfiler.__call__.__code__
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                if frame.f_code is self.root:
+                    break
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# ---------- запись ----------
+def _slug(path):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", path.strip("/"))[:60] or "root"
+
+
+def _prune():
+    summaries = sorted(PROFILE_DIR.glob("*.json"))
+    for old in summaries[:max(0, len(summaries) - PROFILE_KEEP)]:
+        for p in (old, old.with_suffix(".folded")):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _sql_summary(sql):
+    top = sorted(sql.items(), key=lambda kv: kv[1][1], reverse=True)[:TOP_QUERIES]
+    return {"count": sum(n for n, _ in sql.values()),
+            "time_ms": round(sum(t for _, t in sql.values()) * 1000, 3),
+            "top": [{"statement": stmt, "count": n, "time_ms": round(t * 1000, 3)} for stmt, (n, t) in top]}
+
+
+class _Profile:
+    def __init__(self, environ, trigger):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = environ.get("REQUEST_METHOD", "")
+        self.path = environ.get("PATH_INFO", "")
+        self.trigger = trigger
+        self.status = None
+        self.sql = {}
+        self.sampler = _Sampler(threading.get_ident(), PROFILE_INTERVAL_SEC)
+        self.t0 = time.perf_counter()
+        self.started = time.time()
+        _active.sql = self.sql
+        self.sampler.start()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.t0) * 1000
+
+    def headers(self):
+        n = sum(c for c, _ in self.sql.values())
+        sql_ms = sum(t for _, t in self.sql.values()) * 1000
+        return [("X-Profile-Id", self.id),
+                ("Server-Timing", f'app;dur={self.elapsed_ms():.1f}, sql;dur={sql_ms:.1f};desc="{n} queries"')]
+
+    def finish(self):
+        duration = self.elapsed_ms()
+        self.sampler.stop()
+        _active.sql = None
+        try:
+            self._write(duration)
+        except OSError as e:
+            log.warning("cannot write profile: %s", e)
+        finally:
+            _slots.release()
+
+    def _write(self, duration):
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        base = f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime(self.started))}-{self.id}-{_slug(self.path)}"
+        folded = PROFILE_DIR / f"{base}.folded"
+        folded.write_text("".join(f"{stack} {n}\n" for stack, n in self.sampler.stacks.most_common()),
+                          encoding="utf-8")
+        sql = _sql_summary(self.sql)
+        summary = {"id": self.id, "method": self.method, "path": self.path, "status": self.status,
+                   "trigger": self.trigger, "ts": self.started, "duration_ms": round(duration, 3),
+                   "interval_ms": PROFILE_INTERVAL_SEC * 1000,
+                   "samples": sum(self.sampler.stacks.values()), "stacks": folded.name, "sql": sql}
+        (PROFILE_DIR / f"{base}.json").write_text(json.dumps(summary, indent=2), encoding="utf-8")
+        _prune()
+        log.info("%s %s %s %.1f ms, %d queries %.1f ms -> %s", self.method, self.path, self.status,
+                 duration, sql["count"], sql["time_ms"], folded)
+
+
+# ---------- WSGI ----------
+def _trigger(environ):
+    """Причина профилировать запрос: "token", "sample" или None."""
+    if PROFILE_TOKEN:
+        given = environ.get("HTTP_X_PROFILE")
+        if given is None and "_profile" in environ.get("QUERY_STRING", ""):
+            given = (parse_qs(environ["QUERY_STRING"]).get("_profile") or [None])[0]
+        if given and hmac.compare_digest(given.encode(), PROFILE_TOKEN.encode()):
+            return "token"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE \
+            and not environ.get("PATH_INFO", "").startswith(SAMPLE_SKIP):
+        return "sample"
+    return None
+
+
+class RequestProfiler:
+    """Внешняя WSGI-обёртка: профиль охватывает все слои приложения и отдачу тела."""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        trigger = _trigger(environ)
+        if trigger is None or not _slots.acquire(blocking=False):
+            return self.app(environ, start_response)
+        prof = _Profile(environ, trigger)
+
+        def start(status, headers, exc_info=None):
+            prof.status = int(status.split(" ", 1)[0])
+            return start_response(status, headers + prof.headers(), exc_info)
+
+        try:
+            body = self.app(environ, start)
+        except BaseException:
+            prof.finish()
+            raise
+        return _Body(body, prof)
+
+
+class _Body:
+    """Тело ответа; профиль закрывается, когда сервер дочитал и закрыл его."""
+    def __init__(self, body, prof):
+        self.body = body
+        self.prof = prof
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.prof.finish()
+
+
+def init_app(app):
+    # после compression.init_app — значит снаружи RequestDecoder
+    app.wsgi_app = RequestProfiler(app.wsgi_app)
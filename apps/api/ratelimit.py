@@ -0,0 +1,162 @@
+# apps/api/ratelimit.py
+# Ограничение частоты на ингест-эндпоинтах агентов (heartbeat, output, файлы, connections).
+# Два уровня: корзина на агента (и вид запроса) — один зациклившийся агент не забивает
+# воркер, и общая корзина на каждый вид — шторм переподключений всего парка.
+# Общие лимиты по умолчанию считаются из размера парка и штатной частоты запросов агента
+# с запасом, так что обычный трафик в них не упирается.
+# Сверх лимита — 429 с Retry-After; agent.py выжидает указанное время.
+# Состояние — O(1) на запрос: два числа на корзину.
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import request, jsonify
+
+from apps.api import backend
+
+AGENT_RATE = float(os.getenv('RATE_AGENT_PER_SEC', 10))        # запросов в секунду на агента и вид; 0 — без лимита
+AGENT_BURST = float(os.getenv('RATE_AGENT_BURST', 50))
+FLEET_SIZE = int(os.getenv('RATE_FLEET_SIZE', 10000))           # на сколько агентов рассчитаны общие лимиты
+GLOBAL_HEADROOM = float(os.getenv('RATE_GLOBAL_HEADROOM', 3))   # во сколько раз общий лимит выше штатного потока
+GLOBAL_BURST_SEC = float(os.getenv('RATE_GLOBAL_BURST_SEC', 10))  # всплеск — столько секунд лимита
+MAX_BUCKETS = 100_000
+
+# штатная частота запросов одного агента (agent.py: long-poll 20 с, соединения раз в 15 с)
+PER_AGENT_RATE = {"heartbeat": 1 / 20, "connections": 1 / 15, "output": 1 / 30, "file": 1 / 60}
+FIXED_GLOBAL = {"broadcast": (2, 10)}  # действия операторов от размера парка не зависят
+
+
+def _global_limit(kind):
+    """
+    (rate, burst) общей корзины вида kind. RATE_GLOBAL_<KIND>_PER_SEC / _BURST задают явно,
+    RATE_GLOBAL_PER_SEC — для всех видов сразу (0 — без общего лимита).
+    """
+    env = kind.upper()
+    rate = os.getenv(f'RATE_GLOBAL_{env}_PER_SEC', os.getenv('RATE_GLOBAL_PER_SEC'))
+    if rate is not None:
+        rate = float(rate)
+        default_burst = rate * GLOBAL_BURST_SEC
+    elif kind in FIXED_GLOBAL:
+        rate, default_burst = FIXED_GLOBAL[kind]
+    else:
+        rate = FLEET_SIZE * PER_AGENT_RATE.get(kind, 1 / 60) * GLOBAL_HEADROOM
+        default_burst = max(rate * GLOBAL_BURST_SEC, FLEET_SIZE)  # переподключение всего парка разом
+    burst = float(os.getenv(f'RATE_GLOBAL_{env}_BURST', os.getenv('RATE_GLOBAL_BURST', default_burst)))
+    return rate, burst
+
+
+GLOBAL_LIMITS = {kind: _global_limit(kind) for kind in (*PER_AGENT_RATE, *FIXED_GLOBAL)}
+
+
+class MemoryBuckets:
+    """Классический token bucket: {key: [tokens, ts, rate, burst]} под одним lock."""
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _prune_locked(self, now):
+        # полная корзина ничем не отличается от отсутствующей — такие записи можно выбросить
+        for k in [k for k, (tokens, ts, rate, burst) in self.buckets.items()
+                  if tokens + (now - ts) * rate >= burst]:
+            del self.buckets[k]
+
+    def take(self, key, rate, burst, now):
+        with self.lock:
+            b = self.buckets.get(key)
+            if b is None:
+                if len(self.buckets) >= MAX_BUCKETS:
+                    self._prune_locked(now)
+                b = self.buckets[key] = [burst, now, rate, burst]
+            tokens = min(burst, b[0] + (now - b[1]) * rate)
+            b[1] = now
+            if tokens >= 1:
+                b[0] = tokens - 1
+                return 0.0
+            b[0] = tokens
+            return (1 - tokens) / rate
+
+
+# тот же token bucket, атомарно на стороне Redis; время — TIME сервера Redis,
+# чтобы часы воркеров на разных машинах не расходились
+_TAKE_LUA = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """Общие для всех воркеров корзины rl:<key> — hash {tokens, ts}, списание одним Lua-скриптом."""
+    def __init__(self, r):
+        self.r = r
+        self.script = r.register_script(_TAKE_LUA)
+
+    def take(self, key, rate, burst, now):
+        return float(self.script(keys=[backend.key("rl", key)], args=[rate, burst]))
+
+
+store = backend.select(MemoryBuckets, RedisBuckets)
+
+
+def check(kind, agent_id):
+    """Списывает по токену из корзины агента и общей корзины вида. Возвращает 0 или сколько секунд подождать."""
+    now = time.time()
+    st = store()
+    if AGENT_RATE > 0 and agent_id:
+        wait = st.take(f"{kind}:{agent_id}", AGENT_RATE, AGENT_BURST, now)
+        if wait:
+            return wait
+    rate, burst = GLOBAL_LIMITS.get(kind) or GLOBAL_LIMITS.setdefault(kind, _global_limit(kind))
+    if rate > 0:
+        return st.take(f"global:{kind}", rate, burst, now)
+    return 0.0
+
+
+def _agent_id(kwargs):
+    if "agent_id" in kwargs:
+        return kwargs["agent_id"]
+    # /api/heartbeat и batch: id агента (или relay) в теле; без него — по адресу клиента
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and (data.get("id") or data.get("relay")):
+        return str(data.get("id") or data.get("relay"))
+    return request.remote_addr
+
+
+def retry_after(wait):
+    """Значение заголовка Retry-After: целые секунды, не меньше 1."""
+    return str(max(1, math.ceil(wait)))
+
+
+def too_many(wait):
+    resp = jsonify({"error": "rate limit exceeded", "retry_after": round(wait, 3)})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = retry_after(wait)
+    return resp
+
+
+def limited(kind):
+    """Декоратор ингест-эндпоинта; kind — вид запроса (отдельная корзина агента на каждый)."""
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            wait = check(kind, _agent_id(kwargs))
+            if wait:
+                return too_many(wait)
+            return fn(*args, **kwargs)
+        return wrapper
+    return deco
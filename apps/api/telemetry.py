@@ -0,0 +1,229 @@
+# apps/api/telemetry.py
+# Метрики для Prometheus: GET /metrics в текстовом формате экспозиции.
+#  - число запросов и гистограмма задержки по blueprint / endpoint / методу / статусу;
+#  - gauge'и хранилищ: реестр агентов, очередь команд, файлы, соединения и кэш Threat Intel;
+#  - время ожидания на общих lock'ах (TimedLock).
+# Гистограммы запросов при redis:// общие для всех воркеров (hash prom:req),
+# lock'и — свои у каждого процесса, поэтому помечены pid.
+import hmac
+import logging
+import math
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+from apps.api import backend
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # сек; long-poll — до WAIT_MAX
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # если задан — /metrics только с Authorization: Bearer <token>
+PREFIX = "vast_"
+
+log = logging.getLogger(__name__)
+
+
+# ---------- lock'и ----------
+class TimedLock:
+    """
+    threading.Lock, который считает захваты, захваты с ожиданием и суммарное время ожидания.
+    Без конкуренции — один неблокирующий acquire, время не замеряется.
+    Счётчики меняются под самим lock'ом.
+    """
+    registry = []
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.contended = 0
+        self.wait_sec = 0.0
+        TimedLock.registry.append(self)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.acquired += 1
+            return True
+        if not blocking:
+            return False
+        t0 = time.perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+        self.wait_sec += time.perf_counter() - t0
+        self.acquired += 1
+        self.contended += 1
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+# ---------- гистограммы запросов ----------
+def _bucket(value):
+    """Номер первого бакета, в который попадает value (len(BUCKETS) — +Inf)."""
+    for i, le in enumerate(BUCKETS):
+        if value <= le:
+            return i
+    return len(BUCKETS)
+
+
+class MemoryHistograms:
+    """{(blueprint, endpoint, method, status): [counts по бакетам..., sum]} — счётчики не кумулятивные."""
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        i = _bucket(value)
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [0] * (len(BUCKETS) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def dump(self):
+        with self.lock:
+            return {k: list(v) for k, v in self.series.items()}
+
+
+class RedisHistograms:
+    """
+    prom:req — hash "<blueprint>|<endpoint>|<method>|<status>|<бакет или sum>" -> число.
+    Запрос — один pipeline из двух HINCRBY*; кумулятивные бакеты считаются при выдаче.
+    """
+    def __init__(self, r):
+        self.r = r
+        self.key = backend.key("prom", "req")
+
+    def observe(self, labels, value):
+        base = "|".join(labels)
+        p = self.r.pipeline(transaction=False)
+        p.hincrby(self.key, f"{base}|{_bucket(value)}", 1)
+        p.hincrbyfloat(self.key, f"{base}|sum", value)
+        p.execute()
+
+    def dump(self):
+        out = {}
+        for field, v in self.r.hgetall(self.key).items():
+            *labels, slot = field.split("|")
+            s = out.setdefault(tuple(labels), [0] * (len(BUCKETS) + 1) + [0.0])
+            if slot == "sum":
+                s[-1] = float(v)
+            else:
+                s[int(slot)] = int(v)
+        return out
+
+
+histograms = backend.select(MemoryHistograms, RedisHistograms)
+_gauges = []
+
+
+def observe(blueprint, endpoint, method, status, seconds):
+    try:
+        histograms().observe((blueprint or "none", endpoint or "none", method, str(status)), seconds)
+    except Exception:
+        pass  # метрики не должны ронять запрос
+
+
+def gauge(fn):
+    """
+    Регистрирует источник gauge'ей: fn() -> [(name, help, type, [(labels dict, value)])].
+    Вызывается на каждый scrape; ошибка одного источника не мешает остальным.
+    """
+    _gauges.append(fn)
+    return fn
+
+
+# ---------- выдача ----------
+def _esc(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(d):
+    if not d:
+        return ""
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in d.items()) + "}"
+
+
+def _num(v):
+    if isinstance(v, float):
+        if math.isinf(v):
+            return "+Inf" if v > 0 else "-Inf"
+        return repr(v)
+    return str(v)
+
+
+def _render_requests(lines):
+    name = PREFIX + "http_request_duration_seconds"
+    lines.append(f"# HELP {name} Request latency by blueprint and endpoint.")
+    lines.append(f"# TYPE {name} histogram")
+    for (bp, ep, method, status), s in sorted(histograms().dump().items()):
+        lbl = {"blueprint": bp, "endpoint": ep, "method": method, "status": status}
+        acc = 0
+        for le, n in zip(BUCKETS + (math.inf,), s[:-1]):
+            acc += n
+            lines.append(f"{name}_bucket{_labels(dict(lbl, le=_num(float(le))))} {acc}")
+        lines.append(f"{name}_sum{_labels(lbl)} {_num(s[-1])}")
+        lines.append(f"{name}_count{_labels(lbl)} {acc}")
+
+
+def _render_locks(lines):
+    pid = str(os.getpid())
+    for metric, attr, help_ in (("lock_acquired_total", "acquired", "Lock acquisitions."),
+                                ("lock_contended_total", "contended", "Acquisitions that had to wait."),
+                                ("lock_wait_seconds_total", "wait_sec", "Time spent waiting for the lock.")):
+        name = PREFIX + metric
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} counter")
+        for lk in TimedLock.registry:
+            lines.append(f"{name}{_labels({'lock': lk.name, 'pid': pid})} {_num(getattr(lk, attr))}")
+
+
+def render():
+    lines = []
+    _render_requests(lines)
+    _render_locks(lines)
+    for fn in _gauges:
+        try:
+            families = fn()
+        except Exception as e:
+            log.warning("gauge source %s failed: %s", fn.__name__, e)
+            continue
+        for name, help_, type_, samples in families:
+            lines.append(f"# HELP {PREFIX}{name} {help_}")
+            lines.append(f"# TYPE {PREFIX}{name} {type_}")
+            for lbl, value in samples:
+                lines.append(f"{PREFIX}{name}{_labels(lbl)} {_num(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", "").encode(),
+                                                 f"Bearer {METRICS_TOKEN}".encode()):
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def init_app(app):
+    @app.before_request
+    def _start_timer():
+        g._t0 = time.perf_counter()
+
+    @app.after_request
+    def _record(resp):
+        t0 = g.pop("_t0", None)
+        if t0 is not None:
+            observe(request.blueprint, request.endpoint, request.method, resp.status_code,
+                    time.perf_counter() - t0)
+        return resp
+
+    app.add_url_rule("/metrics", "metrics", metrics_view, methods=["GET"])
@@ -1,27 +1,126 @@
 # -*- coding: utf-8 -*-
 # apps/api/threat_intel.py
-import os, time, requests, threading, collections
+import os, time, json, logging, requests, collections, queue, threading
 from dotenv import load_dotenv
 from flask import Blueprint, request, jsonify
 
+from apps.api import backend, ratelimit, telemetry
+
 load_dotenv()
 ti = Blueprint("ti", __name__)
+log = logging.getLogger(__name__)
 
 ABUSE_KEY = os.getenv("ABUSEIPDB_KEY")
 CACHE = {}  # ip -> {"score": int, "reports": int, "ts": float, "country": str, "categories": list}
 CACHE_TTL = 24 * 3600
-STORE_LOCK = threading.Lock()
+CACHE_STATS = {"hits": 0, "misses": 0}  # попадания/промахи кэша для /metrics
+STORE_LOCK = telemetry.TimedLock("STORE_LOCK")
+
+# Обогащение вне запроса: промахи кэша уходят в очередь, пул потоков ходит в AbuseIPDB
+ENRICH_WORKERS = int(os.getenv("TI_ENRICH_WORKERS", 4))
+ENRICH_QUEUE_MAX = int(os.getenv("TI_ENRICH_QUEUE_MAX", 1000))  # больше IP ждать не может — записи помечаются skipped
+ENRICH_STATS = {"enriched": 0, "failed": 0, "dropped": 0, "lookup_sec": 0.0}
+STATS_LOCK = threading.Lock()  # CACHE_STATS и ENRICH_STATS меняют потоки запросов и пула
+
+def _count(stats, key, n=1):
+    with STATS_LOCK:
+        stats[key] += n
 
 # Храним последние N записей по агенту (in-memory)
 MAX_PER_AGENT = 200
 CONN_STORE = collections.defaultdict(lambda: collections.deque(maxlen=MAX_PER_AGENT))
 
-def abuse_check(ip, max_age_days=30, cache_ttl=CACHE_TTL):
-    now = time.time()
+class MemoryConnStore:
+    def push(self, agent_id, items):
+        with STORE_LOCK:
+            dq = CONN_STORE[agent_id]
+            for item in items:
+                dq.appendleft(item)  # новые сверху
+
+    def recent(self, agent_id, limit):
+        with STORE_LOCK:
+            return list(list(CONN_STORE.get(agent_id, []))[:limit])
+
+    def patch(self, agent_id, ip, fields):
+        """Дописывает fields во все ещё не обогащённые записи агента с этим ip (pending, failed, skipped)."""
+        n = 0
+        with STORE_LOCK:
+            for item in CONN_STORE.get(agent_id, ()):
+                if item.get("ip") == ip and item.get("enrichment") in _UNRESOLVED:
+                    item.update(fields)
+                    n += 1
+        return n
+
+    def size(self):
+        with STORE_LOCK:
+            return len(CONN_STORE), sum(len(dq) for dq in CONN_STORE.values())
+
+class RedisConnStore:
+    # conns:<agent_id> — список JSON, новые слева, обрезается до MAX_PER_AGENT
+    def __init__(self, r):
+        self.r = r
+
+    def push(self, agent_id, items):
+        if not items:
+            return
+        k = backend.key("conns", agent_id)
+        p = self.r.pipeline()
+        p.lpush(k, *[json.dumps(i) for i in items])
+        p.ltrim(k, 0, MAX_PER_AGENT - 1)
+        p.execute()
+
+    def recent(self, agent_id, limit):
+        if limit <= 0:
+            return []
+        return [json.loads(v) for v in self.r.lrange(backend.key("conns", agent_id), 0, limit - 1)]
+
+    def patch(self, agent_id, ip, fields):
+        # WATCH + MULTI: параллельный LPUSH сдвигает индексы — тогда перечитываем список
+        from redis.exceptions import WatchError
+        k = backend.key("conns", agent_id)
+        for _ in range(5):
+            with self.r.pipeline() as p:
+                try:
+                    p.watch(k)
+                    changed = []
+                    for i, raw in enumerate(p.lrange(k, 0, -1)):
+                        item = json.loads(raw)
+                        if item.get("ip") == ip and item.get("enrichment") in _UNRESOLVED:
+                            item.update(fields)
+                            changed.append((i, json.dumps(item)))
+                    if not changed:
+                        return 0
+                    p.multi()
+                    for i, raw in changed:
+                        p.lset(k, i, raw)
+                    p.execute()
+                    return len(changed)
+                except WatchError:
+                    continue
+        return 0
+
+    def size(self):
+        keys = list(self.r.scan_iter(match=backend.key("conns", "*"), count=1000))
+        p = self.r.pipeline(transaction=False)
+        for k in keys:
+            p.llen(k)
+        return len(keys), sum(p.execute()) if keys else 0
+
+conn_store = backend.select(MemoryConnStore, RedisConnStore)
+
+def _fresh(ip, cache_ttl=CACHE_TTL):
     hit = CACHE.get(ip)
-    if hit and (now - hit["ts"] < cache_ttl):
-        return hit
+    return hit if hit and (time.time() - hit["ts"] < cache_ttl) else None
+
+def cached(ip, cache_ttl=CACHE_TTL):
+    """Свежая запись кэша или None — без обращения к AbuseIPDB."""
+    hit = _fresh(ip, cache_ttl)
+    _count(CACHE_STATS, "hits" if hit else "misses")
+    return hit
 
+def _fetch(ip, max_age_days=30):
+    """Запись AbuseIPDB или None, если запрос не удался; неудачи не кэшируются — IP спросим при следующей встрече."""
+    now = time.time()
     rec = {"score": 0, "reports": 0, "country": None, "categories": [], "ts": now}
     if not ABUSE_KEY:
         CACHE[ip] = rec
@@ -43,40 +142,155 @@ def abuse_check(ip, max_age_days=30, cache_ttl=CACHE_TTL):
                 "categories": (j.get("reports") or [{}])[-1].get("categories", []) if j.get("reports") else [],
                 "ts": now,
             })
-    except Exception:
-        pass
+        else:
+            log.warning("AbuseIPDB lookup failed for %s: HTTP %s", ip, r.status_code)
+            return None
+    except Exception as e:
+        log.warning("AbuseIPDB lookup failed for %s: %s", ip, e)
+        return None
 
     CACHE[ip] = rec
     return rec
 
+def abuse_check(ip, max_age_days=30, cache_ttl=CACHE_TTL):
+    return cached(ip, cache_ttl) or _fetch(ip, max_age_days)
+
+def _enriched(v):
+    return {"abuse_score": v["score"], "abuse_reports": v["reports"], "country": v["country"],
+            "categories": v["categories"], "enrichment": "done"}
+
+_PENDING_FIELDS = {"abuse_score": None, "abuse_reports": None, "country": None, "categories": [],
+                   "enrichment": "pending"}
+_UNRESOLVED = ("pending", "failed", "skipped")  # такие записи ещё может дописать следующий lookup
+
+
+class Enricher:
+    """
+    Пул потоков обогащения. pending: {ip: set(agent_id)} — IP в очереди или в работе
+    и чьи записи ждут результата; один IP запрашивается один раз, сколько бы агентов его ни прислали.
+    """
+    def __init__(self, workers=ENRICH_WORKERS, maxsize=ENRICH_QUEUE_MAX):
+        self.q = queue.Queue(maxsize=maxsize)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.threads = []
+
+    def _ensure_workers(self):
+        if self.threads:
+            return
+        with self.lock:
+            if not self.threads:
+                self.threads = [threading.Thread(target=self._loop, name=f"ti-enrich-{i}", daemon=True)
+                                for i in range(self.workers)]
+                for t in self.threads:
+                    t.start()
+
+    def submit(self, agent_id, ips):
+        """Записи агента с этими IP уже сохранены как pending."""
+        self._ensure_workers()
+        now_ready, dropped = [], []
+        for ip in ips:
+            with self.lock:
+                if ip in self.pending:
+                    self.pending[ip].add(agent_id)
+                    continue
+                # воркер мог закончить этот IP между проверкой кэша и сохранением записей
+                hit = _fresh(ip)
+                if hit:
+                    now_ready.append((ip, hit))
+                    continue
+                try:
+                    self.q.put_nowait(ip)
+                except queue.Full:
+                    dropped.append(ip)
+                    continue
+                self.pending[ip] = {agent_id}
+        for ip, v in now_ready:
+            conn_store().patch(agent_id, ip, _enriched(v))
+        for ip in dropped:
+            _count(ENRICH_STATS, "dropped")
+            conn_store().patch(agent_id, ip, {"enrichment": "skipped"})
+
+    def _loop(self):
+        while True:
+            ip = self.q.get()
+            try:
+                t0 = time.perf_counter()
+                v = _fetch(ip)
+                _count(ENRICH_STATS, "lookup_sec", time.perf_counter() - t0)
+                with self.lock:
+                    agents = self.pending.pop(ip, ())
+                # неудача не кэшируется: следующая встреча IP снова поставит его в очередь
+                fields = _enriched(v) if v else {"enrichment": "failed"}
+                for agent_id in agents:
+                    conn_store().patch(agent_id, ip, fields)
+                _count(ENRICH_STATS, "enriched" if v else "failed")
+            except Exception:
+                log.exception("enrichment failed for %s", ip)
+                _count(ENRICH_STATS, "failed")
+                with self.lock:
+                    agents = self.pending.pop(ip, ())
+                for agent_id in agents:
+                    conn_store().patch(agent_id, ip, {"enrichment": "failed"})
+            finally:
+                self.q.task_done()
+
+
+enricher = Enricher()
+
 @ti.route("/api/agent/<agent_id>/connections", methods=["POST"])
+@ratelimit.limited('connections')
 def receive_conns(agent_id):
+    """
+    Соединения сохраняются сразу: IP из кэша обогащаются на месте, остальные — с
+    enrichment: "pending", их дописывает пул Enricher. Ответ не ждёт AbuseIPDB.
+    """
     data = request.json or {}
     conns = data.get("conns") or []
-    enriched = []
+    now = int(time.time())
+    records, pending = [], set()
     for c in conns:
-        v = abuse_check(c.get("ip"))
-        enriched.append({
-            **c,
-            "abuse_score": v["score"],
-            "abuse_reports": v["reports"],
-            "country": v["country"],
-            "categories": v["categories"],
-            "received_ts": int(time.time()),
-        })
-
-    with STORE_LOCK:
-        dq = CONN_STORE[agent_id]
-        for item in enriched:
-            dq.appendleft(item)  # новые сверху
-
-    return jsonify({"ok": True, "count": len(enriched)})
+        ip = c.get("ip")
+        v = cached(ip) if ip else None
+        if v is None and ip:
+            fields = _PENDING_FIELDS
+            pending.add(ip)
+        else:
+            fields = _enriched(v or {"score": 0, "reports": 0, "country": None, "categories": []})
+        records.append({**c, **fields, "categories": list(fields["categories"]), "received_ts": now})
+
+    conn_store().push(agent_id, records)
+    if pending:
+        enricher.submit(agent_id, pending)
+
+    return jsonify({"ok": True, "count": len(records), "pending": len(pending)})
+
+@telemetry.gauge
+def _gauges():
+    agents, entries = conn_store().size()
+    with STATS_LOCK:
+        hits, misses = CACHE_STATS["hits"], CACHE_STATS["misses"]
+        enrich = dict(ENRICH_STATS)
+    return [("ti_conn_store_entries", "Stored connection records.", "gauge", [({}, entries)]),
+            ("ti_conn_store_agents", "Agents with stored connections.", "gauge", [({}, agents)]),
+            ("ti_cache_entries", "AbuseIPDB cache entries.", "gauge", [({}, len(CACHE))]),
+            ("ti_cache_requests_total", "AbuseIPDB cache lookups.", "counter",
+             [({"result": "hit"}, hits), ({"result": "miss"}, misses)]),
+            ("ti_cache_hit_ratio", "AbuseIPDB cache hit ratio since start.", "gauge",
+             [({}, hits / (hits + misses) if hits + misses else 0.0)]),
+            ("ti_enrich_queue_depth", "IPs waiting for an AbuseIPDB lookup.", "gauge", [({}, enricher.q.qsize())]),
+            ("ti_enrich_queue_capacity", "Enrichment queue bound.", "gauge", [({}, enricher.q.maxsize)]),
+            ("ti_enrich_pending_ips", "IPs queued or being looked up.", "gauge", [({}, len(enricher.pending))]),
+            ("ti_enrich_total", "Enrichment outcomes: looked up, lookup failed, dropped on a full queue.", "counter",
+             [({"result": r}, enrich[r]) for r in ("enriched", "failed", "dropped")]),
+            ("ti_enrich_lookup_seconds_total", "Time spent in AbuseIPDB lookups.", "counter",
+             [({}, enrich["lookup_sec"])])]
 
 def get_recent_conns(agent_id: str, limit: int = 50):
-    with STORE_LOCK:
-        return list(list(CONN_STORE.get(agent_id, []))[:limit])
+    return conn_store().recent(agent_id, limit)
 
 @ti.route("/api/agent/<agent_id>/connections/recent", methods=["GET"])
 def recent_conns_api(agent_id):
-    limit = int(request.args.get("limit", 50))
+    limit = max(1, min(request.args.get("limit", 50, type=int), MAX_PER_AGENT))
     return jsonify({"items": get_recent_conns(agent_id, limit)})
@@ -0,0 +1,174 @@
+# apps/api/uploads.py
+# Докачиваемая загрузка файлов от агентов: сырые чанки (application/octet-stream)
+# пишутся сразу на диск по смещению, без base64 и без копий файла в памяти.
+# Состояние загрузки целиком на диске (<id>.part + <id>.json), поэтому чанки
+# одной загрузки могут попадать в разные воркеры gunicorn.
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только внутри процесса
+    fcntl = None
+
+DATA_DIR = Path(os.getenv('DATA_DIR', Path(__file__).resolve().parent.parent / 'data'))
+UPLOAD_DIR = Path(os.getenv('UPLOAD_DIR', DATA_DIR / 'uploads'))
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 64 * 1024 ** 3))
+STALE_UPLOAD_SEC = 24 * 3600   # незавершённые загрузки старше суток удаляются
+COPY_BUF = 1024 * 1024
+
+_busy = set()   # загрузки, в которые сейчас пишет этот процесс
+lock = threading.Lock()
+_last_cleanup = 0.0
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _part_path(upload_id):
+    return UPLOAD_DIR / f"{upload_id}.part"
+
+
+def _meta_path(upload_id):
+    return UPLOAD_DIR / f"{upload_id}.json"
+
+
+def _load_meta(agent_id, upload_id):
+    if not upload_id.isalnum():
+        return None
+    try:
+        meta = json.loads(_meta_path(upload_id).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if meta.get("agent_id") != agent_id:
+        return None
+    part = _part_path(upload_id)
+    meta["offset"] = part.stat().st_size if part.exists() else 0
+    return meta
+
+
+def _cleanup(now):
+    global _last_cleanup
+    if now - _last_cleanup < 3600:
+        return
+    _last_cleanup = now
+    for p in UPLOAD_DIR.glob("*.json"):
+        try:
+            if now - p.stat().st_mtime > STALE_UPLOAD_SEC:
+                _part_path(p.stem).unlink(missing_ok=True)
+                p.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+
+def begin(agent_id, name, total, sha256):
+    """
+    Начинает (или продолжает) загрузку. ID детерминированный, поэтому агент после
+    обрыва/перезапуска получает тот же upload_id и текущее смещение.
+    """
+    name = Path(name or "").name
+    sha256 = (sha256 or "").lower()
+    if not name or len(sha256) != 64:
+        raise UploadError("name and sha256 are required")
+    if not isinstance(total, int) or total < 0 or total > MAX_UPLOAD_BYTES:
+        raise UploadError(f"total must be between 0 and {MAX_UPLOAD_BYTES}")
+
+    upload_id = hashlib.sha256(f"{agent_id}\0{name}\0{sha256}\0{total}".encode()).hexdigest()[:32]
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    _cleanup(time.time())
+
+    meta = _load_meta(agent_id, upload_id)
+    if meta is None:
+        meta = {"agent_id": agent_id, "name": name, "total": total, "sha256": sha256}
+        tmp = _meta_path(upload_id).with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp, _meta_path(upload_id))
+        meta["offset"] = _part_path(upload_id).stat().st_size if _part_path(upload_id).exists() else 0
+    return upload_id, meta["offset"]
+
+
+def status(agent_id, upload_id):
+    meta = _load_meta(agent_id, upload_id)
+    if not meta:
+        return None
+    return {"upload_id": upload_id, "offset": meta["offset"], "total": meta["total"]}
+
+
+def _acquire(upload_id, f):
+    with lock:
+        if upload_id in _busy:
+            return False
+        _busy.add(upload_id)
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            with lock:
+                _busy.discard(upload_id)
+            return False
+    return True
+
+
+def _release(upload_id):
+    # flock снимается вместе с закрытием файла
+    with lock:
+        _busy.discard(upload_id)
+
+
+def write_chunk(agent_id, upload_id, offset, stream):
+    """
+    Дописывает чанк из stream (request.stream) начиная с offset.
+    Возвращает (meta, path): path != None, когда файл загружен полностью и SHA-256 совпал.
+    """
+    meta = _load_meta(agent_id, upload_id)
+    if not meta:
+        raise UploadError("unknown upload", status=404)
+
+    part = _part_path(upload_id)
+    with open(part, "a+b") as f:
+        if not _acquire(upload_id, f):
+            raise UploadError("chunk already in progress", status=409, offset=meta["offset"])
+        try:
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                raise UploadError("offset mismatch", status=409, offset=current)
+            written = 0
+            try:
+                while True:
+                    buf = stream.read(COPY_BUF)
+                    if not buf:
+                        break
+                    written += len(buf)
+                    if offset + written > meta["total"]:
+                        raise UploadError("chunk exceeds declared total size", offset=offset)
+                    f.write(buf)
+                f.flush()
+            except Exception:
+                # обрезаем до последнего целого чанка, чтобы можно было докачать
+                f.truncate(offset)
+                raise
+        finally:
+            _release(upload_id)
+
+    meta["offset"] = offset + written
+    os.utime(_meta_path(upload_id))
+    if meta["offset"] != meta["total"]:
+        return meta, None
+
+    h = hashlib.sha256()
+    with open(part, "rb") as f:
+        for buf in iter(lambda: f.read(COPY_BUF), b""):
+            h.update(buf)
+    _meta_path(upload_id).unlink(missing_ok=True)
+    if h.hexdigest() != meta["sha256"]:
+        part.unlink(missing_ok=True)
+        raise UploadError("sha256 mismatch, upload discarded", status=422, offset=0)
+    return meta, part
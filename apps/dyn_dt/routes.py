@@ -1,5 +1,5 @@
 # -*- encoding: utf-8 -*-
-import json, csv, io
+import json, csv, io, logging
 from flask_login import login_required
 from apps.dyn_dt import blueprint
 from flask import render_template, request, redirect, url_for, jsonify, make_response
@@ -7,9 +7,20 @@ from apps.dyn_dt.utils import get_model_field_names, get_model_fk_values, name_t
     exclude_auto_gen_fields
 from apps import db, config
 from apps.dyn_dt.utils import *
-from sqlalchemy import and_
+from sqlalchemy import and_, event
 from sqlalchemy import Integer, DateTime, String, Text
+from sqlalchemy.orm import Session
 from datetime import datetime
+from apps.api import http_cache
+
+log = logging.getLogger(__name__)
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_db_generation(session, flush_context):
+    # любая запись в БД может поменять счётчики /dynamic-dt/stats
+    if session.new or session.dirty or session.deleted:
+        http_cache.bump('db')
 
 
 @blueprint.route('/dynamic-dt')
@@ -78,6 +89,7 @@ def debug_database():
 
 
 @blueprint.route('/dynamic-dt/stats')
+@http_cache.cached(depends=('db',))
 def get_statistics():
     """Get real-time statistics for the dashboard"""
     try:
@@ -85,35 +97,35 @@ def get_statistics():
 
         # Get total workspaces
         stats['total_workspaces'] = len(config.Config.DYNAMIC_DATATB.keys())
-        print(f"Total workspaces: {stats['total_workspaces']}")
+        log.debug("Total workspaces: %s", stats['total_workspaces'])
 
         # Get active cases count (if cases table exists)
         if 'cases' in config.Config.DYNAMIC_DATATB:
             try:
                 CaseModel = name_to_class(config.Config.DYNAMIC_DATATB['cases'])
-                print(f"Case model found: {CaseModel}")
+                log.debug("Case model found: %s", CaseModel)
 
                 if CaseModel:
                     # Count all cases - this should match the "Total Records" from model.html
                     total_cases = CaseModel.query.count()
                     stats['active_cases'] = total_cases
-                    print(f"Total cases counted: {total_cases}")
+                    log.debug("Total cases counted: %s", total_cases)
 
                     # Also get the actual field names for debugging
                     if hasattr(CaseModel, '__table__'):
                         field_names = [field.name for field in CaseModel.__table__.columns]
                         stats['case_fields'] = field_names
-                        print(f"Case fields: {field_names}")
+                        log.debug("Case fields: %s", field_names)
 
                 else:
                     stats['active_cases'] = 0
-                    print("Case model is None, setting active_cases to 0")
+                    log.debug("Case model is None, setting active_cases to 0")
             except Exception as e:
-                print(f"Error getting cases count: {e}")
+                log.warning("Error getting cases count: %s", e)
                 stats['active_cases'] = 0
         else:
             # If no 'cases' table, try to find any table that might contain case data
-            print("No 'cases' in DYNAMIC_DATATB, looking for alternative...")
+            log.debug("No 'cases' in DYNAMIC_DATATB, looking for alternative...")
             stats['active_cases'] = 0
 
             # Try to get count from the first available table as fallback
@@ -122,13 +134,13 @@ def get_statistics():
                     ModelClass = name_to_class(model_name)
                     if ModelClass:
                         record_count = ModelClass.query.count()
-                        print(f"Table '{table_name}' has {record_count} records")
+                        log.debug("Table '%s' has %s records", table_name, record_count)
                         # Use the first table's count as active cases
                         stats['active_cases'] = record_count
                         stats['active_cases_source'] = table_name
                         break
                 except Exception as e:
-                    print(f"Error counting records in {table_name}: {e}")
+                    log.warning("Error counting records in %s: %s", table_name, e)
                     continue
 
         # Get data tables count
@@ -140,11 +152,11 @@ def get_statistics():
         # Add timestamp for debugging
         stats['last_updated'] = datetime.now().isoformat()
 
-        print(f"Final stats: {stats}")
+        log.debug("Final stats: %s", stats)
         return jsonify(stats)
 
     except Exception as e:
-        print(f"Error getting statistics: {e}")
+        log.exception("Error getting statistics: %s", e)
         return jsonify({
             'error': 'Failed to get statistics',
             'active_cases': 0,
@@ -341,7 +353,7 @@ def create(aPath):
 
     except Exception as e:
         db.session.rollback()
-        print(f"Error creating item: {e}")
+        log.exception("Error creating item: %s", e)
         return redirect(
             url_for('table_blueprint.model_dt', aPath=aPath) + '?error=creation_failed&message=Failed to create item')
 
@@ -376,7 +388,7 @@ def delete(aPath, id):
 
     except Exception as e:
         db.session.rollback()
-        print(f"Error deleting item: {e}")
+        log.exception("Error deleting item: %s", e)
         return redirect(
             url_for('table_blueprint.model_dt', aPath=aPath) + '?error=delete_failed&message=Failed to delete item')
 
@@ -414,7 +426,7 @@ def update(aPath, id):
 
     except Exception as e:
         db.session.rollback()
-        print(f"Error updating item: {e}")
+        log.exception("Error updating item: %s", e)
         return redirect(
             url_for('table_blueprint.model_dt', aPath=aPath) + '?error=update_failed&message=Failed to update item')
 
@@ -440,7 +452,7 @@ def export_csv(aPath):
         if field.key in db_field_names:
             fields.append(field.key)
         else:
-            print(f"Field {field.key} does not exist in {aModelClass} model.")
+            log.warning("Field %s does not exist in %s model.", field.key, aModelClass)
 
     output = io.StringIO()
     writer = csv.writer(output)
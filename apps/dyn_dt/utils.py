@@ -2,10 +2,13 @@
 
 
 import importlib
+import logging
 from sqlalchemy import or_
 from sqlalchemy import DateTime, func
 from apps import db 
 
+log = logging.getLogger(__name__)
+
 class PageItems(db.Model):
     __tablename__ = 'page_items'
     id = db.Column(db.Integer, primary_key=True)
@@ -63,7 +66,7 @@ def name_to_class(name: str):
         module = importlib.import_module(module_name)
         return getattr(module, class_name)
     except Exception as e:
-        print(f"Error importing {name}: {e}")
+        log.warning("Error importing %s: %s", name, e)
         return None
 
 
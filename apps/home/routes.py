@@ -13,60 +13,58 @@ from flask_wtf import FlaskForm
 import json
 import os
 from flask import Blueprint, request, jsonify
-import requests
 from datetime import datetime
 import threading
 import time
-import requests
 import time, base64, tempfile
 from pathlib import Path
 from flask import send_file
 
-from apps.api.agent_state import get_all_agents, get_agent
+from apps.api.agent_state import get_agent, list_agents
+from apps.api.agent_state import counts as agent_counts
+from apps.api import command_queue, dispatch
 from apps.api.threat_intel import get_recent_conns
 
-AGENTS_FILE = os.path.join(os.path.dirname(__file__), "..", "data", "agents.json")
-
-ONLINE_WINDOW = 30  # сек
+AGENTS_PER_PAGE = 50
 
 
 @blueprint.route('/')
 @blueprint.route('/index')
 def index():
-    agents = get_all_agents()
     now_ts = time.time()
 
-    # добавим вычисляемое поле для таблицы
-    agents_view = []
-    for a in agents:
-        last_ts = a.get('last_seen_ts', 0)
-        computed_online = (now_ts - last_ts) < ONLINE_WINDOW
-        a_view = dict(a)
-        a_view['computed_online'] = computed_online
-        agents_view.append(a_view)
+    # таблица агентов — постранично, свежие heartbeat'ы первыми
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', AGENTS_PER_PAGE, type=int), 1), 500)
+    agents, agents_total = list_agents(offset=(page - 1) * per_page, limit=per_page,
+                                       sort=request.args.get('sort', 'last_seen'))
 
-    active_count = sum(1 for a in agents if (now_ts - a.get('last_seen_ts', 0)) < ONLINE_WINDOW)
-    inactive_count = len(agents) - active_count
+    stats = agent_counts()
+    active_count = stats['active']
+    inactive_count = stats['inactive']
 
     # Calculate heartbeats for last 24 hours
     from apps.api.routes import heartbeats_log, files_log, metrics_lock
-    from datetime import datetime, timedelta
 
     heartbeats_24h = 0
     transferred_files_24h = 0
     try:
-        now = datetime.utcnow()
-        start = now - timedelta(hours=24)
+        # окно 24 ч с точностью до минуты
+        end = int(now_ts) + 1
+        start = (end // 60) * 60 - 24 * 3600
         with metrics_lock:
-            heartbeats_24h = sum(1 for ts in heartbeats_log if start <= ts <= now)
-            transferred_files_24h = sum(1 for ts in files_log if start <= ts <= now)
+            heartbeats_24h = heartbeats_log.total(start, end)
+            transferred_files_24h = files_log.total(start, end)
     except Exception:
         heartbeats_24h = 0
         transferred_files_24h = 0
 
     return render_template(
         'pages/index.html',
-        agents=agents_view,  # важно: отдаём с computed_online
+        agents=agents,
+        agents_total=agents_total,
+        page=page,
+        pages=max((agents_total + per_page - 1) // per_page, 1),
         active_count=active_count,
         inactive_count=inactive_count,
         heartbeats_24h=heartbeats_24h,  # Add heartbeats count for last 24h
@@ -96,13 +94,6 @@ def view_agent(agent_id):
     )
 
 
-def load_agents():
-    if os.path.exists(AGENTS_FILE):
-        with open(AGENTS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
-
-
 @blueprint.route('/tables')
 def tables():
     context = {
@@ -235,6 +226,28 @@ def replace_value(value, arg):
     return value.replace(arg, " ").title()
 
 
+def _run_on_agent(agent_id, cmd, timeout=dispatch.COMMAND_WAIT_SEC):
+    """
+    Ставит команду агенту и ждёт её вывод (возврат сразу, как агент ответит).
+    Если команда не успела завершиться — страница дочитает вывод через SSE.
+    """
+    try:
+        res = dispatch.run(agent_id, cmd, timeout=timeout)
+    except command_queue.QueueFull as e:
+        return {"output": f"Error sending command: {e}", "id": None, "done": True, "seq": 0}
+    except Exception as e:
+        return {"output": f"Exception: {e}", "id": None, "done": True, "seq": 0}
+    if res["done"] and not res["output"]:
+        res["output"] = "No output."
+    return res
+
+
+def _render_agent(agent_id, res):
+    agent = get_agent(agent_id)
+    return render_template('pages/agent_detail.html', agent=agent, agent_id=agent_id,
+                           exec_output=res["output"], command=res, segment='agent_detail')
+
+
 @blueprint.route('/admin/exec', methods=['POST'])
 def exec_command():
     agent_id = request.form.get('agent_id')
@@ -243,20 +256,8 @@ def exec_command():
     if not agent_id or not command:
         return "Missing data", 400
 
-    try:
-        r = requests.post(f"http://127.0.0.1:5000/api/agent/{agent_id}/command", json={"command": command})
-        if r.status_code == 200:
-            time.sleep(2)  # дождаться выполнения
-            out = requests.get(f"http://127.0.0.1:5000/api/agent/{agent_id}/get_output").json().get(
-                "output") or "No output."
-        else:
-            out = f"Error sending command. Status: {r.status_code}"
-    except Exception as e:
-        out = f"Exception: {e}"
-
-    agent = get_agent(agent_id)
-    return render_template('pages/agent_detail.html', agent=agent, agent_id=agent_id, exec_output=out,
-                           segment='agent_detail')
+    res = _run_on_agent(agent_id, command)
+    return _render_agent(agent_id, res)
 
 
 @blueprint.route('/admin/kill', methods=['POST'])
@@ -269,57 +270,19 @@ def kill_process():
 
     cmd = f"taskkill /PID {pid} /F"
 
-    try:
-        # Отправляем команду агенту
-        response = requests.post(
-            f"http://127.0.0.1:5000/api/agent/{agent_id}/command",
-            json={"command": cmd}
-        )
-
-        if response.status_code == 200:
-            # Ждём, пока агент выполнит команду
-            time.sleep(2)
-
-            # Получаем результат
-            result = requests.get(
-                f"http://127.0.0.1:5000/api/agent/{agent_id}/get_output"
-            )
-            output = result.json().get("output") or "No output."
-        else:
-            output = f"Error sending command. Status: {response.status_code}"
-
-    except Exception as e:
-        output = f"Exception: {e}"
+    # Отправляем команду агенту и ждём результат
+    res = _run_on_agent(agent_id, cmd)
 
     # Возвращаем ту же страницу с результатом
-    agent = get_agent(agent_id)
-    return render_template(
-        'pages/agent_detail.html',
-        agent=agent,
-        agent_id=agent_id,
-        exec_output=output,
-        segment='agent_detail'
-    )
+    return _render_agent(agent_id, res)
 
 
 @blueprint.route('/admin/processes', methods=['POST'])
 def list_processes():
     agent_id = request.form.get('agent_id')
     cmd = "tasklist"
-    try:
-        r = requests.post(f"http://127.0.0.1:5000/api/agent/{agent_id}/command", json={"command": cmd})
-        if r.status_code == 200:
-            time.sleep(2)
-            out = requests.get(f"http://127.0.0.1:5000/api/agent/{agent_id}/get_output").json().get(
-                "output") or "No output."
-        else:
-            out = f"Error sending command. Status: {r.status_code}"
-    except Exception as e:
-        out = f"Exception: {e}"
-
-    agent = get_agent(agent_id)
-    return render_template('pages/agent_detail.html', agent=agent, agent_id=agent_id, exec_output=out,
-                           segment='agent_detail')
+    res = _run_on_agent(agent_id, cmd)
+    return _render_agent(agent_id, res)
 
 
 @blueprint.route('/admin/list_dir', methods=['POST'])
@@ -331,20 +294,8 @@ def list_directory():
         return "Missing data", 400
 
     cmd = f'dir "{dir_path}"'
-    try:
-        r = requests.post(f"http://127.0.0.1:5000/api/agent/{agent_id}/command", json={"command": cmd})
-        if r.status_code == 200:
-            time.sleep(2)
-            out = requests.get(f"http://127.0.0.1:5000/api/agent/{agent_id}/get_output").json().get(
-                "output") or "No output."
-        else:
-            out = f"Error sending command. Status: {r.status_code}"
-    except Exception as e:
-        out = f"Exception: {e}"
-
-    agent = get_agent(agent_id)
-    return render_template('pages/agent_detail.html', agent=agent, agent_id=agent_id, exec_output=out,
-                           segment='agent_detail')
+    res = _run_on_agent(agent_id, cmd)
+    return _render_agent(agent_id, res)
 
 
 @blueprint.route('/admin/download', methods=['POST'])
@@ -355,16 +306,9 @@ def download_file():
     if not agent_id or not file_path:
         return "Missing data", 400
 
-    # Просим агента отправить файл
+    # Просим агента отправить файл и ждём, пока он отчитается о завершении
     cmd = f'__DOWNLOAD__:"{file_path}"'
-    requests.post(
-        f"http://127.0.0.1:5000/api/agent/{agent_id}/command",
-        json={"command": cmd},
-        timeout=5
-    )
-
-    # Дадим агенту время отправить файл
-    time.sleep(3)
+    _run_on_agent(agent_id, cmd)
 
     # Редиректим браузер на эндпоинт скачивания «последнего» файла
     return redirect(f"/api/agent/{agent_id}/files/latest")
@@ -373,9 +317,8 @@ def download_file():
 @blueprint.route('/admin/screenshot', methods=['POST'])
 def take_screenshot():
     agent_id = request.form.get('agent_id')
-    # просим агента
-    requests.post(f"http://127.0.0.1:5000/api/agent/{agent_id}/command", json={"command": "__SCREENSHOT__"}, timeout=5)
-    time.sleep(3)  # подождать
+    # просим агента и ждём, пока скриншот будет загружен
+    _run_on_agent(agent_id, "__SCREENSHOT__")
     # отдать последний файл на скачивание
     return redirect(f"/api/agent/{agent_id}/files/latest")
 
@@ -393,24 +336,9 @@ def run_yara():
     data = file.read()
     b64 = base64.b64encode(data).decode("utf-8")
 
-    try:
-        # Encode scan_path to avoid delimiter conflicts
-        scan_path_encoded = base64.b64encode(scan_path.encode()).decode()
-        # Include scan_path in the YARA command
-        r = requests.post(
-            f"http://127.0.0.1:5000/api/agent/{agent_id}/command",
-            json={"command": f"__YARA__:{fname}:{b64}:{scan_path_encoded}"},
-            timeout=10
-        )
-        if r.ok:
-            time.sleep(2.5)
-            out = requests.get(f"http://127.0.0.1:5000/api/agent/{agent_id}/get_output").json().get(
-                "output") or "No output."
-        else:
-            out = f"Error sending YARA job: {r.status_code}"
-    except Exception as e:
-        out = f"Exception: {e}"
-
-    agent = get_agent(agent_id)
-    return render_template('pages/agent_detail.html', agent=agent, agent_id=agent_id, exec_output=out,
-                           segment='agent_detail')
\ No newline at end of file
+    # Encode scan_path to avoid delimiter conflicts
+    scan_path_encoded = base64.b64encode(scan_path.encode()).decode()
+    # Include scan_path in the YARA command
+    # Долгий скан: страница вернётся быстро, остальной вывод придёт через SSE
+    res = _run_on_agent(agent_id, f"__YARA__:{fname}:{b64}:{scan_path_encoded}", timeout=3)
+    return _render_agent(agent_id, res)
@@ -0,0 +1,14 @@
+# -*- encoding: utf-8 -*-
+"""
+ASGI entry point: the agent API (long-poll heartbeats) runs on an event loop,
+everything else is served by the same Flask app through a WSGI bridge.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5006
+
+With STATE_BACKEND_URL=redis://... the UI can keep running under gunicorn (run:app)
+and nginx sends /api/heartbeat* here.
+"""
+from run import app as flask_app
+from apps.api.asgi import AgentAPI
+
+app = AgentAPI(flask_app)
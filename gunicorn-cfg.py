@@ -2,9 +2,17 @@
 """
 Copyright (c) 2019 - present AppSeed.us
 """
+import os
 
 bind = '0.0.0.0:5005'
-workers = 1
+# больше одного воркера — только с общим состоянием: STATE_BACKEND_URL=redis://...
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+# long-poll heartbeat'ы держат поток до HEARTBEAT_LONGPOLL_MAX_SEC (20 с), поэтому нужны потоки.
+# Одновременно ждать может не больше HEARTBEAT_LONGPOLL_MAX_CONCURRENT (по умолчанию 3/4 потоков) —
+# остальным heartbeat'ам сервер отвечает сразу, и агент повторяет через свой интервал.
+# Крупному парку — агентский API через asgi.py (uvicorn), см. README.
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 64))
 accesslog = '-'
 loglevel = 'debug'
 capture_output = True
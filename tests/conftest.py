@@ -0,0 +1,61 @@
+# tests/conftest.py
+# Хранилища API читают настройки из окружения при импорте — поэтому окружение задаётся до импорта apps.
+# Тесты на Redis идут через fakeredis (Lua — через lupa); без них эти варианты пропускаются.
+import os
+import tempfile
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="vast-tests-"))
+os.environ["REGISTRY_SNAPSHOT_SEC"] = "0"   # без фонового снимка в SQLite
+
+import pytest
+from flask import Flask
+
+from apps.api import artifacts, backend, command_queue, dispatch, http_cache, outputs, ratelimit, uploads
+
+STORES = (command_queue.store, dispatch.store, outputs.store, ratelimit.store, http_cache.generations)
+
+
+def _reset_stores():
+    for get in STORES:
+        get.reset()
+
+
+@pytest.fixture(params=["memory", "redis"])
+def state_backend(request):
+    """Каждый тест с этой фикстурой проходит на обоих бэкендах, с чистым состоянием."""
+    if request.param == "redis":
+        fakeredis = pytest.importorskip("fakeredis")
+        pytest.importorskip("lupa")
+        backend.use(fakeredis.FakeRedis(decode_responses=True))
+    else:
+        backend.use("memory://")
+    _reset_stores()
+    yield request.param
+    backend.use("memory://")
+    _reset_stores()
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Загрузки, файлы и вывод — во временном каталоге теста."""
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", tmp_path / "uploads")
+    monkeypatch.setattr(artifacts, "BLOB_DIR", tmp_path / "artifacts" / "blobs")
+    monkeypatch.setattr(artifacts, "INDEX_PATH", tmp_path / "artifacts" / "index.sqlite3")
+    monkeypatch.setattr(artifacts, "_ready", False)
+    monkeypatch.setattr(outputs, "OUTPUT_DIR", tmp_path / "outputs")
+    return tmp_path
+
+
+@pytest.fixture
+def app(state_backend, data_dir):
+    """Только агентский API — без БД, логина и шаблонов."""
+    from apps.api.routes import api
+
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
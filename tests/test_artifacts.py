@@ -0,0 +1,62 @@
+import pytest
+
+from apps.api import artifacts
+
+
+@pytest.fixture
+def store(data_dir, monkeypatch):
+    monkeypatch.setattr(artifacts, "ARTIFACT_AGENT_QUOTA_BYTES", 2500)
+    monkeypatch.setattr(artifacts, "ARTIFACT_QUOTA_BYTES", 4000)
+
+    def put(agent_id, name, data):
+        src = data_dir / f"{agent_id}-{name}.tmp"
+        src.write_bytes(data)
+        return artifacts.put(agent_id, name, str(src))
+
+    return put
+
+
+def names():
+    return sorted((f["agent_id"], f["name"]) for f in artifacts.list_files())
+
+
+def blobs_on_disk():
+    return sorted(p.name for p in artifacts.BLOB_DIR.rglob("*") if p.is_file())
+
+
+def test_identical_files_share_one_blob(store):
+    a = store("a", "1.bin", b"x" * 1000)
+    b = store("b", "same.bin", b"x" * 1000)
+    assert a["sha256"] == b["sha256"]
+    assert artifacts.usage() == {"files": 2, "logical_bytes": 2000, "physical_bytes": 1000}
+    assert blobs_on_disk() == [a["sha256"]]
+
+
+def test_agent_quota_evicts_least_recently_used(store):
+    x = store("a", "1.bin", b"x" * 1000)
+    store("b", "same.bin", b"x" * 1000)
+    store("a", "2.bin", b"y" * 1000)
+    store("a", "3.bin", b"z" * 1000)     # a: 3000 > 2500 — уходит 1.bin
+
+    assert names() == [("a", "2.bin"), ("a", "3.bin"), ("b", "same.bin")]
+    assert x["sha256"] in blobs_on_disk()   # blob всё ещё нужен b/same.bin
+
+
+def test_global_quota_counts_physical_bytes_and_frees_blobs(store):
+    store("b", "same.bin", b"x" * 1000)
+    y = store("a", "2.bin", b"y" * 1000)
+    store("a", "3.bin", b"z" * 1000)
+    artifacts.get("b", "same.bin")           # свежий доступ — b/same.bin уже не самый старый
+
+    big = store("c", "big.bin", b"w" * 2000)  # 5000 > 4000 — уходит LRU a/2.bin вместе с blob
+    assert names() == [("a", "3.bin"), ("b", "same.bin"), ("c", "big.bin")]
+    assert artifacts.usage()["physical_bytes"] == 4000
+    assert y["sha256"] not in blobs_on_disk() and big["sha256"] in blobs_on_disk()
+    assert len(blobs_on_disk()) == 3
+
+
+def test_replacing_a_file_frees_its_old_blob(store):
+    old = store("a", "f.bin", b"old" * 100)
+    new = store("a", "f.bin", b"new" * 100)
+    assert names() == [("a", "f.bin")]
+    assert blobs_on_disk() == [new["sha256"]] and old["sha256"] != new["sha256"]
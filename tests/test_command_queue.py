@@ -0,0 +1,62 @@
+import pytest
+
+from apps.api import command_queue
+
+
+def ids(batch):
+    return [c["id"] for c in batch]
+
+
+def test_unacked_commands_are_redelivered_first(state_backend):
+    a = command_queue.enqueue("a1", "whoami")
+    b = command_queue.enqueue("a1", "hostname")
+
+    first = command_queue.take("a1")
+    assert ids(first) == [a, b]
+    # ответ до агента не дошёл — без ack те же команды приходят снова
+    assert ids(command_queue.take("a1")) == [a, b]
+    assert command_queue.pending_count("a1") == 2
+
+    c = command_queue.enqueue("a1", "ipconfig")
+    assert command_queue.ack("a1", [a]) == 1
+    assert sorted(ids(command_queue.take("a1"))) == sorted([b, c])
+
+    command_queue.ack("a1", [b, c])
+    assert command_queue.take("a1") == []
+    assert command_queue.pending_count() == 0
+
+
+def test_ack_of_unknown_ids_is_ignored(state_backend):
+    cid = command_queue.enqueue("a1", "whoami")
+    command_queue.take("a1")
+    assert command_queue.ack("a1", ["nope"]) == 0
+    assert command_queue.ack("a2", [cid]) == 0
+    assert ids(command_queue.take("a1")) == [cid]
+
+
+def test_untracked_take_is_not_redelivered(state_backend):
+    command_queue.enqueue("legacy", "whoami")
+    assert len(command_queue.take("legacy", max_items=1, track=False)) == 1
+    assert command_queue.take("legacy", track=False) == []
+    assert command_queue.pending_count() == 0
+
+
+def test_take_many_redelivers_per_agent(state_backend):
+    a = command_queue.enqueue("r1", "x")
+    b = command_queue.enqueue("r2", "y")
+    assert {k: ids(v) for k, v in command_queue.take_many(["r1", "r2", "r3"]).items()} == {"r1": [a], "r2": [b]}
+
+    command_queue.ack_many({"r1": [a]})
+    assert {k: ids(v) for k, v in command_queue.take_many(["r1", "r2"]).items()} == {"r2": [b]}
+
+
+def test_queue_limit(state_backend, monkeypatch):
+    monkeypatch.setattr(command_queue, "MAX_QUEUED_PER_AGENT", 2)
+    command_queue.enqueue("a1", "1")
+    command_queue.enqueue("a1", "2")
+    with pytest.raises(command_queue.QueueFull):
+        command_queue.enqueue("a1", "3")
+
+    queued, rejected = command_queue.enqueue_many(["a1", "a2"], "broadcast")
+    assert list(queued) == ["a2"] and list(rejected) == ["a1"]
+    assert command_queue.pending_count() == 3
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+from apps.api import command_queue, dispatch
+
+
+@pytest.fixture
+def fast_agent(state_backend, monkeypatch):
+    """Агент отвечает, как только команда попала в очередь, — раньше, чем submit() вернулся."""
+    q = command_queue.store()
+
+    def enqueue(agent_id, item):
+        type(q).enqueue(q, agent_id, item)
+        dispatch.record_output(agent_id, item["id"], f"out-{agent_id}", True)
+
+    def enqueue_many(items):
+        rejected = type(q).enqueue_many(q, items)
+        for agent_id, item in items:
+            if agent_id not in rejected:
+                dispatch.record_output(agent_id, item["id"], f"out-{agent_id}", True)
+        return rejected
+
+    monkeypatch.setattr(q, "enqueue", enqueue)
+    monkeypatch.setattr(q, "enqueue_many", enqueue_many)
+
+
+def test_output_before_submit_returns_is_kept(fast_agent):
+    cid = dispatch.submit("a1", "whoami")
+    res = dispatch.wait(cid, timeout=0.5)
+    assert res == {"id": cid, "output": "out-a1", "done": True, "seq": 1}
+
+
+def test_broadcast_output_before_submit_many_returns_is_kept(fast_agent):
+    queued, rejected = dispatch.submit_many(["a1", "a2"], "hostname")
+    assert rejected == {}
+    assert dispatch.status_many(queued.values()) == {cid: (True, True, 1) for cid in queued.values()}
+
+
+def test_chunks_arrive_in_order(state_backend):
+    cid = dispatch.submit("a1", "long task")
+
+    def agent():
+        for i in range(3):
+            dispatch.record_output("a1", cid, f"chunk{i}")
+        dispatch.record_output("a1", cid, "", done=True)
+
+    t = threading.Thread(target=agent)
+    t.start()
+    res = dispatch.wait(cid, timeout=2)
+    t.join()
+    assert res["done"] and res["output"] == "chunk0\nchunk1\nchunk2" and res["seq"] == 3
+
+
+def test_legacy_output_goes_to_oldest_open_command(state_backend):
+    first = dispatch.submit("a1", "one")
+    second = dispatch.submit("a1", "two")
+    assert dispatch.record_output("a1", None, "result") == first
+    assert dispatch.record_output("a1", None, "result") == second
+    assert dispatch.record_output("a1", None, "result") is None
+
+
+def test_rejected_commands_are_not_left_open(state_backend, monkeypatch):
+    monkeypatch.setattr(command_queue, "MAX_QUEUED_PER_AGENT", 1)
+    dispatch.submit("a1", "one")
+    with pytest.raises(command_queue.QueueFull):
+        dispatch.submit("a1", "two")
+    queued, rejected = dispatch.submit_many(["a1", "a2"], "three")
+    assert list(queued) == ["a2"] and list(rejected) == ["a1"]
+
+    # в открытых у a1 — только первая команда: отказы не перехватывают вывод старых агентов
+    assert dispatch.record_output("a1", None, "x") is not None
+    assert dispatch.record_output("a1", None, "x") is None
@@ -0,0 +1,44 @@
+import pytest
+
+from apps.api import outputs
+
+
+@pytest.fixture
+def history(state_backend, data_dir, monkeypatch):
+    monkeypatch.setattr(outputs, "OUTPUT_HISTORY_ENTRIES", 5)
+    for i in range(1, 9):
+        outputs.append("a1", f"c{i}", f"out{i}")
+
+
+def seqs(items):
+    return [i["seq"] for i in items]
+
+
+def test_evicted_history_shows_as_gap(history):
+    items, last, first = outputs.read("a1", after=0)
+    assert seqs(items) == [4, 5, 6, 7, 8]
+    assert (last, first) == (8, 4)   # first > after + 1: записи 1..3 вытеснены
+
+
+def test_cursor_continues_after_seq(history):
+    items, last, first = outputs.read("a1", after=5)
+    assert seqs(items) == [6, 7, 8] and items[0]["output"] == "out6" and items[0]["command_id"] == "c6"
+
+    items, _, _ = outputs.read("a1", after=2, limit=2)
+    assert seqs(items) == [4, 5]
+
+    assert outputs.read("a1", after=8) == ([], 8, 4)
+
+
+def test_unknown_agent(state_backend):
+    assert outputs.read("nobody") == ([], 0, None)
+    assert outputs.latest("nobody") is None
+
+
+def test_latest_and_spilled_entries(history, monkeypatch):
+    monkeypatch.setattr(outputs, "OUTPUT_SPILL_BYTES", 10)
+    outputs.append("a1", "big", "x" * 100)
+    latest = outputs.latest("a1")
+    assert (latest["seq"], latest["command_id"], latest["output"]) == (9, "big", "x" * 100)
+    items, _, first = outputs.read("a1", after=8)
+    assert seqs(items) == [9] and items[0]["output"] == "x" * 100 and first == 5
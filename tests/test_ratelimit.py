@@ -0,0 +1,47 @@
+import pytest
+from flask import Flask
+
+from apps.api import ratelimit
+
+
+@pytest.fixture
+def client(state_backend, monkeypatch):
+    monkeypatch.setattr(ratelimit, "AGENT_RATE", 0.1)
+    monkeypatch.setattr(ratelimit, "AGENT_BURST", 2)
+    monkeypatch.setitem(ratelimit.GLOBAL_LIMITS, "test", (0, 0))
+
+    app = Flask(__name__)
+
+    @app.route("/limited/<agent_id>", methods=["POST"])
+    @ratelimit.limited("test")
+    def limited_view(agent_id):
+        return "ok"
+
+    return app.test_client()
+
+
+def test_agent_bucket_returns_429_with_retry_after(client):
+    assert client.post("/limited/a1").status_code == 200
+    assert client.post("/limited/a1").status_code == 200
+
+    r = client.post("/limited/a1")
+    assert r.status_code == 429
+    # корзина пуста, пополнение 0.1 токена/с — ждать ~10 с, в заголовке целые секунды
+    assert r.headers["Retry-After"] == "10"
+    assert 9 < r.json["retry_after"] <= 10
+
+    assert client.post("/limited/a2").status_code == 200   # у другого агента своя корзина
+
+
+def test_global_bucket(client, monkeypatch):
+    monkeypatch.setattr(ratelimit, "AGENT_RATE", 0)
+    monkeypatch.setitem(ratelimit.GLOBAL_LIMITS, "test", (0.5, 1))
+    assert client.post("/limited/a1").status_code == 200
+
+    r = client.post("/limited/a2")
+    assert r.status_code == 429 and r.headers["Retry-After"] == "2"
+
+
+def test_retry_after_is_at_least_one_second():
+    assert ratelimit.retry_after(0.01) == "1"
+    assert ratelimit.retry_after(2.2) == "3"
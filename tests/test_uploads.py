@@ -0,0 +1,71 @@
+import hashlib
+import os
+
+import pytest
+
+DATA = os.urandom(3000)
+SHA = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture
+def upload(client):
+    r = client.post("/api/agent/a1/uploads", json={"name": "dump.bin", "total": len(DATA), "sha256": SHA})
+    assert r.status_code == 200 and r.json["offset"] == 0
+    return r.json["upload_id"]
+
+
+def put(client, upload_id, offset, body):
+    return client.put(f"/api/agent/a1/uploads/{upload_id}?offset={offset}", data=body,
+                      content_type="application/octet-stream")
+
+
+def test_resume_from_stored_offset(client, upload):
+    r = put(client, upload, 0, DATA[:1000])
+    assert r.json == {"status": "partial", "offset": 1000}
+
+    # после обрыва агент начинает заново и получает тот же upload_id и смещение
+    r = client.post("/api/agent/a1/uploads", json={"name": "dump.bin", "total": len(DATA), "sha256": SHA})
+    assert r.json == {"upload_id": upload, "offset": 1000}
+    assert client.get(f"/api/agent/a1/uploads/{upload}").json == {"upload_id": upload, "offset": 1000,
+                                                                  "total": len(DATA)}
+
+    r = put(client, upload, 1000, DATA[1000:])
+    assert r.json == {"status": "stored", "name": "dump.bin", "offset": len(DATA)}
+
+    r = client.get("/api/agent/a1/files/dump.bin")
+    assert r.status_code == 200 and r.data == DATA
+    assert client.get("/api/agent/a1/files/dump.bin", headers={"If-None-Match": f'"{SHA}"'}).status_code == 304
+
+
+def test_wrong_offset_is_409_with_current_offset(client, upload):
+    put(client, upload, 0, DATA[:500])
+
+    r = put(client, upload, 0, DATA[:500])      # повтор уже принятого чанка
+    assert r.status_code == 409 and r.json["offset"] == 500
+    r = put(client, upload, 900, DATA[900:])    # пропуск
+    assert r.status_code == 409 and r.json["offset"] == 500
+
+    assert put(client, upload, 500, DATA[500:]).json["status"] == "stored"
+
+
+def test_chunk_past_total_is_rejected_and_truncated(client, upload):
+    put(client, upload, 0, DATA[:1000])
+    r = put(client, upload, 1000, DATA[1000:] + b"extra")
+    assert r.status_code == 400
+    assert client.get(f"/api/agent/a1/uploads/{upload}").json["offset"] == 1000
+
+
+def test_sha256_mismatch_discards_upload(client):
+    bad = hashlib.sha256(b"other").hexdigest()
+    upload_id = client.post("/api/agent/a1/uploads",
+                            json={"name": "x.bin", "total": len(DATA), "sha256": bad}).json["upload_id"]
+    r = put(client, upload_id, 0, DATA)
+    assert r.status_code == 422
+    assert client.get(f"/api/agent/a1/uploads/{upload_id}").status_code == 404
+    assert client.get("/api/agent/a1/files/x.bin").status_code == 404
+
+
+def test_unknown_upload_and_other_agent(client, upload):
+    assert put(client, "deadbeef", 0, b"x").status_code == 404
+    assert client.put(f"/api/agent/a2/uploads/{upload}?offset=0", data=b"x").status_code == 404
+    assert client.put(f"/api/agent/a1/uploads/{upload}").status_code == 400
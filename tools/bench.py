@@ -0,0 +1,347 @@
+# tools/bench.py
+# Микробенчмарки горячих функций сервера и агента на реалистичных данных:
+# 10k агентов в реестре, 100k соединений Threat Intel, 1k файлов в индексе артефактов,
+# 10k записей Case для dyn_dt. Для каждой функции — ops/sec (медиана повторов)
+# и аллокации через tracemalloc: пик памяти одного вызова и блоки, оставшиеся после вызовов.
+#
+#   python tools/bench.py                  # прогон + сравнение с tools/bench_baseline.json
+#   python tools/bench.py --save           # записать новый baseline
+#   python tools/bench.py -k agents --check 20   # код 1, если что-то медленнее baseline на 20%+
+#
+# Всё состояние — во временном DATA_DIR и in-memory backend; рабочие данные не трогаются.
+import argparse
+import ast
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE = Path(__file__).resolve().parent / "bench_baseline.json"
+
+N_AGENTS = 10_000
+N_CONN_AGENTS = 500          # 500 агентов x 200 записей (MAX_PER_AGENT) = 100k соединений
+N_FILES = 1_000
+N_CASES = 10_000
+
+_benches = []
+
+
+def bench(name):
+    """Регистрирует фабрику: fixtures -> функция без аргументов (одна операция)."""
+    def deco(fn):
+        _benches.append((name, fn))
+        return fn
+    return deco
+
+
+# ---------- окружение и данные ----------
+def _setup_env(backend_url):
+    tmp = tempfile.mkdtemp(prefix="vast-bench-")
+    os.environ["DATA_DIR"] = tmp
+    os.environ["REGISTRY_SNAPSHOT_SEC"] = "0"
+    os.environ["RATE_AGENT_PER_SEC"] = "0"
+    os.environ["RATE_GLOBAL_PER_SEC"] = "0"
+    os.environ["STATE_BACKEND_URL"] = backend_url
+    sys.path.insert(0, str(ROOT))
+    return Path(tmp)
+
+
+def _make_app(tmp):
+    from apps.config import config_dict
+
+    class BenchConfig(config_dict["Debug"]):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + str(tmp / "bench.sqlite3")
+
+    from apps import create_app, db
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _agent_functions(*names):
+    """
+    Функции agent.py без импорта модуля: на импорте agent.py спрашивает адрес сервера (input()).
+    Берём только нужные def и модули, которые им нужны.
+    """
+    import ipaddress
+    import time as time_mod
+    import uuid
+    import psutil
+    src = (ROOT / "agent.py").read_text(encoding="utf-8")
+    tree = ast.parse(src)
+    nodes = [n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name in names]
+    g = {"ipaddress": ipaddress, "psutil": psutil, "uuid": uuid, "time": time_mod}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), "agent.py", "exec"), g)
+    return {n: g[n] for n in names}
+
+
+class Fixtures:
+    def __init__(self, tmp):
+        self.tmp = tmp
+        self.app = _make_app(tmp)
+        rnd = random.Random(42)
+        self.rnd = rnd
+
+        from apps.api import agent_state
+        self.agent_ids = [f"agent-{i:05d}" for i in range(N_AGENTS)]
+        oses = ["Windows 10", "Windows 11", "Linux 6.1.0", "Darwin 23.1.0"]
+        agent_state.update_agents([
+            (a, {"hostname": f"host-{i:05d}", "os": oses[i % 4], "mac": f"00:16:3E:{i >> 16 & 255:02X}:{i >> 8 & 255:02X}:{i & 255:02X}"},
+             f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}")
+            for i, a in enumerate(self.agent_ids)])
+
+        # Threat Intel: 100k соединений в хранилище, кэш AbuseIPDB прогрет
+        from apps.api import threat_intel
+        self.ips = [f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+                    for _ in range(20_000)]
+        now = time.time()
+        for ip in self.ips:
+            threat_intel.CACHE[ip] = {"score": rnd.randint(0, 100), "reports": rnd.randint(0, 50),
+                                      "country": "US", "categories": [14, 18], "ts": now}
+        for a in self.agent_ids[:N_CONN_AGENTS]:
+            threat_intel.conn_store().push(a, [self.conn(now) for _ in range(threat_intel.MAX_PER_AGENT)])
+        self.conn_batch = [self.conn(now) for _ in range(20)]
+
+        # метрики: неделя heartbeat'ов, минутные и часовые бакеты заполнены
+        from apps.api import metrics
+        self.counter = metrics.counter("bench_heartbeats")
+        for s in range(0, 7 * 86400, 60):
+            self.counter.add(ts=now - s, k=rnd.randint(1, 200))
+
+        # 1k файлов у 100 агентов
+        from apps.api import artifacts
+        src_dir = tmp / "src"
+        src_dir.mkdir()
+        for i in range(N_FILES):
+            p = src_dir / f"f{i}.bin"
+            p.write_bytes(os.urandom(rnd.randint(200, 4000)))
+            artifacts.put(self.agent_ids[i % 100], f"file-{i}.bin", p)
+
+        # dyn_dt: таблица cases
+        from apps import db
+        from apps.models import Case, SeverityLevel, STATUS_TYPE
+        words = ["phishing", "malware", "ransomware", "lateral", "beacon", "exfil", "brute", "scan"]
+        with self.app.app_context():
+            db.session.bulk_save_objects([
+                Case(case_title=f"{rnd.choice(words)} on host-{i:05d}", description=" ".join(rnd.choices(words, k=12)),
+                     severity=rnd.choice(list(SeverityLevel)), status=rnd.choice(list(STATUS_TYPE)))
+                for i in range(N_CASES)])
+            db.session.commit()
+
+    def conn(self, ts):
+        return {"ip": self.rnd.choice(self.ips), "port": self.rnd.choice((443, 80, 22, 8443)),
+                "pid": self.rnd.randint(100, 60000), "proc": "chrome.exe", "ts": int(ts)}
+
+
+# ---------- бенчмарки ----------
+@bench("routes._bucket_count 7d/day")
+def _(fx):
+    from apps.api.routes import _bucket_count
+    end = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    start = end - timedelta(days=7)
+    return lambda: _bucket_count(fx.counter, start, end, timedelta(days=1), "%a")
+
+
+@bench("routes._bucket_count 30m/min")
+def _(fx):
+    from apps.api.routes import _bucket_count
+    end = datetime.utcnow().replace(second=0, microsecond=0)
+    start = end - timedelta(minutes=30)
+    return lambda: _bucket_count(fx.counter, start, end, timedelta(minutes=1), "%H:%M")
+
+
+@bench("agent_state.update_agent")
+def _(fx):
+    from apps.api.agent_state import update_agent
+    ids, rnd = fx.agent_ids, fx.rnd
+    data = {"hostname": "host", "os": "Linux 6.1.0", "mac": "00:16:3E:00:00:01"}
+
+    def op():
+        a = ids[rnd.randrange(N_AGENTS)]
+        update_agent(a, dict(data, hostname="host-" + a[-5:]), "10.0.0.1")
+    return op
+
+
+@bench("agent_state.get_all_agents (10k)")
+def _(fx):
+    from apps.api.agent_state import get_all_agents
+    return get_all_agents
+
+
+@bench("agent_state.list_agents page")
+def _(fx):
+    from apps.api.agent_state import list_agents
+    return lambda: list_agents(offset=0, limit=50, os="linux")
+
+
+@bench("threat_intel.abuse_check (cache hit)")
+def _(fx):
+    from apps.api.threat_intel import abuse_check
+    ips, rnd = fx.ips, fx.rnd
+    return lambda: abuse_check(ips[rnd.randrange(len(ips))])
+
+
+@bench("threat_intel.receive_conns (20 conns)")
+def _(fx):
+    from apps.api import threat_intel
+    view = getattr(threat_intel.receive_conns, "__wrapped__", threat_intel.receive_conns)  # без rate limit
+    body = {"conns": fx.conn_batch}
+    ids, rnd = fx.agent_ids, fx.rnd
+
+    def op():
+        with fx.app.test_request_context(json=body, method="POST"):
+            view(ids[rnd.randrange(N_CONN_AGENTS)])
+    return op
+
+
+@bench("routes.list_all_files (1k files)")
+def _(fx):
+    from apps.api import routes
+    view = getattr(routes.list_all_files, "__wrapped__", routes.list_all_files)  # без http_cache
+
+    def op():
+        with fx.app.test_request_context("/api/files?limit=1000"):
+            view()
+    return op
+
+
+@bench("dyn_dt.user_filter + first page")
+def _(fx):
+    from apps.dyn_dt.utils import user_filter
+    from apps.models import Case
+    fields = ["case_title", "description"]
+
+    def op():
+        with fx.app.test_request_context("/dynamic-dt/cases?search=ransom"):
+            user_filter(__import__("flask").request, Case.query, fields).limit(25).all()
+    return op
+
+
+@bench("agent.get_mac")
+def _(fx):
+    return _agent_functions("get_mac")["get_mac"]
+
+
+@bench("agent.collect_conns")
+def _(fx):
+    return _agent_functions("is_public_ip", "collect_conns")["collect_conns"]
+
+
+# ---------- замер ----------
+def _measure(op, min_time, repeats):
+    op()  # прогрев
+    n, t = 1, 0.0
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            op()
+        t = time.perf_counter() - t0
+        if t >= min_time / 5 or n >= 1 << 20:
+            break
+        n *= 4
+    rates = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            op()
+        rates.append(n / (time.perf_counter() - t0))
+
+    # аллокации: пик одного вызова и блоки, оставшиеся после k вызовов (утечки, рост кэшей)
+    k = max(1, min(n, 200))
+    tracemalloc.start()
+    try:
+        op()
+        cur, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        op()
+        _, peak = tracemalloc.get_traced_memory()
+        before = tracemalloc.take_snapshot()
+        for _ in range(k):
+            op()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained = sum(s.count_diff for s in after.compare_to(before, "filename"))
+    return {"ops_per_sec": round(statistics.median(rates), 1),
+            "peak_kib": round(max(0, peak - cur) / 1024, 1),
+            "retained_blocks_per_op": round(retained / k, 2)}
+
+
+def _compare(results, baseline, threshold):
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            r["vs_baseline"] = None
+            continue
+        delta = (r["ops_per_sec"] - base["ops_per_sec"]) / base["ops_per_sec"] * 100
+        r["vs_baseline"] = round(delta, 1)
+        if threshold is not None and delta < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Microbenchmarks for server and agent hot paths.")
+    p.add_argument("-k", dest="filter", help="run only benchmarks whose name contains this")
+    p.add_argument("--min-time", type=float, default=1.0, help="seconds per benchmark (approx.)")
+    p.add_argument("--repeats", type=int, default=5)
+    p.add_argument("--backend", default="memory://", help="STATE_BACKEND_URL for the run")
+    p.add_argument("--baseline", type=Path, default=BASELINE)
+    p.add_argument("--save", action="store_true", help="store results as the new baseline")
+    p.add_argument("--check", type=float, metavar="PCT",
+                   help="exit 1 if ops/sec dropped more than PCT%% against the baseline")
+    p.add_argument("--json", help="write results to this file")
+    args = p.parse_args(argv)
+
+    tmp = _setup_env(args.backend)
+    t0 = time.perf_counter()
+    fx = Fixtures(tmp)
+    print(f"fixtures: {N_AGENTS} agents, {N_CONN_AGENTS * 200} connections, {N_FILES} files, "
+          f"{N_CASES} cases ({time.perf_counter() - t0:.1f} s)")
+
+    results = {}
+    for name, factory in _benches:
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = _measure(factory(fx), args.min_time, args.repeats)
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8")).get("results", {})
+    regressions = _compare(results, baseline, args.check)
+
+    width = max(len(n) for n in results) if results else 10
+    print(f"{'benchmark':<{width}} {'ops/sec':>12} {'vs base':>9} {'peak KiB':>9} {'blocks/op':>10}")
+    for name, r in results.items():
+        vs = "-" if r["vs_baseline"] is None else f"{r['vs_baseline']:+.1f}%"
+        print(f"{name:<{width}} {r['ops_per_sec']:>12,.1f} {vs:>9} {r['peak_kib']:>9} {r['retained_blocks_per_op']:>10}")
+
+    meta = {"python": sys.version.split()[0], "platform": sys.platform, "backend": args.backend,
+            "date": datetime.utcnow().strftime("%Y-%m-%d")}
+    if args.save:
+        merged = dict(baseline)
+        merged.update({n: {k: v for k, v in r.items() if k != "vs_baseline"} for n, r in results.items()})
+        args.baseline.write_text(json.dumps({"meta": meta, "results": merged}, indent=2) + "\n", encoding="utf-8")
+        print(f"baseline saved to {args.baseline}")
+    if args.json:
+        Path(args.json).write_text(json.dumps({"meta": meta, "results": results}, indent=2), encoding="utf-8")
+    if regressions:
+        print("regressions: " + ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,400 @@
+# tools/loadgen.py
+# Нагрузочный генератор: N виртуальных агентов говорят с сервером ровно по протоколу agent.py —
+# long-poll heartbeat с ack, выполнение команд (пачка post_output + done), пуш /connections,
+# чанковая загрузка файлов. В конце — p50/p95/p99, пропускная способность и доля ошибок
+# по каждому эндпоинту.
+#
+#   python tools/loadgen.py --url http://127.0.0.1:5000 --agents 1000 --duration 60
+#   python tools/loadgen.py --agents 10000 --ramp 30 --commands-per-sec 50 --json before.json
+#
+# Только стандартная библиотека: asyncio + собственный минимальный HTTP/1.1-клиент,
+# как и agent.py (requests без Session) — новое соединение на каждый запрос.
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PUBLIC_IPS = [f"203.0.113.{i}" for i in range(1, 255)]  # TEST-NET-3: «публичные» адреса для /connections
+PROCS = ["chrome.exe", "svchost.exe", "python", "sshd", "curl"]
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Client:
+    """Минимальный HTTP/1.1: Content-Length и chunked, Connection: close — как requests без Session."""
+    def __init__(self, base, timeout):
+        u = urlsplit(base)
+        self.host, self.port = u.hostname, u.port or 80
+        self.timeout = timeout
+
+    async def request(self, method, path, body=b"", headers=None, timeout=None):
+        r, w = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        try:
+            head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                    f"Content-Length: {len(body)}", "Connection: close"]
+            head += [f"{k}: {v}" for k, v in (headers or {}).items()]
+            w.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+            await w.drain()
+            return await asyncio.wait_for(self._response(r), timeout or self.timeout)
+        finally:
+            w.close()
+
+    @staticmethod
+    async def _response(r):
+        status_line = await r.readline()
+        if not status_line:
+            raise HTTPError("connection closed")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await r.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int((await r.readline()).split(b";")[0], 16)
+                if not size:
+                    await r.readline()
+                    break
+                parts.append(await r.readexactly(size))
+                await r.readline()
+            body = b"".join(parts)
+        elif "content-length" in headers:
+            body = await r.readexactly(int(headers["content-length"]))
+        else:
+            body = await r.read()
+        return status, headers, body
+
+
+class Stats:
+    """Латентности и исходы по эндпоинтам (шаблон пути, а не конкретный агент)."""
+    def __init__(self):
+        self.count = defaultdict(int)
+        self.lat = defaultdict(list)
+        self.ok = defaultdict(int)
+        self.throttled = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.error_kinds = defaultdict(lambda: defaultdict(int))
+
+    def add(self, name, sec, status=None, error=None):
+        self.count[name] += 1
+        if error is not None:
+            self.errors[name] += 1
+            self.error_kinds[name][error] += 1
+            return
+        self.lat[name].append(sec)
+        if status == 429:
+            self.throttled[name] += 1
+        elif 200 <= status < 300:
+            self.ok[name] += 1
+        else:
+            self.errors[name] += 1
+            self.error_kinds[name][f"HTTP {status}"] += 1
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = max(0, min(len(sorted_vals) - 1, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+
+class Fleet:
+    def __init__(self, args):
+        self.args = args
+        self.client = Client(args.url, args.timeout)
+        self.stats = Stats()
+        self.started = self.stop_at = None
+        self.elapsed = 0.0
+        self.agent_ids = [f"{args.prefix}-{i:05d}" for i in range(args.agents)]
+        self.sent_commands = {}       # cmd_id -> время постановки (для задержки доставки)
+        self.delivery = []            # enqueue -> heartbeat-ответ с командой, сек
+        self.payload = os.urandom(args.upload_bytes) if args.upload_per_hour else b""
+
+    def running(self):
+        return time.monotonic() < self.stop_at
+
+    async def _sleep(self, sec):
+        # не спим дольше конца прогона — иначе отчёт ждёт самый долгий таймер
+        await asyncio.sleep(max(0.0, min(sec, self.stop_at - time.monotonic())))
+
+    async def call(self, name, method, path, obj=None, raw=None, headers=None, timeout=None):
+        body = raw if raw is not None else (json.dumps(obj).encode() if obj is not None else b"")
+        hdrs = {"Content-Type": "application/octet-stream" if raw is not None else "application/json"}
+        hdrs.update(headers or {})
+        t = time.perf_counter()
+        try:
+            status, h, data = await self.client.request(method, path, body, hdrs, timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError, ValueError) as e:
+            self.stats.add(name, time.perf_counter() - t, error=type(e).__name__)
+            return None, {}, None
+        self.stats.add(name, time.perf_counter() - t, status)
+        try:
+            parsed = json.loads(data) if data else None
+        except ValueError:
+            parsed = None
+        return status, h, parsed
+
+    async def _backoff(self, headers):
+        # agent.py: пауза из Retry-After с разбросом
+        try:
+            sec = float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            sec = 1.0
+        await self._sleep(min(sec, 300) * random.uniform(1.0, 1.5))
+
+    # ---------- поведение одного агента ----------
+    async def agent(self, agent_id, start_delay):
+        await self._sleep(start_delay)
+        tasks = [asyncio.ensure_future(self.heartbeat_loop(agent_id))]
+        if self.args.conns_interval > 0:
+            tasks.append(asyncio.ensure_future(self.conns_loop(agent_id)))
+        if self.args.outputs_per_min > 0:
+            tasks.append(asyncio.ensure_future(self.output_loop(agent_id)))
+        if self.args.upload_per_hour > 0:
+            tasks.append(asyncio.ensure_future(self.upload_loop(agent_id)))
+        await asyncio.gather(*tasks)
+
+    async def heartbeat_loop(self, agent_id):
+        n = int(agent_id.rsplit("-", 1)[1])
+        info = {"id": agent_id, "hostname": f"{self.args.prefix}-host-{n}",
+                "os": random.choice(["Windows 10", "Linux 6.1.0", "Darwin 23.1.0"]),
+                "mac": ":".join(f"{(n >> s) & 0xff:02X}" for s in (40, 32, 24, 16, 8, 0))}
+        acks, done_ids = [], set()
+        name = "POST /api/heartbeat" + (" (long-poll)" if self.args.wait else "")
+        while self.running():
+            status, h, body = await self.call(name, "POST", "/api/heartbeat",
+                                              dict(info, wait=self.args.wait, ack=acks),
+                                              timeout=self.args.wait + self.args.timeout)
+            if status == 429:
+                await self._backoff(h)
+                continue
+            if status != 200 or not isinstance(body, dict):
+                await self._sleep(1)
+                continue
+            batch = body.get("commands") or []
+            acks = [c["id"] for c in batch]
+            now = time.monotonic()
+            for c in batch:
+                sent = self.sent_commands.pop(c["id"], None)
+                if sent is not None:
+                    self.delivery.append(now - sent)
+                if c["id"] not in done_ids:
+                    done_ids.add(c["id"])
+                    await self.run_command(agent_id, c["id"])
+            if not self.args.wait:
+                await self._sleep(self.args.heartbeat_interval)
+
+    async def post_output(self, agent_id, cmd_id, text, done=False):
+        path = f"/api/agent/{agent_id}/output"
+        for _ in range(6):  # RATE_LIMIT_RETRIES в agent.py
+            status, h, _ = await self.call("POST /api/agent/<id>/output", "POST", path,
+                                           {"output": text, "command_id": cmd_id, "done": done})
+            if status != 429:
+                return
+            await self._backoff(h)
+
+    async def run_command(self, agent_id, cmd_id):
+        for i in range(self.args.output_burst):
+            await self.post_output(agent_id, cmd_id, f"line {i}: " + "x" * self.args.output_bytes)
+        await self.post_output(agent_id, cmd_id, "", done=True)
+
+    async def output_loop(self, agent_id):
+        # «болтливый» агент: пачки вывода вне команд (старый протокол без command_id)
+        period = 60.0 / self.args.outputs_per_min
+        await self._sleep(random.uniform(0, period))
+        while self.running():
+            for i in range(self.args.output_burst):
+                await self.post_output(agent_id, None, f"unsolicited {i}: " + "y" * self.args.output_bytes)
+            await self._sleep(random.expovariate(1 / period))
+
+    async def conns_loop(self, agent_id):
+        await self._sleep(random.uniform(0, self.args.conns_interval))
+        while self.running():
+            now = int(time.time())
+            conns = [{"ip": random.choice(PUBLIC_IPS), "port": random.choice((443, 80, 8443, 22)),
+                      "pid": random.randint(100, 60000), "proc": random.choice(PROCS), "ts": now}
+                     for _ in range(self.args.conns_per_push)]
+            status, h, _ = await self.call("POST /api/agent/<id>/connections", "POST",
+                                           f"/api/agent/{agent_id}/connections", {"conns": conns})
+            if status == 429:
+                await self._backoff(h)
+            await self._sleep(self.args.conns_interval)
+
+    async def upload_loop(self, agent_id):
+        period = 3600.0 / self.args.upload_per_hour
+        await self._sleep(random.uniform(0, period))
+        while self.running():
+            await self.upload(agent_id)
+            await self._sleep(random.expovariate(1 / period))
+
+    async def upload(self, agent_id):
+        data = self.payload
+        status, h, body = await self.call(
+            "POST /api/agent/<id>/uploads", "POST", f"/api/agent/{agent_id}/uploads",
+            {"name": f"loadgen-{uuid.uuid4().hex[:8]}.bin", "total": len(data),
+             "sha256": hashlib.sha256(data).hexdigest()})
+        if status != 200 or not isinstance(body, dict):
+            return
+        url, offset = f"/api/agent/{agent_id}/uploads/{body['upload_id']}", body["offset"]
+        chunk = self.args.upload_chunk
+        while self.running():
+            status, h, body = await self.call("PUT /api/agent/<id>/uploads/<upload_id>", "PUT",
+                                              f"{url}?offset={offset}", raw=data[offset:offset + chunk],
+                                              timeout=self.args.timeout + 30)
+            if status == 429:
+                await self._backoff(h)
+                continue
+            if status == 409 and isinstance(body, dict):
+                offset = body.get("offset") or 0
+                continue
+            if status != 200 or not isinstance(body, dict) or body.get("status") == "stored":
+                return
+            offset = body["offset"]
+
+    # ---------- «аналитик»: ставит команды случайным агентам ----------
+    async def commander(self):
+        if self.args.commands_per_sec <= 0:
+            return
+        await self._sleep(self.args.ramp)
+        while self.running():
+            agent_id = random.choice(self.agent_ids)
+            t = time.monotonic()
+            status, _, body = await self.call("POST /api/agent/<id>/command", "POST",
+                                              f"/api/agent/{agent_id}/command", {"command": "whoami"})
+            if status == 200 and isinstance(body, dict) and body.get("command_id"):
+                self.sent_commands[body["command_id"]] = t
+            await self._sleep(random.expovariate(self.args.commands_per_sec))
+
+    async def run(self):
+        self.started = time.monotonic()
+        self.stop_at = self.started + self.args.ramp + self.args.duration
+        step = self.args.ramp / max(1, len(self.agent_ids))
+        tasks = [asyncio.ensure_future(self.agent(a, i * step)) for i, a in enumerate(self.agent_ids)]
+        tasks.append(asyncio.ensure_future(self.commander()))
+        await asyncio.gather(*tasks)
+        self.elapsed = time.monotonic() - self.started
+
+    # ---------- отчёт ----------
+    def report(self):
+        rows = []
+        ms = lambda v: None if v is None else round(v * 1000, 1)
+        for name in sorted(self.stats.count):
+            lat = sorted(self.stats.lat[name])
+            total = self.stats.count[name]
+            rows.append({
+                "endpoint": name,
+                "requests": total,
+                "ok": self.stats.ok[name],
+                "throttled": self.stats.throttled[name],
+                "errors": self.stats.errors[name],
+                "error_rate": round(self.stats.errors[name] / total, 4) if total else 0.0,
+                "rps": round(total / self.elapsed, 1) if self.elapsed else 0.0,
+                "p50_ms": ms(percentile(lat, 50)),
+                "p95_ms": ms(percentile(lat, 95)),
+                "p99_ms": ms(percentile(lat, 99)),
+                "max_ms": ms(lat[-1] if lat else None),
+                "error_kinds": dict(self.stats.error_kinds[name]),
+            })
+        delivery = sorted(self.delivery)
+        return {
+            "config": {k: v for k, v in vars(self.args).items() if k != "json"},
+            "elapsed_sec": round(self.elapsed, 1),
+            "endpoints": rows,
+            "command_delivery_ms": {
+                "count": len(delivery),
+                "p50": None if not delivery else round(percentile(delivery, 50) * 1000, 1),
+                "p95": None if not delivery else round(percentile(delivery, 95) * 1000, 1),
+                "p99": None if not delivery else round(percentile(delivery, 99) * 1000, 1),
+                "undelivered": len(self.sent_commands),
+            },
+        }
+
+
+def print_report(rep):
+    cols = ("endpoint", "requests", "rps", "p50_ms", "p95_ms", "p99_ms", "max_ms", "error_rate", "throttled")
+    width = max([len(r["endpoint"]) for r in rep["endpoints"]] + [8])
+    print(f"\n{rep['config']['agents']} agents, {rep['elapsed_sec']} s (ramp {rep['config']['ramp']} s)")
+    print(f"{'endpoint':<{width}}" + "".join(f"{c:>11}" for c in cols[1:]))
+    for r in rep["endpoints"]:
+        print(f"{r['endpoint']:<{width}}" + "".join(
+            f"{'-' if r[c] is None else r[c]:>11}" for c in cols[1:]))
+        if r["error_kinds"]:
+            print(" " * 4 + ", ".join(f"{k}: {v}" for k, v in sorted(r["error_kinds"].items())))
+    d = rep["command_delivery_ms"]
+    if d["count"] or d["undelivered"]:
+        print(f"command delivery (enqueue -> agent): n={d['count']} p50={d['p50']} ms "
+              f"p95={d['p95']} ms p99={d['p99']} ms, undelivered={d['undelivered']}")
+    if rep["config"]["wait"]:
+        print("note: long-poll heartbeat latency includes the time the server holds the request")
+
+
+def _raise_fd_limit(need):
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < need:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(need, hard), hard))
+        except (ValueError, OSError):
+            pass
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft < need:
+            print(f"warning: open files limit {soft} < {need}; raise it with ulimit -n", file=sys.stderr)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Simulate a fleet of VAST agents against a server.")
+    p.add_argument("--url", default="http://127.0.0.1:5000", help="server base URL")
+    p.add_argument("--agents", type=int, default=1000)
+    p.add_argument("--duration", type=float, default=60, help="seconds of steady load after ramp-up")
+    p.add_argument("--ramp", type=float, default=10, help="seconds over which agents start")
+    p.add_argument("--prefix", default="loadgen", help="agent id prefix (ids: <prefix>-00001)")
+    p.add_argument("--wait", type=float, default=20, help="heartbeat long-poll seconds (0 = short poll)")
+    p.add_argument("--heartbeat-interval", type=float, default=5, help="pause between short-poll heartbeats")
+    p.add_argument("--conns-interval", type=float, default=15, help="seconds between /connections pushes, 0 = off")
+    p.add_argument("--conns-per-push", type=int, default=5)
+    p.add_argument("--commands-per-sec", type=float, default=0, help="commands queued to random agents")
+    p.add_argument("--outputs-per-min", type=float, default=0, help="unsolicited output bursts per agent")
+    p.add_argument("--output-burst", type=int, default=5, help="post_output calls per command / burst")
+    p.add_argument("--output-bytes", type=int, default=80)
+    p.add_argument("--upload-per-hour", type=float, default=0, help="chunked uploads per agent per hour")
+    p.add_argument("--upload-bytes", type=int, default=256 * 1024)
+    p.add_argument("--upload-chunk", type=int, default=4 * 1024 * 1024)
+    p.add_argument("--timeout", type=float, default=10, help="per-request timeout (plus long-poll wait)")
+    p.add_argument("--json", help="also write the report to this file")
+    args = p.parse_args(argv)
+
+    _raise_fd_limit(args.agents * 2 + 256)
+    fleet = Fleet(args)
+    try:
+        asyncio.run(fleet.run())
+    except KeyboardInterrupt:
+        fleet.elapsed = time.monotonic() - fleet.started
+    rep = fleet.report()
+    print_report(rep)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rep, f, indent=2)
+    return rep
+
+
+if __name__ == "__main__":
+    main()